@@ -0,0 +1,66 @@
+import pytest
+
+pytest.importorskip('itk')
+pytest.importorskip('vtk')
+pytest.importorskip('PyQt5')
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from managers import SegmentManager
+from segmenttubes import SegmentArgs, SegmentJobQueue, SegmentWorker
+
+def _runJobs(worker, imageHandles):
+    '''Runs one segment job per image handle on the worker.
+
+    Returns:
+        The SegmentJobStats of the jobs.
+    '''
+    stats = list()
+    for imageHandle in imageHandles:
+        args = SegmentArgs()
+        args.enqueueTime = args.startTime = 0.0
+        swapSkipped = worker._setImage(imageHandle)
+        worker._extractTube(args, 0.0, swapSkipped)
+        stats.append(args.stats)
+    return stats
+
+def test_skipped_image_swaps_in_stats():
+    worker = SegmentWorker(SegmentJobQueue())
+    worker.segmenter = mock.Mock(setupTime=0.0, extractTime=0.0)
+    worker.segmenter.extractTube.return_value = None
+    first = mock.Mock(version=1)
+    second = mock.Mock(version=2)
+
+    stats = _runJobs(worker, [first, first, second, second, second])
+
+    assert [s.toDict()['imageSwapSkipped'] for s in stats] == \
+            [False, True, False, True, True]
+    assert worker.segmenter.setImage.call_count == 2
+    assert worker.skippedImageSwaps == 3
+
+    manager = mock.Mock(workers=[worker, mock.Mock(skippedImageSwaps=2)])
+    skippedImageSwaps = getattr(SegmentManager.skippedImageSwaps,
+            '__func__', SegmentManager.skippedImageSwaps)
+    assert skippedImageSwaps(manager) == 5
+
+def _extractConcurrency(spans):
+    '''Calls SegmentManager.extractConcurrency on jobs that spent their
+    whole (start, finish) span in ExtractTube.
+    '''
+    stats = [mock.Mock(enqueueTime=0.0, queueWait=start, latency=finish,
+            extractTime=finish - start) for start, finish in spans]
+    manager = mock.Mock(jobStats=stats)
+    extractConcurrency = getattr(SegmentManager.extractConcurrency,
+            '__func__', SegmentManager.extractConcurrency)
+    return extractConcurrency(manager)
+
+def test_extract_concurrency():
+    assert _extractConcurrency([]) is None
+    # serialized jobs, with an idle gap
+    assert _extractConcurrency([(0.0, 1.0), (1.0, 2.0), (5.0, 6.0)]) == 1.0
+    # two jobs at a time
+    assert _extractConcurrency([(0.0, 2.0), (0.0, 2.0), (2.0, 3.0),
+            (2.0, 3.0)]) == 2.0
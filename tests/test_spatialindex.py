@@ -0,0 +1,65 @@
+import numpy as np
+
+from spatialindex import TubeSpatialIndex
+from tubestore import TubeStore
+from test_tubestore import addTube
+
+def straightTube(start, count=10, radius=1.0):
+    positions = np.zeros((count, 3))
+    positions[:, 0] = start + np.arange(count)
+    return positions, np.full(count, radius)
+
+def test_contains_point():
+    index = TubeSpatialIndex()
+    index.addTubePoints('a', *straightTube(0))
+    assert index.tubesContainingPoint((5, 0.5, 0)) == ['a']
+    assert index.tubesContainingPoint((5, 2, 0)) == []
+    assert index.containsPoints([(0, 0, 0), (50, 0, 0)]).tolist() == \
+            [True, False]
+
+def test_remove_and_readd():
+    index = TubeSpatialIndex()
+    index.addTubePoints('a', *straightTube(0))
+    index.addTubePoints('b', *straightTube(100))
+    index.removeTube('a')
+    assert index.tubesContainingPoint((5, 0, 0)) == []
+    assert index.tubesContainingPoint((105, 0, 0)) == ['b']
+    index.addTubePoints('a', *straightTube(50))
+    assert index.tubesContainingPoint((55, 0, 0)) == ['a']
+    assert len(index) == 2
+
+def test_nearest_tube():
+    index = TubeSpatialIndex()
+    index.addTubePoints('a', *straightTube(0))
+    index.addTubePoints('b', *straightTube(100))
+    tubeId, dist = index.nearestTube((95, 0, 0))
+    assert tubeId == 'b'
+    assert np.isclose(dist, 4)
+    assert index.nearestTube((50, 0, 0), maxDistance=10) is None
+
+def test_index_owns_points():
+    # the index must not follow tube store columns rewritten by compact
+    store = TubeStore()
+    index = TubeSpatialIndex()
+
+    def add(tubeId, start):
+        addTube(store, tubeId, start)
+        index.addTubePoints(tubeId, store.positions(tubeId),
+                store.radii(tubeId))
+
+    def remove(tubeId):
+        store.removeTube(tubeId)
+        index.removeTube(tubeId)
+
+    for tubeId, start in zip('abc', (0, 100, 200)):
+        add(tubeId, start)
+    remove('a')
+    remove('b')
+    add('d', 300)
+    add('e', 400)
+
+    assert index.tubesContainingPoint((205, 0, 0)) == ['c']
+    tubeId, dist = index.nearestTube((205, 0, 3))
+    assert tubeId == 'c'
+    assert np.isclose(dist, 2)
+    assert index.tubesContainingPoint((305, 0, 0)) == ['d']
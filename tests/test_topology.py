@@ -0,0 +1,51 @@
+import numpy as np
+
+from spatialindex import TubeSpatialIndex
+from topology import BuildTubeGraph
+from tubestore import TubeStore
+from test_tubestore import POINT_DTYPE
+
+def addTube(store, index, tubeId, start, end, radius, count=11):
+    '''Adds a straight tube from start to end to a store and an index.'''
+    points = np.zeros(count, dtype=POINT_DTYPE)
+    points['position'] = np.linspace(start, end, count)
+    points['radius'] = radius
+    store.addTubeArray(tubeId, points, np.eye(3), np.zeros(3))
+    index.addTubePoints(tubeId, store.positions(tubeId),
+            store.radii(tubeId))
+
+def test_branch_on_parent_wall():
+    store = TubeStore()
+    index = TubeSpatialIndex()
+    addTube(store, index, 'parent', (0, 0, 0), (20, 0, 0), 2.0)
+    # starts on the parent wall, 2.0 away from the parent axis
+    addTube(store, index, 'branch', (10, 2, 0), (10, 12, 0), 0.5)
+
+    graph = BuildTubeGraph(store, index)
+    assert graph.parent('branch') == 'parent'
+    assert graph.roots() == ['parent']
+    connection = graph.connections['branch']
+    assert connection.childPoint == 0
+    assert connection.parentPoint == 5
+    assert np.isclose(connection.distance, 0)
+
+def test_distant_tubes_stay_apart():
+    store = TubeStore()
+    index = TubeSpatialIndex()
+    addTube(store, index, 'a', (0, 0, 0), (20, 0, 0), 2.0)
+    addTube(store, index, 'b', (10, 5, 0), (10, 15, 0), 0.5)
+
+    graph = BuildTubeGraph(store, index)
+    assert graph.parent('b') is None
+    assert sorted(graph.roots()) == ['a', 'b']
+
+def test_tubes_without_points():
+    store = TubeStore()
+    index = TubeSpatialIndex()
+    addTube(store, index, 'a', (0, 0, 0), (20, 0, 0), 2.0)
+    addTube(store, index, 'empty', (0, 0, 0), (0, 0, 0), 1.0, count=0)
+    addTube(store, index, 'b', (10, 2, 0), (10, 12, 0), 0.5)
+
+    graph = BuildTubeGraph(store, index)
+    assert graph.parent('b') == 'a'
+    assert sorted(graph.roots()) == ['a', 'empty']
@@ -0,0 +1,64 @@
+import numpy as np
+
+from tubestore import TubeStore
+
+POINT_DTYPE = [(name, dtype, shape) for name, dtype, shape in
+        TubeStore.COLUMNS]
+
+def makePoints(start, count=10, radius=1.0):
+    '''Makes tube points along the x axis, starting at x = start.'''
+    points = np.zeros(count, dtype=POINT_DTYPE)
+    points['position'][:, 0] = start + np.arange(count)
+    points['radius'] = radius
+    points['tangent'][:, 0] = 1
+    return points
+
+def addTube(store, tubeId, start, count=10, radius=1.0):
+    store.addTubeArray(tubeId, makePoints(start, count, radius),
+            np.eye(3), np.zeros(3))
+
+def test_add_tube_applies_transform():
+    store = TubeStore()
+    matrix = np.diag([2.0, 2.0, 2.0])
+    store.addTubeArray('a', makePoints(0, 3), matrix, np.array([1, 0, 0]))
+    np.testing.assert_allclose(store.positions('a')[:, 0], [1, 3, 5])
+    np.testing.assert_allclose(store.radii('a'), 2)
+    np.testing.assert_allclose(store.column('tangent', 'a')[:, 0], 1)
+
+def test_remove_compacts_columns():
+    store = TubeStore()
+    for tubeId, start in zip('abc', (0, 100, 200)):
+        addTube(store, tubeId, start)
+    store.removeTube('a')
+    store.removeTube('b')
+    # more than half of the entries were garbage
+    assert store.records['c'].offset == 0
+    assert store.numPoints() == 10
+    np.testing.assert_allclose(store.positions('c')[:, 0],
+            200 + np.arange(10))
+
+def test_readd_after_compact():
+    store = TubeStore()
+    for tubeId, start in zip('abc', (0, 100, 200)):
+        addTube(store, tubeId, start)
+    store.removeTube('a')
+    store.removeTube('b')
+    addTube(store, 'd', 300)
+    addTube(store, 'e', 400)
+    assert sorted(store.records) == ['c', 'd', 'e']
+    for tubeId, start in zip('cde', (200, 300, 400)):
+        np.testing.assert_allclose(store.positions(tubeId)[:, 0],
+                start + np.arange(10))
+
+    tubeIds, offsets, counts = store.layout()
+    assert tubeIds == ['c', 'd', 'e']
+    assert offsets.tolist() == [0, 10, 20]
+    assert counts.tolist() == [10, 10, 10]
+
+def test_grow_keeps_tubes():
+    store = TubeStore()
+    count = TubeStore.INITIAL_CAPACITY // 2 + 1
+    addTube(store, 'a', 0, count)
+    addTube(store, 'b', 0, count)
+    assert len(store.positions()) == 2*count
+    np.testing.assert_allclose(store.positions('a')[:, 0], np.arange(count))
@@ -0,0 +1,48 @@
+import inspect
+import re
+
+import pytest
+
+pytest.importorskip('itk')
+pytest.importorskip('vtk')
+pytest.importorskip('PyQt5')
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from managers import ViewManager
+from vtkviewer import VTKViewer
+
+def _showTubes(mergeTubes):
+    '''Calls ViewManager.showTubes with a VTKViewer spec as the viewer.
+
+    The viewer mock only accepts methods that VTKViewer defines, so a
+    method dropped from the viewer fails here.
+    '''
+    viewer = mock.create_autospec(VTKViewer, instance=True)
+    manager = mock.Mock(mergeTubes=mergeTubes)
+    manager.window.vtkView.return_value = viewer
+    showTubes = getattr(ViewManager.showTubes, '__func__',
+            ViewManager.showTubes)
+    showTubes(manager)
+    return viewer
+
+def test_show_tube_blocks():
+    viewer = _showTubes(False)
+    assert viewer.setInteractionTubes.called
+    assert viewer.showTubeBlocks.called
+    assert not viewer.showMergedTubes.called
+
+def test_show_merged_tubes():
+    viewer = _showTubes(True)
+    assert viewer.setInteractionTubes.called
+    assert viewer.showMergedTubes.called
+    assert not viewer.showTubeBlocks.called
+
+def test_viewer_has_view_manager_calls():
+    # every vtkView() method used by ViewManager exists on VTKViewer
+    source = inspect.getsource(ViewManager)
+    for name in set(re.findall(r'vtkView\(\)\.(\w+)', source)):
+        assert hasattr(VTKViewer, name), name
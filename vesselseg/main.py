@@ -1,3 +1,4 @@
+import os
 import sys
 
 import signal
@@ -28,6 +29,8 @@ class VesselSegApp(QObject):
         self.filterManager = FilterManager()
 
         self.viewManager.setSegmentScale(self.segmentManager.scale())
+        self.segmentManager.setPresetScales(
+                self.viewManager.getSegmentScalePresets())
         self.viewManager.disableUi()
 
         # main window
@@ -37,6 +40,12 @@ class VesselSegApp(QObject):
         self.viewManager.fileSelected.connect(self.loadFile)
         self.viewManager.imageVoxelSelected.connect(self.segmentTube)
         self.viewManager.scaleChanged.connect(self.segmentManager.setScale)
+        self.viewManager.seedFileSelected.connect(self.segmentSeedFile)
+        self.viewManager.findSeedsClicked.connect(self.segmentWholeImage)
+        self.viewManager.speculativeEnabled.connect(
+                self.segmentManager.setSpeculative)
+        self.viewManager.roiSizeChanged.connect(
+                self.segmentManager.setRoiSize)
         self.viewManager.tubeSelected.connect(self.tubeManager.toggleSelection)
         self.viewManager.deleteTubeSelClicked.connect(
                 self.tubeManager.deleteSelection)
@@ -44,6 +53,10 @@ class VesselSegApp(QObject):
                 self.tubeManager.clearSelection)
         self.viewManager.selectAllTubesClicked.connect(
                 self.tubeManager.selectAllTubes)
+        self.viewManager.selectByRadiusClicked.connect(
+                self.tubeManager.selectByRadius)
+        self.viewManager.buildTreeClicked.connect(self.buildTubeTree)
+        self.viewManager.saveTubesClicked.connect(self.viewManager.saveTubes)
         self.viewManager.windowLevelChanged.connect(
                 self.filterManager.setWindowLevel)
         self.viewManager.windowLevelFilterEnabled.connect(
@@ -63,8 +76,19 @@ class VesselSegApp(QObject):
         # segment manager
         self.segmentManager.tubeSegmented.connect(
                 self.tubeManager.addSegmentedTube)
+        self.segmentManager.tubesSegmented.connect(
+                self.tubeManager.addSegmentedTubes)
         self.segmentManager.jobCountChanged.connect(
                 self.viewManager.showJobCount)
+        self.segmentManager.batchProgress.connect(
+                self.viewManager.showBatchProgress)
+        self.segmentManager.seedsRejected.connect(
+                self.viewManager.showSeedsRejected)
+        self.segmentManager.seedFindingFailed.connect(
+                self.seedFindingFailed)
+        self.segmentManager.setSpatialIndex(self.tubeManager.spatialIndex)
+        self.segmentManager.setTelemetryLog(
+                os.environ.get('VESSELSEG_TELEMETRY_LOG'))
 
         # tube manager
         self.tubeManager.tubesUpdated.connect(self.viewManager.displayTubes)
@@ -88,6 +112,7 @@ class VesselSegApp(QObject):
     def teardown(self):
         '''Tear down application.'''
         self.segmentManager.stop()
+        self.viewManager.stop()
 
     def loadFile(self, filename):
         # filename is passed as a unicode type, so make it str type
@@ -105,14 +130,12 @@ class VesselSegApp(QObject):
         self.viewManager.reset()
         self.viewManager.displayImage(
                 imageManager.vtkImage, imageManager.filename)
-        self.segmentManager.setImage(
-                imageManager.itkImage,
-                imageManager.itkPixelType,
-                imageManager.dimension)
         self.filterManager.setImage(
                 imageManager.itkImage,
                 imageManager.itkPixelType,
                 imageManager.dimension)
+        self.segmentManager.setImageHandle(
+                self.filterManager.getOutputHandle())
         self.resetTubeManager()
 
     def changeViewedImage(self, imageType):
@@ -137,11 +160,38 @@ class VesselSegApp(QObject):
 
     def segmentTube(self, x, y, z):
         if self.viewManager.isSegmentEnabled():
-            self.segmentManager.setImage(
-                    self.filterManager.getOutput(),
-                    *self.filterManager.getOutputType())
+            # only changes the segmenting image if the handle version changed
+            self.segmentManager.setImageHandle(
+                    self.filterManager.getOutputHandle())
             self.segmentManager.segmentTube(x, y, z)
 
+    def segmentSeedFile(self, filename):
+        '''Segments tubes at all seeds in a seed file.'''
+        self.segmentManager.setImageHandle(
+                self.filterManager.getOutputHandle())
+        try:
+            self.segmentManager.segmentTubes(str(filename))
+        except Exception as e:
+            self.viewManager.alert('Seeds could not be read: %s' % e)
+
+    def segmentWholeImage(self):
+        '''Segments tubes at seeds found across the preprocessed image.'''
+        self.segmentManager.setImageHandle(
+                self.filterManager.getOutputHandle())
+        self.segmentManager.segmentWholeImage()
+
+    def seedFindingFailed(self, exc):
+        '''Callback for when seeds could not be found.'''
+        self.viewManager.alert('Seeds could not be found: %s' % exc)
+
+    def buildTubeTree(self):
+        '''Connects the tubes into vessel trees.'''
+        progress = self.viewManager.makeProgressDialog(
+                'Building vessel tree...')
+        graph = self.tubeManager.buildTopology()
+        progress.close()
+        self.viewManager.showTubeGraph(graph)
+
     def resetTubeManager(self):
         '''Resets tube manager.'''
         self.tubeManager.reset()
@@ -13,6 +13,8 @@ class MainWindow(QMainWindow):
     fileSelected = pyqtSignal(str)
     # signal: window was closed
     closed = pyqtSignal()
+    # signal: tube mesh generation should be cancelled
+    cancelMeshingClicked = pyqtSignal()
 
     def __init__(self, parent=None):
         super(MainWindow, self).__init__(parent)
@@ -26,6 +28,16 @@ class MainWindow(QMainWindow):
         self.statusLabel = QLabel(self)
         self.statusBar().addWidget(self.statusLabel)
 
+        # tube mesh generation progress
+        self.meshProgressBar = QProgressBar(self)
+        self.meshProgressBar.setFormat('Meshing tubes: %v/%m')
+        self.meshProgressBar.hide()
+        self.statusBar().addPermanentWidget(self.meshProgressBar)
+        self.cancelMeshingBtn = QPushButton('Cancel', self)
+        self.cancelMeshingBtn.hide()
+        self.statusBar().addPermanentWidget(self.cancelMeshingBtn)
+        self.cancelMeshingBtn.clicked.connect(self.cancelMeshingClicked)
+
         self.openAction.triggered.connect(self.openFileDialog)
 
     def createMenus(self):
@@ -71,6 +83,27 @@ class MainWindow(QMainWindow):
         else:
             self.statusLabel.setText('Segmenting jobs: %d' % count)
 
+    def showStatusMessage(self, message, timeout=3000):
+        '''Shows a temporary message in the status bar.'''
+        self.statusBar().showMessage(message, timeout)
+
+    def showBatchProgress(self, done, total):
+        '''Shows batch segmentation progress.'''
+        if done >= total:
+            self.statusBar().clearMessage()
+        else:
+            self.statusBar().showMessage(
+                    'Segmenting seeds: %d/%d' % (done, total))
+
+    def showMeshProgress(self, done, total):
+        '''Shows tube mesh generation progress.'''
+        busy = done < total
+        if busy:
+            self.meshProgressBar.setMaximum(total)
+            self.meshProgressBar.setValue(done)
+        self.meshProgressBar.setVisible(busy)
+        self.cancelMeshingBtn.setVisible(busy)
+
     def show(self):
         '''Overridden show().
 
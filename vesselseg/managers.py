@@ -1,17 +1,36 @@
 import os
+import copy
+import json
+import time
 import math
+import Queue
+import itertools
 import collections
 
-from PyQt5.QtCore import QThread, QObject, pyqtSignal
+import numpy as np
+from PyQt5.QtCore import QThread, QObject, QTimer, pyqtSignal
 
 import vtk
 import itk
 from vtk.util import keys
+import vtk.util.numpy_support as np_s
 
-from segmenttubes import SegmentWorker, SegmentArgs, TubeIterator, GetTubePoints
+from segmenttubes import SegmentWorker, SegmentArgs, SegmentJobQueue, \
+        SegmentJobStats, TubeRegistry, GetTubePointArray, \
+        GetTubeTransformArrays
 from models import TubeTreeViewModel, RAW_DATA_ROLE
-
-TUBE_ID_KEY = keys.MakeKey(keys.StringKey, 'tube.id', '')
+from spatialindex import TubeSpatialIndex
+from tubestore import TubeStore
+from topology import BuildTubeGraph
+from simplify import SimplifiedCopy, DEFAULT_MAX_ERROR
+from tubemesh import MeshWorker, MeshJob, MeshCache, DEFAULT_SIDE_LENGTH
+from morphometrics import TubeMorphometrics
+from selection import TubeSelection, TubeSelectionChange
+from utils import ImageHandle, readSeedFile
+
+TUBE_ID_KEY = keys.MakeKey(keys.IntegerKey, 'tube.id', '')
+# name of the cell array holding the tube ID of each tube mesh cell
+TUBE_ID_ARRAY = 'TubeId'
 
 VTK_ITK_TYPE_CONVERSION = {
     vtk.VTK_UNSIGNED_CHAR: itk.UC,
@@ -96,13 +115,47 @@ class ImageManager(QObject):
         self.imageLoaded.emit(self)
         return True
 
+class TubeChangeSet(object):
+    '''Describes an update of the stored tubes.
+
+    Consumers apply removed tubes first, then added and modified tubes.
+    '''
+
+    def __init__(self, tubeGroup, tubes, morphometrics=None, reset=False,
+            tubeStore=None):
+        # the root tube group
+        self.tubeGroup = tubeGroup
+        # tubeId -> itk tube, for all tubes after the update
+        self.tubes = tubes
+        # TubeStore holding the world space points of all tubes
+        self.tubeStore = tubeStore
+        # TubeMorphometrics of all tubes after the update
+        self.morphometrics = morphometrics
+        # the root tube group was replaced, so consumers should start over
+        self.reset = reset
+        # tubes were moved within the tube tree, without changing shape
+        self.restructured = False
+        # lists of tube IDs
+        self.added = list()
+        self.removed = list()
+        self.modified = list()
+        # tube groups newly attached to the tube tree
+        self.addedGroups = list()
+
+    def isEmpty(self):
+        return not (self.reset or self.restructured or self.added or
+                self.removed or self.modified or self.addedGroups)
+
 class TubeManager(QObject):
     '''Manager for segmented and imported tubes.'''
 
+    # number of imported tubes registered per event loop iteration
+    IMPORT_BATCH_SIZE = 64
+
     # signal: stored tubes were updated
-    tubesUpdated = pyqtSignal(itk.GroupSpatialObject[3])
+    tubesUpdated = pyqtSignal(TubeChangeSet)
     # signal: tube selection changed
-    tubeSelectionChanged = pyqtSignal(set)
+    tubeSelectionChanged = pyqtSignal(TubeSelectionChange)
 
     def __init__(self, parent=None):
         super(TubeManager, self).__init__(parent)
@@ -113,7 +166,26 @@ class TubeManager(QObject):
 
         # map tubeId -> itk tube
         self.tubes = dict()
-        self.tubeSelection = set()
+        # map hash(tube) -> tubeId
+        self._tubeIds = dict()
+        # tube IDs are never reused, even across resets
+        self._nextTubeId = itertools.count(1)
+        self.tubeSelection = TubeSelection()
+        # columnar world space point data of all tubes
+        self.tubeStore = TubeStore()
+        # spatial index over all tubes
+        self.spatialIndex = TubeSpatialIndex()
+        # flattened view of the tube tree
+        self.tubeRegistry = TubeRegistry()
+        # vessel tree from the last topology build
+        self.tubeGraph = None
+        # per-tube and per-group measurements
+        self.morphometrics = TubeMorphometrics()
+        # imported tubes that are not registered yet
+        self._importQueue = collections.deque()
+        self._importTimer = QTimer(self)
+        self._importTimer.setSingleShot(True)
+        self._importTimer.timeout.connect(self._importNextTubes)
 
         self.reset()
 
@@ -147,34 +219,122 @@ class TubeManager(QObject):
 
     def addSegmentedTube(self, tube):
         '''Adds a segmented tube to the segmented tube set.'''
-        self.tubes[str(hash(tube))] = tube
-        group = tube.GetParent()
-
-        # replace the current segment group with new one
-        # also copy over transform info
-        children = group.GetChildren()
-        transform = group.GetObjectToWorldTransform()
-        self._segmentedGroup.GetTreeNode().SetData(group)
-        self._segmentedGroup.SetObjectToWorldTransform(transform)
-        self._segmentedGroup.SetChildren(children)
+        self.addSegmentedTubes([tube])
+
+    def addSegmentedTubes(self, tubes):
+        '''Adds several segmented tubes in one update.'''
+        changeSet = self._newChangeSet()
+        for tube in tubes:
+            changeSet.added.append(self._addSegmentedTube(tube))
+        if not changeSet.isEmpty():
+            self._emitChanges(changeSet)
+
+    def _newChangeSet(self, reset=False):
+        return TubeChangeSet(self._tubeGroup, self.tubes,
+                self.morphometrics, reset, self.tubeStore)
+
+    def _emitChanges(self, changeSet):
+        '''Updates tube morphometrics, then emits a change set.'''
+        if changeSet.reset:
+            self.morphometrics.clear()
+        changed = changeSet.added + changeSet.modified
+        if changeSet.restructured:
+            regrouped = self.tubes
+        else:
+            regrouped = changed
+        groups = dict((tubeId, self._groupKeys(self.tubes[tubeId]))
+                for tubeId in regrouped if tubeId in self.tubes)
+        self.morphometrics.update(self.tubeStore, changed,
+                changeSet.removed, groups)
+        self.tubesUpdated.emit(changeSet)
+
+    def _groupKeys(self, tube):
+        '''Gets the keys of the tube groups containing a tube.'''
+        return tuple(hash(ancestor)
+                for ancestor in self.tubeRegistry.pathOf(tube)
+                if isinstance(ancestor, itk.GroupSpatialObject[3]))
+
+    def tubeId(self, tube):
+        '''Gets the ID of a registered tube, or None.'''
+        return self._tubeIds.get(hash(tube))
+
+    def _registerTube(self, tube):
+        '''Adds a tube to the tube map, tube store and spatial index.
 
-        self.tubesUpdated.emit(self._tubeGroup)
+        Returns:
+            The new tube ID.
+        '''
+        tubeId = next(self._nextTubeId)
+        self.tubes[tubeId] = tube
+        self._tubeIds[hash(tube)] = tubeId
+        matrix, offset = GetTubeTransformArrays(tube)
+        self.tubeStore.addTubeArray(tubeId, GetTubePointArray(tube), matrix,
+                offset)
+        self.spatialIndex.addTubePoints(tubeId,
+                self.tubeStore.positions(tubeId),
+                self.tubeStore.radii(tubeId))
+        return tubeId
+
+    def _unregisterTube(self, tubeId):
+        '''Removes a tube from the tube map, tube store and spatial index.'''
+        tube = self.tubes.pop(tubeId)
+        del self._tubeIds[hash(tube)]
+        self.tubeStore.removeTube(tubeId)
+        self.spatialIndex.removeTube(tubeId)
+
+    def _addSegmentedTube(self, tube):
+        # Segment workers hand over parentless copies placed in world space,
+        # see DetachTube(), so the segmented group keeps an identity
+        # transform and no worker ever sees the tubes added to it.
+        self._segmentedGroup.AddSpatialObject(tube)
+        tube.ComputeObjectToWorldTransform()
+        self.tubeRegistry.addSubtree(tube)
+        return self._registerTube(tube)
 
     def importTubeGroup(self, group):
-        '''Adds a whole tube group as imported tubes.'''
-        for tube in TubeIterator(group):
-            self.tubes[str(hash(tube))] = tube
+        '''Adds a whole tube group as imported tubes.
+
+        The group joins the tube tree right away. Its tubes are registered
+        in batches of IMPORT_BATCH_SIZE from the event loop, with one change
+        set per batch, so that the first tubes show while the rest load.
+        '''
         self._tubeGroup.AddSpatialObject(group)
-        self.tubesUpdated.emit(self._tubeGroup)
+        self._importQueue.extend(self.tubeRegistry.addSubtree(group))
+        changeSet = self._newChangeSet()
+        changeSet.addedGroups.append(group)
+        self._importNextTubes(changeSet)
+
+    def _importNextTubes(self, changeSet=None):
+        '''Registers the next batch of imported tubes.'''
+        if changeSet is None:
+            changeSet = self._newChangeSet()
+        count = min(self.IMPORT_BATCH_SIZE, len(self._importQueue))
+        for _ in range(count):
+            tube = self._importQueue.popleft()
+            changeSet.added.append(self._registerTube(tube))
+        if not changeSet.isEmpty():
+            self._emitChanges(changeSet)
+        if self._importQueue:
+            self._importTimer.start(0)
 
     def reset(self):
         '''Resets the tube manager state.'''
+        self._importQueue.clear()
+        self._importTimer.stop()
+        removed = list(self.tubes)
         self.tubes.clear()
+        self._tubeIds.clear()
+        self.tubeStore.clear()
+        self.spatialIndex.clear()
+        self._emitSelection(self.tubeSelection.clear())
         self._tubeGroup = itk.GroupSpatialObject[3].New()
         self._segmentedGroup = itk.GroupSpatialObject[3].New()
         self._segmentedGroup.SetObjectName('Segmented Tubes')
         self._tubeGroup.AddSpatialObject(self._segmentedGroup)
-        self.tubesUpdated.emit(self._tubeGroup)
+        self.tubeRegistry.setRoot(self._tubeGroup)
+        changeSet = self._newChangeSet(reset=True)
+        changeSet.removed.extend(removed)
+        self._emitChanges(changeSet)
 
     def toggleSelection(self, tubeId):
         '''Toggles the selection of a tube.
@@ -182,127 +342,474 @@ class TubeManager(QObject):
         Args:
             tubeId: the tube ID for which to toggle selection.
         '''
-        # convert qstring to python str
-        tubeId = str(tubeId)
-        if tubeId in self.tubeSelection:
-            self.tubeSelection.remove(tubeId)
-        else:
-            self.tubeSelection.add(tubeId)
-        self.tubeSelectionChanged.emit(self.tubeSelection)
+        self._emitSelection(self.tubeSelection.toggle(tubeId))
+
+    def _emitSelection(self, change):
+        '''Emits a selection change, unless it is empty.'''
+        if not change.isEmpty():
+            self.tubeSelectionChanged.emit(change)
 
     def deleteSelection(self):
         '''Deletes the current tube selection.'''
         if len(self.tubeSelection) > 0:
+            changeSet = self._newChangeSet()
             for tubeId in self.tubeSelection:
+                if tubeId not in self.tubes:
+                    continue
                 tube = self.tubes[tubeId]
-                tube.GetParent().RemoveSpatialObject(tube)
-                del self.tubes[tubeId]
-            self.tubeSelection.clear()
+                parent = tube.GetParent()
+                # keep the branches of a deleted tube in the tree
+                children = tube.GetChildren()
+                for i in range(tube.GetNumberOfChildren()):
+                    self._reparentTube(children[i], parent)
+                    changeSet.restructured = True
+                parent.RemoveSpatialObject(tube)
+                self.tubeRegistry.removeSubtree(tube)
+                self._unregisterTube(tubeId)
+                changeSet.removed.append(tubeId)
+            selectionChange = self.tubeSelection.clear()
+            if changeSet.restructured:
+                self.tubeRegistry.invalidate()
+
+            self._emitChanges(changeSet)
+            self._emitSelection(selectionChange)
+
+    def buildTopology(self, **kwargs):
+        '''Connects all tubes into vessel trees.
+
+        Tubes are reparented below the tube they branch off from. Tubes
+        that start a tree are moved back to their tube group.
+
+        Args:
+            kwargs: passed to topology.BuildTubeGraph.
+
+        Returns:
+            The topology.TubeGraph.
+        '''
+        graph = BuildTubeGraph(self.tubeStore, self.spatialIndex, **kwargs)
+
+        # the group a tube belongs to, past any parent tubes
+        homeGroups = dict()
+        for tubeId, tube in self.tubes.items():
+            for ancestor in reversed(self.tubeRegistry.pathOf(tube)):
+                if isinstance(ancestor, itk.GroupSpatialObject[3]):
+                    homeGroups[tubeId] = ancestor
+                    break
+
+        changeSet = self._newChangeSet()
+        for tubeId in graph.depthFirst():
+            tube = self.tubes[tubeId]
+            parentId = graph.parent(tubeId)
+            if parentId is None:
+                newParent = homeGroups.get(tubeId, self._segmentedGroup)
+            else:
+                newParent = self.tubes[parentId]
+            if hash(tube.GetParent()) != hash(newParent):
+                self._reparentTube(tube, newParent)
+                changeSet.restructured = True
+
+        self.tubeGraph = graph
+        if changeSet.restructured:
+            self.tubeRegistry.invalidate()
+            self._emitChanges(changeSet)
+        return graph
 
-            self.tubesUpdated.emit(self._tubeGroup)
-            self.tubeSelectionChanged.emit(self.tubeSelection)
+    def _reparentTube(self, tube, newParent):
+        '''Moves a spatial object below a new parent.
+
+        The object keeps its world transform.
+        '''
+        tube.ComputeObjectToWorldTransform()
+        current = tube.GetObjectToWorldTransform()
+        world = itk.ScalableAffineTransform[itk.D, 3].New()
+        world.SetFixedParameters(current.GetFixedParameters())
+        world.SetParameters(current.GetParameters())
+
+        tube.GetParent().RemoveSpatialObject(tube)
+        newParent.AddSpatialObject(tube)
+        newParent.ComputeObjectToWorldTransform()
+        tube.SetObjectToWorldTransform(world)
+        tube.ComputeObjectToParentTransform()
+        tube.ComputeObjectToWorldTransform()
 
     def clearSelection(self):
         '''Clears current tube selection.'''
-        self.tubeSelection.clear()
-        self.tubeSelectionChanged.emit(self.tubeSelection)
+        self._emitSelection(self.tubeSelection.clear())
 
     def selectAllTubes(self):
         '''Selects all tubes.'''
-        self.tubeSelection.update(self.tubes)
-        self.tubeSelectionChanged.emit(self.tubeSelection)
+        self._emitSelection(self.tubeSelection.select(self.tubes))
+
+    def selectByMetric(self, name, minValue, maxValue, extend=False):
+        '''Selects the tubes with a metric within a range.
+
+        Args:
+            name: a morphometrics.METRIC_LABELS metric name.
+            minValue, maxValue: inclusive bounds of the metric.
+            extend: add to the current selection instead of replacing it.
+        '''
+        tubeIds, values = self.morphometrics.metricValues(name)
+        matched = TubeSelection(
+                tubeIds[(values >= minValue) & (values <= maxValue)])
+        if extend:
+            matched = matched | self.tubeSelection
+        self._emitSelection(self.tubeSelection.assign(matched))
+
+    def selectByRadius(self, minRadius, maxRadius):
+        '''Selects the tubes with a mean radius within a range.'''
+        self.selectByMetric('meanRadius', minRadius, maxRadius)
 
 class TubePolyManager(QObject):
-    '''Manager for tube poly data.'''
+    '''Manager for tube poly data.
+
+    Tube meshes are available both as blocks of a vtkMultiBlockDataSet, one
+    per tube, and merged into chunks of tubes. Tube centerlines are merged
+    into chunks as well, used as a low detail stand-in during interaction.
+    Every mesh and centerline cell carries its tube ID in the TUBE_ID_ARRAY
+    cell array.
+
+    Meshes are generated in batches by a pool of mesh workers, each running
+    on its own thread, and are added as their batches finish. Each finished
+    batch becomes one chunk, so adding a batch does not copy the meshes of
+    other batches. Removing a tube rebuilds only the chunk it was in.
+    '''
 
-    def __init__(self, parent=None):
+    # number of tubes per mesh job
+    BATCH_SIZE = 32
+
+    # signal: meshes of a finished batch were added, with their tube IDs
+    meshesAdded = pyqtSignal(list)
+    # signal: mesh generation progress (done, total)
+    meshProgress = pyqtSignal(int, int)
+    # signal: mesh generation threw exception
+    meshingErrored = pyqtSignal(Exception)
+
+    def __init__(self, numWorkers=None, meshCache=None, parent=None):
+        '''Creates a TubePolyManager.
+
+        Args:
+            numWorkers: number of mesh workers. Defaults to the ideal
+                thread count of the machine.
+            meshCache: MeshCache shared by the mesh workers. Defaults to a
+                cache in the user cache directory.
+        '''
         super(TubePolyManager, self).__init__(parent)
 
-        # str(hash(tube)) -> vtkPolyData
+        # tubeId -> vtkPolyData
         self.tubePolys = dict()
-        # cached tube blocks
-        self._tubeBlocks = None
-        # determines if tube blocks need regeneration
-        self._tubeBlocksModified = True
-
-    def updatePolyData(self, tubeGroup):
-        '''Updates the polygonal data.'''
-        newTubePolys = dict()
-        for tube in TubeIterator(tubeGroup):
-            tubeId = str(hash(tube))
-            if tubeId in self.tubePolys:
-                newTubePolys[tubeId] = self.tubePolys[tubeId]
-            else:
-                newTubePolys[tubeId] = self._createTubePolyData(tube)
-        self.tubePolys = newTubePolys
-        self._tubeBlocksModified = True
+        # tubeId -> centerline vtkPolyData
+        self.tubeCenterlines = dict()
+        # tubeId -> flat index of the tube block
+        self.blockIndexes = dict()
+        # flat block index -> tubeId
+        self.blockTubeIds = dict()
+        self._tubeBlocks = vtk.vtkMultiBlockDataSet()
+        # block slots emptied by removed tubes
+        self._freeBlocks = list()
+        # merged tube meshes and centerlines, one block per chunk
+        self._mergedBlocks = vtk.vtkMultiBlockDataSet()
+        self._centerlineBlocks = vtk.vtkMultiBlockDataSet()
+        self._mergedProducer = vtk.vtkTrivialProducer()
+        self._mergedProducer.SetOutput(self._mergedBlocks)
+        self._centerlineProducer = vtk.vtkTrivialProducer()
+        self._centerlineProducer.SetOutput(self._centerlineBlocks)
+        # chunk block index -> list of tube IDs
+        self._chunkTubes = dict()
+        # tubeId -> chunk block index
+        self._tubeChunks = dict()
+        # chunks that lost tubes and need to be rebuilt
+        self._dirtyChunks = set()
+        # chunk slots emptied by removed chunks
+        self._freeChunks = list()
+        # TubeStore holding the points of the displayed tubes
+        self._tubeStore = None
+        # maximum centerline simplification error, in world units
+        self.maxError = DEFAULT_MAX_ERROR
+        # length of a side of tube mesh cross sections, in world units
+        self.sideLength = DEFAULT_SIDE_LENGTH
+
+        # tubeId -> token of the latest queued mesh of the tube. Results
+        # with another token are out of date.
+        self._pending = dict()
+        self._tokens = itertools.count()
+        # bumped to drop all queued and running jobs
+        self._generation = 0
+        # number of tubes meshed and queued since meshing was last idle
+        self._meshDone = 0
+        self._meshTotal = 0
+
+        if meshCache is None:
+            meshCache = MeshCache()
+        self.meshCache = meshCache
+
+        if numWorkers is None:
+            numWorkers = QThread.idealThreadCount()
+        numWorkers = max(1, numWorkers)
+
+        self.jobQueue = Queue.Queue()
+        self.workers = list()
+        self.workerThreads = list()
+        for i in range(numWorkers):
+            worker = MeshWorker(self.jobQueue, self.meshCache)
+            workerThread = QThread()
+            worker.moveToThread(workerThread)
+
+            worker.terminated.connect(workerThread.quit)
+            workerThread.started.connect(worker.run)
+
+            worker.jobFinished.connect(self.processMeshJob)
+            worker.jobFailed.connect(self.meshJobFailed)
+
+            self.workers.append(worker)
+            self.workerThreads.append(workerThread)
+
+        for workerThread in self.workerThreads:
+            workerThread.start()
+
+    def stop(self):
+        '''Stops all mesh workers. Pending jobs are dropped.'''
+        self.cancel()
+        for worker in self.workers:
+            self.jobQueue.put((MeshWorker.STOP, None))
+        for workerThread in self.workerThreads:
+            workerThread.quit()
+            workerThread.wait()
+
+    def cancel(self):
+        '''Cancels all queued and running mesh jobs.
+
+        Tubes keep their current meshes, if any.
+        '''
+        self._generation += 1
+        while True:
+            try:
+                self.jobQueue.get_nowait()
+            except Queue.Empty:
+                break
+        self._pending.clear()
+        self._meshDone = self._meshTotal = 0
+        self.meshProgress.emit(0, 0)
+
+    def isMeshing(self):
+        '''Whether mesh jobs are queued or running.'''
+        return bool(self._pending)
+
+    def setMaxError(self, maxError):
+        '''Sets the simplification error and regenerates all polydata.'''
+        self.maxError = maxError
+        self._rebuildAll()
+
+    def setSideLength(self, sideLength):
+        '''Sets the mesh side length and regenerates all polydata.'''
+        self.sideLength = sideLength
+        self._rebuildAll()
+
+    def _rebuildAll(self):
+        '''Regenerates the polydata of all tubes.
+
+        Tubes keep their current meshes until the new ones are done.
+        '''
+        self._queueMeshes(set(self.blockIndexes) | set(self._pending))
+
+    def applyChanges(self, changeSet):
+        '''Updates the polygonal data from a TubeChangeSet.
+
+        Removed tubes are dropped right away, while meshes of added and
+        modified tubes are queued.
+        '''
+        self._tubeStore = changeSet.tubeStore
+        if changeSet.reset:
+            self.cancel()
+            self.tubePolys.clear()
+            self.tubeCenterlines.clear()
+            self.blockIndexes.clear()
+            self.blockTubeIds.clear()
+            self._tubeBlocks = vtk.vtkMultiBlockDataSet()
+            del self._freeBlocks[:]
+            self._chunkTubes.clear()
+            self._tubeChunks.clear()
+            self._dirtyChunks.clear()
+            del self._freeChunks[:]
+            self._mergedBlocks.SetNumberOfBlocks(0)
+            self._centerlineBlocks.SetNumberOfBlocks(0)
+        else:
+            for tubeId in changeSet.removed:
+                self._pending.pop(tubeId, None)
+                self._removeTubeBlock(tubeId)
+            self._rebuildDirtyChunks()
+
+        self._queueMeshes(changeSet.added + changeSet.modified)
+        self._tubeBlocks.Modified()
+        self._mergedBlocks.Modified()
+        self._centerlineBlocks.Modified()
+
+    def _queueMeshes(self, tubeIds):
+        '''Queues mesh jobs for tubes in the tube store.'''
+        store = self._tubeStore
+        if store is None:
+            return
+        tubes = list()
+        for tubeId in tubeIds:
+            if tubeId not in store:
+                continue
+            token = next(self._tokens)
+            self._pending[tubeId] = token
+            # copies, since the store may change while the job runs
+            tubes.append((tubeId, token,
+                np.array(store.positions(tubeId), dtype=np.float64),
+                np.array(store.radii(tubeId), dtype=np.float64)))
+
+        for i in range(0, len(tubes), self.BATCH_SIZE):
+            job = MeshJob(tubes[i:i+self.BATCH_SIZE], self.maxError,
+                    self.sideLength, self._generation)
+            self.jobQueue.put((MeshWorker.MESH, job))
+        if tubes:
+            self._meshTotal += len(tubes)
+            self.meshProgress.emit(self._meshDone, self._meshTotal)
+
+    def processMeshJob(self, job):
+        '''Adds the up to date meshes of a finished mesh job.
+
+        Tubes that failed to mesh keep their current meshes, if any.
+        '''
+        if job.generation != self._generation:
+            return
+        added = list()
+        for tubeId, token, centerline, mesh in job.meshes:
+            if self._pending.get(tubeId) != token:
+                continue
+            del self._pending[tubeId]
+            self._removeTubeBlock(tubeId)
+            self._addTubeBlock(tubeId, centerline, mesh)
+            added.append(tubeId)
+        errors = list()
+        for tubeId, token, exception in job.errors:
+            if self._pending.get(tubeId) == token:
+                del self._pending[tubeId]
+                errors.append(exception)
+        self._addChunk(added)
+        self._rebuildDirtyChunks()
+        self._tubeBlocks.Modified()
+        self._mergedBlocks.Modified()
+        self._centerlineBlocks.Modified()
+        self._finishMeshJob(job)
+        self.meshesAdded.emit(added)
+        for exception in errors:
+            self.meshingErrored.emit(exception)
+
+    def meshJobFailed(self, exception, job):
+        '''Drops the tubes of a failed mesh job.'''
+        if job.generation != self._generation:
+            return
+        for tubeId, token, _, _ in job.tubes:
+            if self._pending.get(tubeId) == token:
+                del self._pending[tubeId]
+        self._finishMeshJob(job)
+        self.meshingErrored.emit(exception)
+
+    def _finishMeshJob(self, job):
+        '''Updates mesh progress, resetting it when meshing is idle.'''
+        self._meshDone += len(job.tubes)
+        if not self._pending:
+            self._meshDone = self._meshTotal = 0
+        self.meshProgress.emit(self._meshDone, self._meshTotal)
+
+    def _addTubeBlock(self, tubeId, centerline, poly):
+        '''Puts tube polydata into a free block slot.
+
+        The tube is not merged until it is added to a chunk.
+        '''
+        self._labelTubeCells(centerline, tubeId)
+        self._labelTubeCells(poly, tubeId)
+
+        blocks = self._tubeBlocks
+        if self._freeBlocks:
+            curIndex = self._freeBlocks.pop()
+        else:
+            curIndex = blocks.GetNumberOfBlocks()
+        blocks.SetBlock(curIndex, poly)
+        blocks.GetMetaData(curIndex).Set(TUBE_ID_KEY, tubeId)
+        self.tubePolys[tubeId] = poly
+        self.tubeCenterlines[tubeId] = centerline
+        # flat index 0 is the root, and tube blocks are its leaves
+        self.blockIndexes[tubeId] = curIndex + 1
+        self.blockTubeIds[curIndex + 1] = tubeId
+
+    def _removeTubeBlock(self, tubeId):
+        '''Empties the block slot of a tube, if present.'''
+        if tubeId not in self.blockIndexes:
+            return
+        flatIndex = self.blockIndexes.pop(tubeId)
+        del self.blockTubeIds[flatIndex]
+        del self.tubePolys[tubeId]
+        del self.tubeCenterlines[tubeId]
+        curIndex = flatIndex - 1
+        self._tubeBlocks.SetBlock(curIndex, None)
+        self._tubeBlocks.GetMetaData(curIndex).Remove(TUBE_ID_KEY)
+        self._freeBlocks.append(curIndex)
+
+        chunk = self._tubeChunks.pop(tubeId, None)
+        if chunk is not None:
+            self._chunkTubes[chunk].remove(tubeId)
+            self._dirtyChunks.add(chunk)
+
+    def _addChunk(self, tubeIds):
+        '''Merges the meshes and centerlines of tubes into a new chunk.'''
+        if not tubeIds:
+            return
+        if self._freeChunks:
+            chunk = self._freeChunks.pop()
+        else:
+            chunk = self._mergedBlocks.GetNumberOfBlocks()
+        self._chunkTubes[chunk] = list(tubeIds)
+        for tubeId in tubeIds:
+            self._tubeChunks[tubeId] = chunk
+        self._buildChunk(chunk)
+
+    def _rebuildDirtyChunks(self):
+        '''Rebuilds the chunks that lost tubes, freeing empty ones.'''
+        for chunk in self._dirtyChunks:
+            if self._chunkTubes[chunk]:
+                self._buildChunk(chunk)
+                continue
+            del self._chunkTubes[chunk]
+            self._mergedBlocks.SetBlock(chunk, None)
+            self._centerlineBlocks.SetBlock(chunk, None)
+            self._freeChunks.append(chunk)
+        self._dirtyChunks.clear()
+
+    def _buildChunk(self, chunk):
+        '''Appends the polydata of the tubes of a chunk into its blocks.'''
+        tubeIds = self._chunkTubes[chunk]
+        for blocks, polys in ((self._mergedBlocks, self.tubePolys),
+                (self._centerlineBlocks, self.tubeCenterlines)):
+            appender = vtk.vtkAppendPolyData()
+            for tubeId in tubeIds:
+                appender.AddInputData(polys[tubeId])
+            appender.Update()
+            # detach the merged polydata from the appender
+            poly = vtk.vtkPolyData()
+            poly.ShallowCopy(appender.GetOutput())
+            blocks.SetBlock(chunk, poly)
+
+    def _labelTubeCells(self, poly, tubeId):
+        '''Labels all cells of tube polydata with the tube ID.'''
+        tubeIds = np_s.numpy_to_vtk(np.full(poly.GetNumberOfCells(), tubeId,
+            dtype=np.int32), deep=True)
+        tubeIds.SetName(TUBE_ID_ARRAY)
+        poly.GetCellData().AddArray(tubeIds)
 
     def tubeBlocks(self):
-        '''Generates a tube vtkMultiBlockDataSet.'''
-        if self._tubeBlocksModified:
-            self._tubeBlocksModified = False
-            blocks = vtk.vtkMultiBlockDataSet()
-            for tubeId in self.tubePolys:
-                poly = self.tubePolys[tubeId]
-                curIndex = blocks.GetNumberOfBlocks()
-                blocks.SetBlock(curIndex, poly)
-                blocks.GetMetaData(curIndex).Set(TUBE_ID_KEY, tubeId)
-            self._tubeBlocks = blocks
+        '''Gets the tube vtkMultiBlockDataSet.'''
         return self._tubeBlocks
 
-    def _createTubePolyData(self, tube):
-        '''Generates polydata from an itk.VesselTubeSpatialObject.'''
-        points = GetTubePoints(tube)
+    def mergedTubesPort(self):
+        '''Gets the output port of the merged tube chunk blocks.'''
+        return self._mergedProducer.GetOutputPort()
 
-        # Convert points to world space.
-        tube.ComputeObjectToWorldTransform()
-        transform = tube.GetIndexToWorldTransform()
-        # Get scaling vector from transform matrix diagonal.
-        scaling = [transform.GetMatrix()(i,i) for i in range(3)]
-        # Use average of scaling vector for scale since TubeFilter
-        # doesn't seem to support ellipsoid.
-        scale = sum(scaling) / len(scaling)
-
-        for i in range(len(points)):
-            pt, radius = points[i]
-            pt = transform.TransformPoint(pt)
-            points[i] = (pt, radius*scale)
-
-        vpoints = vtk.vtkPoints()
-        vpoints.SetNumberOfPoints(len(points))
-        scalars = vtk.vtkFloatArray()
-        scalars.SetNumberOfValues(len(points))
-        scalars.SetName('Radii')
-
-        minRadius = float('inf')
-        maxRadius = float('-inf')
-        for i, (pt, r) in enumerate(points):
-            vpoints.SetPoint(i, pt)
-            scalars.SetValue(i, r)
-            minRadius = min(r, minRadius)
-            maxRadius = max(r, maxRadius)
-
-        pl = vtk.vtkPolyLine()
-        pl.Initialize(len(points), range(len(points)), vpoints)
-
-        ca = vtk.vtkCellArray()
-        ca.InsertNextCell(pl)
-
-        pd = vtk.vtkPolyData()
-        pd.SetLines(ca)
-        pd.SetPoints(vpoints)
-        pd.GetPointData().SetScalars(scalars)
-        pd.GetPointData().SetActiveScalars('Radii')
-
-        tf = vtk.vtkTubeFilter()
-        tf.SetInputData(pd)
-        tf.SetVaryRadiusToVaryRadiusByAbsoluteScalar()
-        tf.SetRadius(minRadius)
-        tf.SetRadiusFactor(maxRadius/minRadius)
-        tf.SetNumberOfSides(20)
-        tf.Update()
-
-        return tf.GetOutput()
+    def centerlinesPort(self):
+        '''Gets the output port of the merged tube centerline chunk blocks.'''
+        return self._centerlineProducer.GetOutputPort()
 
 class ViewManager(QObject):
     '''Manager of the UI.'''
@@ -312,6 +819,14 @@ class ViewManager(QObject):
 
         self.window = window
         self.tubePolyManager = TubePolyManager()
+        # render all tubes as one merged mesh instead of one block each
+        self.mergeTubes = False
+        # the current TubeSelection
+        self._tubeSelection = TubeSelection()
+        # tubeId -> flat index of the highlighted block of selected tubes
+        self._selectedBlocks = dict()
+        # reset the camera once the first meshes of a change are added
+        self._resetTubeCamera = False
 
         # main window
         forwardSignal(window, self, 'fileSelected')
@@ -324,14 +839,20 @@ class ViewManager(QObject):
 
         # segment tab
         forwardSignal(window.segmentTabView(), self, 'scaleChanged')
+        forwardSignal(window.segmentTabView(), self, 'seedFileSelected')
+        forwardSignal(window.segmentTabView(), self, 'findSeedsClicked')
+        forwardSignal(window.segmentTabView(), self, 'speculativeEnabled')
+        forwardSignal(window.segmentTabView(), self, 'roiSizeChanged')
 
         # selection
         forwardSignal(window.selectionTabView(), self, 'deleteTubeSelClicked')
         forwardSignal(window.selectionTabView(), self, 'clearTubeSelClicked')
         forwardSignal(window.selectionTabView(), self, 'selectAllTubesClicked')
+        forwardSignal(window.selectionTabView(), self, 'selectByRadiusClicked')
 
         # tube tree
         forwardSignal(window.tubeTreeTabView(), self, 'saveTubesClicked')
+        forwardSignal(window.tubeTreeTabView(), self, 'buildTreeClicked')
 
         # filters
         forwardSignal(window.filtersTabView(), self, 'windowLevelFilterEnabled')
@@ -342,6 +863,22 @@ class ViewManager(QObject):
         # 3D view
         self.window.threeDTabView().scalarOpacityUnitDistChanged.connect(
                 self.window.vtkView().setScalarOpacityUnitDist)
+        self.window.threeDTabView().setTubeSimplifyError(
+                self.tubePolyManager.maxError)
+        self.window.threeDTabView().tubeSimplifyErrorChanged.connect(
+                self.setTubeSimplifyError)
+        self.window.threeDTabView().mergedTubesEnabled.connect(
+                self.setMergeTubes)
+
+        # tube meshes
+        self.tubePolyManager.meshesAdded.connect(self.showNewTubeMeshes)
+        self.tubePolyManager.meshProgress.connect(self.window.showMeshProgress)
+        self.tubePolyManager.meshingErrored.connect(self.showMeshingError)
+        self.window.cancelMeshingClicked.connect(self.tubePolyManager.cancel)
+
+    def stop(self):
+        '''Stops background work of the UI.'''
+        self.tubePolyManager.stop()
 
     def disableUi(self):
         self.setUiState(False)
@@ -374,13 +911,65 @@ class ViewManager(QObject):
         if not preserveState:
             self.window.threeDTabView().setScalarOpacity(scalarOpacityMax/15)
 
-    def displayTubes(self, tubeGroup):
-        '''Display tubes in UI.'''
-        self.tubePolyManager.updatePolyData(tubeGroup)
+    def displayTubes(self, changeSet):
+        '''Display tube changes in UI.
+
+        Args:
+            changeSet: a TubeChangeSet.
+        '''
+        self.tubePolyManager.applyChanges(changeSet)
         # display tube tree
-        self.window.tubeTreeTabView().setModel(TubeTreeViewModel(tubeGroup))
-        # display tubes in 3D scene
-        self.window.vtkView().showTubeBlocks(self.tubePolyManager.tubeBlocks())
+        treeView = self.window.tubeTreeTabView()
+        model = treeView.model()
+        if changeSet.reset or changeSet.restructured or \
+                not isinstance(model, TubeTreeViewModel):
+            treeView.setModel(TubeTreeViewModel(changeSet.tubeGroup,
+                    changeSet.tubes, changeSet.morphometrics))
+        else:
+            model.applyChanges(changeSet)
+        # display tubes in 3D scene. Meshes of added tubes show up as they
+        # are generated.
+        self._resetTubeCamera = True
+        self.showTubes()
+
+    def showNewTubeMeshes(self, tubeIds):
+        '''Shows tube meshes added by a finished mesh job.'''
+        # newly meshed tubes may be selected
+        if not self.mergeTubes:
+            self._updateBlockSelection([tubeId for tubeId in tubeIds
+                if tubeId in self._tubeSelection], [])
+        if self._resetTubeCamera or not self.tubePolyManager.isMeshing():
+            self._resetTubeCamera = False
+            self.showTubes()
+        else:
+            self.window.vtkView().renderTubes()
+
+    def showMeshingError(self, exception):
+        '''Shows a tube mesh generation failure.'''
+        self.window.showStatusMessage(
+                'Tube mesh generation failed: %s' % exception)
+
+    def showTubes(self):
+        '''Shows the tube meshes in the 3D scene.'''
+        self.window.vtkView().setInteractionTubes(
+                self.tubePolyManager.centerlinesPort())
+        if self.mergeTubes:
+            self.window.vtkView().showMergedTubes(
+                    self.tubePolyManager.mergedTubesPort())
+        else:
+            self.window.vtkView().showTubeBlocks(
+                    self.tubePolyManager.tubeBlocks(),
+                    self.tubePolyManager.blockTubeIds)
+
+    def setMergeTubes(self, merge):
+        '''Switches between merged and per-tube block rendering.'''
+        self.mergeTubes = merge
+        if not merge:
+            # block highlights were not kept up to date while merged
+            self._selectedBlocks.clear()
+            self.window.vtkView().clearTubeBlockSelection()
+            self._updateBlockSelection(self._tubeSelection.tubeIds(), [])
+        self.showTubes()
 
     def alert(self, message):
         '''Alerts the user with some message.'''
@@ -394,6 +983,10 @@ class ViewManager(QObject):
         '''Updates view with scale.'''
         self.window.segmentTabView().setScale(scale)
 
+    def getSegmentScalePresets(self):
+        '''Getter for the segment scale presets.'''
+        return self.window.segmentTabView().scalePresets()
+
     def isSegmentEnabled(self):
         '''Getter for segment button toggle state.'''
         return self.window.segmentTabView().isSegmentEnabled()
@@ -402,44 +995,94 @@ class ViewManager(QObject):
         '''Shows segment job count.'''
         self.window.showJobCount(count)
 
-    def showTubeSelection(self, selection):
-        '''Shows a tube selection.
+    def showBatchProgress(self, done, total):
+        '''Shows batch segmentation progress.'''
+        self.window.showBatchProgress(done, total)
+
+    def showSeedsRejected(self, count):
+        '''Shows the number of seeds rejected by segmentation.'''
+        self.window.showStatusMessage(
+                '%d seed(s) inside existing tubes were skipped' % count)
+
+    def showTubeGraph(self, graph):
+        '''Shows a summary of a vessel tree build.'''
+        self.window.showStatusMessage(
+                '%d tube(s) joined into %d tree(s) with %d branch point(s)'
+                % (len(graph.tubeIds), len(graph.roots()),
+                    len(graph.bifurcations())))
+
+    def showTubeSelection(self, change):
+        '''Shows a tube selection change.
+
+        Only the tubes that entered or left the selection are updated.
 
         Args:
-            selection: an iterable of tube IDs.
-        '''
-        selectedTubeIndexes = list()
-        # Eh, this is efficient enough. If performance issues
-        # occur here, just make a datastructure mapping
-        # (tubeId -> tube block index) inside TubePolyManager.tubeBlocks().
-        it = self.tubePolyManager.tubeBlocks().NewTreeIterator()
-        it.SetVisitOnlyLeaves(False)
-        it.InitTraversal()
-        while not it.IsDoneWithTraversal():
-            tubeId = it.GetCurrentMetaData().Get(TUBE_ID_KEY)
-            if tubeId in selection:
-                selectedTubeIndexes.append(it.GetCurrentFlatIndex())
-            it.GoToNextItem()
-
-        self.window.vtkView().showTubeSelection(selectedTubeIndexes)
-        self.window.selectionTabView().setTubeSelection(selection)
-
-    def saveTubes(self, selection, filename):
+            change: a TubeSelectionChange.
+        '''
+        self._tubeSelection = change.selection
+        # also colors the merged mesh and the interaction centerlines
+        self.window.vtkView().updateTubeSelectionTable(
+                change.selected, change.deselected)
+        if not self.mergeTubes:
+            self._updateBlockSelection(change.selected, change.deselected)
+        self.window.vtkView().renderTubes()
+        self.window.selectionTabView().setTubeSelection(change.selection)
+
+    def _updateBlockSelection(self, selected, deselected):
+        '''Updates the highlighted tube blocks.
+
+        Args:
+            selected: tube IDs to highlight, if they have a block.
+            deselected: tube IDs to stop highlighting.
+        '''
+        blockIndexes = self.tubePolyManager.blockIndexes
+        deselectedIndexes = [self._selectedBlocks.pop(tubeId)
+                for tubeId in np.asarray(deselected, dtype=np.int64).tolist()
+                if tubeId in self._selectedBlocks]
+        selectedIndexes = list()
+        for tubeId in np.asarray(selected, dtype=np.int64).tolist():
+            flatIndex = blockIndexes.get(tubeId)
+            oldIndex = self._selectedBlocks.get(tubeId)
+            if flatIndex is None or flatIndex == oldIndex:
+                continue
+            if oldIndex is not None:
+                deselectedIndexes.append(oldIndex)
+            self._selectedBlocks[tubeId] = flatIndex
+            selectedIndexes.append(flatIndex)
+        self.window.vtkView().updateTubeBlockSelection(
+                selectedIndexes, deselectedIndexes)
+
+    def setTubeSimplifyError(self, maxError):
+        '''Sets the tube simplification error for display and saving.'''
+        self.tubePolyManager.setMaxError(maxError)
+        self.showTubes()
+
+    def saveTubes(self, selection, filename, maxError=0.0):
+        '''Saves copies of the selected tubes and groups.
+
+        Args:
+            selection: tube tree model indices.
+            filename: output file name.
+            maxError: maximum simplification error of the saved tubes, in
+                world units. Zero saves all points. This is independent of
+                the simplification of the rendered tubes.
+        '''
         # TODO move to tube manager
         dim = 3
         model = self.window.tubeTreeTabView().model()
         tubes = [model.data(index, RAW_DATA_ROLE) for index in selection]
+        copies = [SimplifiedCopy(tube, maxError) for tube in tubes]
 
-        if len(tubes) > 1:
+        if len(copies) > 1:
             # create a tube group to hold the selection.
             group = itk.GroupSpatialObject[dim].New()
-            for tube in tubes:
-                group.AddSpatialObject(tube)
+            for tubeCopy in copies:
+                group.AddSpatialObject(tubeCopy)
         else:
-            group = tubes[0]
+            group = copies[0]
 
         writer = itk.SpatialObjectWriter[dim].New()
-        writer.SetFileName(filename.toLatin1().data())
+        writer.SetFileName(str(filename))
         writer.SetInput(group)
         writer.Update()
 
@@ -447,37 +1090,191 @@ class ViewManager(QObject):
         '''Gets the currently viewed image type.'''
         return self.window.ui.getViewedImageType()
 
+class SegmentBatch(object):
+    '''Bookkeeping for a batch of segment jobs.'''
+
+    def __init__(self, seeds):
+        # (coords, scale) of the seeds not yet queued, in dispatch order
+        self.seeds = collections.deque(seeds)
+        self.total = len(self.seeds)
+        # number of seeds segmented or rejected
+        self.done = 0
+        # number of queued or running jobs
+        self.running = 0
+        # number of seeds rejected for lying inside tubes
+        self.rejected = 0
+        self.tubes = list()
+        # the tubes of this batch, keyed by their position in tubes
+        self.tubeStore = TubeStore()
+        self.spatialIndex = TubeSpatialIndex()
+
+    def addTube(self, tube):
+        '''Adds a segmented tube to the batch and its spatial index.'''
+        tubeId = len(self.tubes)
+        matrix, offset = GetTubeTransformArrays(tube)
+        self.tubeStore.addTubeArray(tubeId, GetTubePointArray(tube), matrix,
+                offset)
+        self.spatialIndex.addTubePoints(tubeId,
+                self.tubeStore.positions(tubeId),
+                self.tubeStore.radii(tubeId))
+        self.tubes.append(tube)
+
+    def isDone(self):
+        return self.done >= self.total
+
+class SegmentResultCache(object):
+    '''Bounded LRU cache of segmented tubes.'''
+
+    DEFAULT_SIZE = 64
+
+    def __init__(self, maxSize=DEFAULT_SIZE):
+        self.maxSize = maxSize
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def put(self, key, tube):
+        '''Adds a tube, evicting the least recently added tubes if full.'''
+        self._items.pop(key, None)
+        self._items[key] = tube
+        while len(self._items) > self.maxSize:
+            self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        '''Removes and returns a cached tube.'''
+        return self._items.pop(key, default)
+
+    def clear(self):
+        self._items.clear()
+
 class SegmentManager(QObject):
-    '''Manager of tube segmentation.'''
+    '''Manager of tube segmentation.
+
+    Segment jobs are placed on a queue shared by a pool of segment workers,
+    each running on its own thread.
+    '''
 
     DEFAULT_SCALE = 2.0
+    # number of recent job stats to keep
+    JOB_STATS_LENGTH = 1000
 
     tubeSegmented = pyqtSignal(itk.VesselTubeSpatialObject[3])
+    # signal: all tubes of a batch were segmented
+    tubesSegmented = pyqtSignal(list)
+    # signal: batch progress (done, total)
+    batchProgress = pyqtSignal(int, int)
+    # signal: number of seeds rejected for lying inside existing tubes
+    seedsRejected = pyqtSignal(int)
+    # signal: finding seeds across the image threw exception
+    seedFindingFailed = pyqtSignal(Exception)
     segmentationErrored = pyqtSignal(Exception)
     jobCountChanged = pyqtSignal(int)
+    # signal: stats of a finished segmentation job
+    jobStatsReady = pyqtSignal(SegmentJobStats)
 
-    def __init__(self, parent=None):
+    def __init__(self, numWorkers=None, parent=None):
+        '''Creates a SegmentManager.
+
+        Args:
+            numWorkers: number of segment workers. Defaults to the ideal
+                thread count of the machine.
+        '''
         super(SegmentManager, self).__init__(parent)
 
         self._scale = self.DEFAULT_SCALE
         self._jobCount = 0
+        # handle to the segmenting image
+        self._imageHandle = None
+        # spatial index used to reject seeds inside existing tubes
+        self._spatialIndex = None
+        # batchId -> SegmentBatch
+        self._batches = dict()
+        self._batchIds = itertools.count()
+
+        # half size in voxels of the initial segmentation region, or None
+        self._roiSize = None
+
+        # speculative extraction at neighbouring preset scales
+        self._speculative = False
+        self._presetScales = list()
+        self.resultCache = SegmentResultCache()
+        # cache key -> True if a seed click is waiting on the job
+        self._speculativeJobs = dict()
+
+        if numWorkers is None:
+            numWorkers = QThread.idealThreadCount()
+        numWorkers = max(1, numWorkers)
+
+        # SegmentJobStats of recently finished jobs
+        self.jobStats = collections.deque(maxlen=self.JOB_STATS_LENGTH)
+        # JSON lines file that job stats are written to
+        self._telemetryLog = None
+
+        self.jobQueue = SegmentJobQueue()
+        self.workers = list()
+        self.workerThreads = list()
+        for i in range(numWorkers):
+            worker = SegmentWorker(self.jobQueue)
+            workerThread = QThread()
+            worker.moveToThread(workerThread)
+
+            worker.terminated.connect(workerThread.quit)
+            workerThread.started.connect(worker.run)
+
+            worker.jobFinished.connect(self.processSegmentResult)
+            worker.jobFailed.connect(self.segmentationFailed)
+            worker.seedsFound.connect(self.processFoundSeeds)
+            worker.seedsFailed.connect(self.seedFindingErrored)
+
+            self.workers.append(worker)
+            self.workerThreads.append(workerThread)
+
+        for workerThread in self.workerThreads:
+            workerThread.start()
 
-        self.worker = SegmentWorker()
-        self.workerThread = QThread()
-        self.worker.moveToThread(self.workerThread)
-
-        self.worker.terminated.connect(self.workerThread.quit)
-        self.workerThread.started.connect(self.worker.run)
+    def stop(self):
+        '''Stops all segment workers.
 
-        self.worker.jobFinished.connect(self.processSegmentResult)
-        self.worker.jobFailed.connect(self.segmentationFailed)
+        Workers finish their current job, then stop on the first STOP message
+        they receive. Pending jobs are dropped.
+        '''
+        self.clearJobs()
+        for worker in self.workers:
+            self.jobQueue.put((SegmentWorker.STOP, None))
+        for workerThread in self.workerThreads:
+            workerThread.quit()
+            workerThread.wait()
+        self.setTelemetryLog(None)
 
-        self.workerThread.start()
+    def setTelemetryLog(self, filename):
+        '''Sets the file that job stats are appended to as JSON lines.
 
-    def stop(self):
-        self.worker.stop()
-        self.workerThread.quit()
-        self.workerThread.wait()
+        Args:
+            filename: log filename, or None to stop logging.
+        '''
+        if self._telemetryLog:
+            self._telemetryLog.close()
+            self._telemetryLog = None
+        if filename:
+            self._telemetryLog = open(filename, 'a')
+
+    def _recordStats(self, stats):
+        '''Publishes the stats of a finished job.'''
+        if stats is None:
+            return
+        self.jobStats.append(stats)
+        self.jobStatsReady.emit(stats)
+        if self._telemetryLog:
+            self._telemetryLog.write(json.dumps(stats.toDict()) + '\n')
+            self._telemetryLog.flush()
+
+    def numWorkers(self):
+        '''Getter for the number of segment workers.'''
+        return len(self.workers)
 
     def scale(self):
         '''Getter for scale.'''
@@ -492,39 +1289,330 @@ class SegmentManager(QObject):
             scale = self.DEFAULT_SCALE
         self._scale = scale
 
-    def setImage(self, image, pixelType, dimension):
-        '''Sets segmenting image.'''
-        self.worker.setImage(image, pixelType, dimension)
+    def setImageHandle(self, imageHandle):
+        '''Sets segmenting image.
 
-    def setWindowLevel(self, enabled, window, level):
-        '''Sets window and level for image.'''
-        self.worker.setWindowLevel(enabled, window, level)
+        The image is shared by all segment workers. Workers only swap images
+        when the handle version changes.
 
-    def setMedianParams(self, enabled, radius):
-        '''Sets window and level for image.'''
-        self.worker.setMedianParams(enabled, radius)
+        Args:
+            imageHandle: a utils.ImageHandle.
+        '''
+        self._imageHandle = imageHandle
+
+    def setRoiSize(self, roiSize):
+        '''Sets the region of interest size for extraction.
+
+        Args:
+            roiSize: half size in voxels of the initial region around each
+                seed. The region grows if the tube reaches its boundary. If
+                0 or None, the whole image is used.
+        '''
+        self._roiSize = roiSize or None
+
+    def setSpeculative(self, enabled):
+        '''Enables or disables speculative extraction.
+
+        When enabled, idle workers also extract each clicked seed at the
+        neighbouring preset scales. Those tubes are cached, so clicking the
+        same seed at one of those scales returns the tube right away.
+        '''
+        self._speculative = enabled
+        if not enabled:
+            self._clearSpeculativeJobs()
+            self.resultCache.clear()
+
+    def setPresetScales(self, scales):
+        '''Sets the preset scales used for speculative extraction.'''
+        self._presetScales = sorted(set(scales))
+
+    def _neighbourScales(self, scale):
+        '''Gets the preset scales just below and above a scale.'''
+        below = [s for s in self._presetScales if s < scale]
+        above = [s for s in self._presetScales if s > scale]
+        return below[-1:] + above[:1]
+
+    def _cacheKey(self, coords, scale):
+        '''Gets the (seed voxel, scale, image version) key of a seed.'''
+        if self._imageHandle is None:
+            return None
+        image = self._imageHandle.image
+        point = itk.Point[itk.D, self._imageHandle.dimension]()
+        for i, c in enumerate(coords):
+            point[i] = c
+        voxel = tuple(image.TransformPhysicalPointToIndex(point))
+        return (voxel, round(scale, 6), self._imageHandle.version)
+
+    def _clearSpeculativeJobs(self):
+        '''Drops all speculative jobs that have not yet started.'''
+        cleared = self.jobQueue.clear(
+                SegmentWorker.SEGMENT, speculativeOnly=True)
+        for _, args in cleared:
+            self._speculativeJobs.pop(args.cacheKey, None)
+
+    def setSpatialIndex(self, spatialIndex):
+        '''Sets the spatial index of existing tubes.
+
+        Seeds inside a tube of the index are rejected before being queued.
+
+        Args:
+            spatialIndex: a TubeSpatialIndex, or None to accept all seeds.
+        '''
+        self._spatialIndex = spatialIndex
+
+    def skippedImageSwaps(self):
+        '''Number of jobs for which workers kept their current image.'''
+        return sum(worker.skippedImageSwaps for worker in self.workers)
+
+    def extractConcurrency(self):
+        '''Average number of ExtractTube calls that ran at once.
+
+        The ExtractTube time of the recent jobs is divided by the time during
+        which at least one of them was running. The workers only segment in
+        parallel if the ITK bindings release the GIL in ExtractTube, in which
+        case this approaches the number of workers on a busy queue, and
+        stays near 1 otherwise.
+
+        Returns:
+            The concurrency, or None if no job has finished yet.
+        '''
+        spans = sorted(
+                (s.enqueueTime + s.queueWait, s.enqueueTime + s.latency)
+                for s in self.jobStats)
+        busyTime = 0.0
+        end = None
+        for start, finish in spans:
+            if end is None or start > end:
+                busyTime += finish - start
+                end = finish
+            elif finish > end:
+                busyTime += finish - end
+                end = finish
+        if busyTime <= 0.0:
+            return None
+        return sum(s.extractTime for s in self.jobStats) / busyTime
 
     def segmentTube(self, x, y, z):
-        '''Segments a tube at (x, y, z).'''
+        '''Segments a tube at (x, y, z).
+
+        Nothing is segmented if (x, y, z) is inside an existing tube.
+        '''
+        if self._spatialIndex and self._spatialIndex.containsPoint((x, y, z)):
+            self.seedsRejected.emit(1)
+            return
+
+        coords = (x, y, z)
+        scale = self.scale()
+        if not self._speculative:
+            self._queueJob(coords, scale)
+            return
+
+        # only speculate on the most recent seed
+        self._clearSpeculativeJobs()
+
+        key = self._cacheKey(coords, scale)
+        tube = self.resultCache.pop(key)
+        if tube:
+            self.tubeSegmented.emit(tube)
+        elif key in self._speculativeJobs:
+            # wait on the running speculative job instead of extracting again
+            self._speculativeJobs[key] = True
+            self._jobCount += 1
+            self.jobCountChanged.emit(self._jobCount)
+        else:
+            self._queueJob(coords, scale)
+
+        for neighbour in self._neighbourScales(scale):
+            neighbourKey = self._cacheKey(coords, neighbour)
+            if neighbourKey not in self.resultCache and \
+                    neighbourKey not in self._speculativeJobs:
+                self._speculativeJobs[neighbourKey] = False
+                self._queueJob(coords, neighbour,
+                        speculative=True, cacheKey=neighbourKey)
+
+    def segmentWholeImage(self):
+        '''Segments tubes at seeds found across the segmenting image.
+
+        Seeds are found on a segment worker, then segmented as a batch, see
+        segmentTubes().
+        '''
         self._jobCount += 1
         self.jobCountChanged.emit(self._jobCount)
+        self.jobQueue.put(
+                (SegmentWorker.FIND_SEEDS, (self._imageHandle, None)))
 
-        args = SegmentArgs()
-        args.scale = self.scale()
-        args.coords = (x, y, z)
-        self.worker.extractTube(args)
+    def processFoundSeeds(self, seeds):
+        '''Segments the seeds found by segmentWholeImage().'''
+        self._jobCount -= 1
+        self.jobCountChanged.emit(self._jobCount)
+        self.segmentTubes(seeds)
 
-    def processSegmentResult(self, result):
-        '''Handles segment results.'''
+    def seedFindingErrored(self, exc):
+        '''Finding seeds across the image failed.'''
         self._jobCount -= 1
         self.jobCountChanged.emit(self._jobCount)
-        if result.tube:
-            self.tubeSegmented.emit(result.tube)
+        self.seedFindingFailed.emit(exc)
 
-    def segmentationFailed(self, exc):
-        '''Segmentation failed.'''
+    def segmentTubes(self, seeds, scales=None):
+        '''Segments tubes at a batch of seeds.
+
+        Seeds are segmented in order by the segment workers, with at most
+        one job per worker queued at a time. Right before a seed is queued,
+        it is rejected if it lies inside an existing tube or a tube
+        segmented earlier in the batch. Progress is reported through
+        batchProgress, and all segmented tubes are emitted at once through
+        tubesSegmented.
+
+        Args:
+            seeds: an (N, 3) array of physical seed coordinates, an (N, 4)
+                array whose last column is the scale of each seed, or the
+                filename of a CSV file holding such an array. Seeds should
+                be ordered by decreasing strength, as returned by
+                seedfinder.FindSeeds().
+            scales: optional scalar or length N array of scales. Overrides
+                the scale column of seeds. Defaults to the current scale.
+
+        Returns:
+            The batch ID.
+        '''
+        if isinstance(seeds, basestring):
+            seeds = readSeedFile(seeds)
+        seeds = np.atleast_2d(np.asarray(seeds, dtype=float))
+        if seeds.shape[1] not in (3, 4):
+            raise Exception('Seeds must have 3 or 4 columns')
+
+        if scales is None:
+            if seeds.shape[1] == 4:
+                scales = seeds[:, 3]
+            else:
+                scales = self.scale()
+        scales = np.broadcast_to(np.asarray(scales, dtype=float), len(seeds))
+
+        batchSeeds = list()
+        for coords, scale in zip(seeds[:, :3].tolist(), scales.tolist()):
+            if scale <= 0.0:
+                scale = self.DEFAULT_SCALE
+            batchSeeds.append((tuple(coords), scale))
+
+        batchId = next(self._batchIds)
+        self._batches[batchId] = SegmentBatch(batchSeeds)
+        self._dispatchBatch(batchId)
+        return batchId
+
+    def _dispatchBatch(self, batchId):
+        '''Queues the next seeds of a batch, until each worker has a job.
+
+        Finishes the batch once all of its seeds are done.
+        '''
+        batch = self._batches[batchId]
+        while batch.seeds and batch.running < len(self.workers):
+            coords, scale = batch.seeds.popleft()
+            if self._isCovered(coords, batch):
+                batch.done += 1
+                batch.rejected += 1
+                continue
+            batch.running += 1
+            self._queueJob(coords, scale, batchId)
+
+        self.batchProgress.emit(batch.done, batch.total)
+        if batch.isDone():
+            self._finishBatch(batchId)
+
+    def _isCovered(self, coords, batch):
+        '''Checks if a seed lies inside an existing or batch tube.'''
+        if self._spatialIndex and self._spatialIndex.containsPoint(coords):
+            return True
+        return batch.spatialIndex.containsPoint(coords)
+
+    def _queueJob(self, coords, scale, batchId=None, speculative=False,
+            cacheKey=None):
+        '''Puts a segment job on the job queue.
+
+        Speculative jobs do not count towards the job count.
+        '''
+        if not speculative:
+            self._jobCount += 1
+            self.jobCountChanged.emit(self._jobCount)
+
+        args = SegmentArgs()
+        args.scale = scale
+        args.coords = coords
+        args.batchId = batchId
+        args.roiSize = self._roiSize
+        args.speculative = speculative
+        args.cacheKey = cacheKey
+        args.enqueueTime = time.time()
+        # make deepcopy to prevent modification via references
+        self.jobQueue.put(
+                (SegmentWorker.SEGMENT,
+                    (self._imageHandle, copy.deepcopy(args))))
+
+    def clearJobs(self):
+        '''Clears all segment jobs that have not yet started.
+
+        Batch seeds that were not yet queued are dropped as well.
+        '''
+        for batch in self._batches.values():
+            batch.done += len(batch.seeds)
+            batch.seeds.clear()
+        cleared = self.jobQueue.clear(SegmentWorker.SEGMENT)
+        for _, args in cleared:
+            if args.speculative:
+                self._speculativeDone(args)
+            else:
+                self._jobDone(args)
+
+    def _jobDone(self, args, tube=None):
+        '''Updates job count and batch state for a finished job.'''
         self._jobCount -= 1
         self.jobCountChanged.emit(self._jobCount)
+
+        if args.batchId in self._batches:
+            batch = self._batches[args.batchId]
+            batch.done += 1
+            batch.running -= 1
+            if tube:
+                batch.addTube(tube)
+            self._dispatchBatch(args.batchId)
+        elif tube:
+            self.tubeSegmented.emit(tube)
+
+    def _finishBatch(self, batchId):
+        '''Emits all tubes of a finished batch.'''
+        batch = self._batches.pop(batchId)
+        self.tubesSegmented.emit(batch.tubes)
+        if batch.rejected:
+            self.seedsRejected.emit(batch.rejected)
+
+    def _speculativeDone(self, args, tube=None):
+        '''Handles a finished speculative job.
+
+        Returns:
+            True if a seed click was waiting on the job.
+        '''
+        if self._speculativeJobs.pop(args.cacheKey, False):
+            self._jobDone(args, tube)
+            return True
+        if tube and self._speculative:
+            self.resultCache.put(args.cacheKey, tube)
+        return False
+
+    def processSegmentResult(self, result):
+        '''Handles segment results.'''
+        args = result.args
+        self._recordStats(args.stats)
+        if args.speculative:
+            self._speculativeDone(args, result.tube)
+        else:
+            self._jobDone(args, result.tube)
+
+    def segmentationFailed(self, exc, args):
+        '''Segmentation failed.'''
+        self._recordStats(args.stats)
+        if args.speculative and not self._speculativeDone(args):
+            return
+        if not args.speculative:
+            self._jobDone(args)
         self.segmentationErrored.emit(exc)
 
 class FilterManager(QObject):
@@ -549,6 +1637,7 @@ class FilterManager(QObject):
         self.pixelType = None
         self.dimension = None
         self.filteredImage = None
+        self.outputHandle = None
 
         # parameters
         self.window, self.level = 1, 0.5
@@ -563,6 +1652,7 @@ class FilterManager(QObject):
         self.filteredImage = itkImage
         self.pixelType = pixelType
         self.dimension = dimension
+        self.outputHandle = ImageHandle(itkImage, pixelType, dimension)
 
         # setup the filters
         imageType = itk.Image[pixelType, dimension]
@@ -578,6 +1668,17 @@ class FilterManager(QObject):
         '''Returns the filtered image, or original if no cached filter image.'''
         return self.filteredImage or self.itkImage
 
+    def getOutputHandle(self):
+        '''Returns a versioned handle to the output image.
+
+        The handle version changes only when the output image changes.
+        '''
+        output = self.getOutput()
+        if self.outputHandle is None or self.outputHandle.image is not output:
+            self.outputHandle = ImageHandle(
+                    output, self.pixelType, self.dimension)
+        return self.outputHandle
+
     def update(self):
         '''Updates filtered image.'''
         prevFilter = None
@@ -1,17 +1,100 @@
 from PyQt5.QtCore import *
 
+import math
+
 import itk
 import itkExtras
 
+from morphometrics import METRIC_LABELS
+
 # Custom Qt role that represents raw data
 RAW_DATA_ROLE = 0x1000
 
 class TubeTreeViewModel(QAbstractItemModel):
-    def __init__(self, tubeGroup, *args, **kwargs):
+    def __init__(self, tubeGroup, tubes=None, morphometrics=None,
+            *args, **kwargs):
+        '''Creates a TubeTreeViewModel.
+
+        Args:
+            tubeGroup: the root tube group.
+            tubes: an optional map of tubeId -> itk tube, used to label
+                tube items with their IDs.
+            morphometrics: an optional TubeMorphometrics, shown in extra
+                columns.
+        '''
         super(TubeTreeViewModel, self).__init__(*args, **kwargs)
 
-        self.rootItem = TubeItem(tubeGroup)
+        self.registry = TubeItemRegistry()
+        if tubes is not None:
+            for tubeId, tube in tubes.items():
+                self.registry.tubeIds[hash(tube)] = tubeId
+        self.rootItem = TubeItem(tubeGroup, registry=self.registry)
         self.header = 'Tube Groups'
+        self.morphometrics = morphometrics
+        # names of metric columns, after the tree column
+        self.metricColumns = list(METRIC_LABELS) if morphometrics else []
+
+    def indexOfItem(self, item, column=0):
+        '''Gets the model index of a TubeItem.'''
+        if item is None or item is self.rootItem:
+            return QModelIndex()
+        return self.createIndex(item.row(), column, item)
+
+    def indexOfTube(self, tubeId, column=0):
+        '''Gets the model index of a tube, or an invalid index.'''
+        return self.indexOfItem(self.registry.tubeItems.get(tubeId), column)
+
+    def applyChanges(self, changeSet):
+        '''Updates the tree from a managers.TubeChangeSet.
+
+        Only the rows of changed tubes are inserted or removed. Reset
+        change sets are not handled here; build a new model instead.
+        '''
+        registry = self.registry
+        # items whose group metrics changed
+        changedItems = list()
+        for tubeId in changeSet.removed:
+            item = registry.tubeItems.get(tubeId)
+            if item is not None:
+                parentItem = item.parent()
+                changedItems.append(parentItem)
+                row = item.row()
+                self.beginRemoveRows(self.indexOfItem(parentItem), row, row)
+                parentItem.removeChild(row)
+                self.endRemoveRows()
+
+        for tubeId in changeSet.added:
+            registry.tubeIds[hash(changeSet.tubes[tubeId])] = tubeId
+        for group in changeSet.addedGroups:
+            self._insertItem(group)
+        for tubeId in changeSet.added:
+            # tubes of added groups already have items
+            if tubeId not in registry.tubeItems:
+                self._insertItem(changeSet.tubes[tubeId])
+            changedItems.append(registry.tubeItems.get(tubeId))
+        changedItems.extend(registry.tubeItems.get(tubeId)
+                for tubeId in changeSet.modified)
+
+        # refresh changed items and the groups above them
+        lastColumn = len(self.metricColumns)
+        seen = set()
+        for item in changedItems:
+            while item is not None and item is not self.rootItem and \
+                    id(item) not in seen:
+                seen.add(id(item))
+                self.dataChanged.emit(self.indexOfItem(item),
+                        self.indexOfItem(item, lastColumn))
+                item = item.parent()
+
+    def _insertItem(self, spatialObject):
+        '''Appends an item for a spatial object below its parent group.'''
+        parentItem = self.registry.itemOf(spatialObject.GetParent())
+        if parentItem is None:
+            parentItem = self.rootItem
+        row = parentItem.childCount()
+        self.beginInsertRows(self.indexOfItem(parentItem), row, row)
+        parentItem.addChild(spatialObject)
+        self.endInsertRows()
 
     def index(self, row, column, parent):
         if not self.hasIndex(row, column, parent):
@@ -48,33 +131,99 @@ class TubeTreeViewModel(QAbstractItemModel):
         return parentItem.childCount()
 
     def columnCount(self, parent):
-        # always 1 column since we don't display other data.
-        return 1
+        # the tree column, then one column per metric
+        return 1 + len(self.metricColumns)
 
     def data(self, index, role):
         if not index.isValid():
             return None
 
+        if index.column() > 0:
+            if role == Qt.DisplayRole:
+                return self._metricText(index.internalPointer(),
+                        self.metricColumns[index.column() - 1])
+            elif role == Qt.TextAlignmentRole:
+                return Qt.AlignRight | Qt.AlignVCenter
+            return None
+
         if role == Qt.DisplayRole:
             return repr(index.internalPointer())
         elif role == RAW_DATA_ROLE:
             return index.internalPointer().getRawData()
 
+    def _metricText(self, item, name):
+        '''Formats a metric of a tube or the aggregate of a group.'''
+        if item.tubeId is not None:
+            metrics = self.morphometrics.metrics(item.tubeId)
+        elif isinstance(item.tubeGroup, itk.GroupSpatialObject[3]):
+            metrics = self.morphometrics.groupMetrics(hash(item.tubeGroup))
+        else:
+            metrics = None
+        if metrics is None:
+            return None
+        value = float(metrics[name])
+        if math.isnan(value):
+            return '-'
+        return '%.2f' % value
+
     def headerData(self, section, orientation, role):
         if orientation == Qt.Horizontal and role == Qt.DisplayRole:
-            return self.header
+            if section == 0:
+                return self.header
+            return METRIC_LABELS[self.metricColumns[section - 1]]
         return None
 
+class TubeItemRegistry(object):
+    '''Lookup tables shared by all TubeItems of a tree.'''
+
+    def __init__(self):
+        # hash(tube) -> tubeId
+        self.tubeIds = dict()
+        # tubeId -> TubeItem
+        self.tubeItems = dict()
+        # hash(group) -> TubeItem
+        self.groupItems = dict()
+
+    def itemOf(self, spatialObject):
+        '''Gets the item of a tube or tube group, or None.'''
+        key = hash(spatialObject)
+        if key in self.tubeIds:
+            return self.tubeItems.get(self.tubeIds[key])
+        return self.groupItems.get(key)
+
+    def register(self, item):
+        if item.tubeId is not None:
+            self.tubeItems[item.tubeId] = item
+        elif item.tubeGroup is not None:
+            self.groupItems[hash(item.tubeGroup)] = item
+
+    def unregister(self, item):
+        if item.tubeId is not None:
+            self.tubeItems.pop(item.tubeId, None)
+            self.tubeIds.pop(hash(item.tubeGroup), None)
+        elif item.tubeGroup is not None:
+            self.groupItems.pop(hash(item.tubeGroup), None)
+        for child in item.children:
+            self.unregister(child)
+
 class TubeItem(object):
-    def __init__(self, tubeGroup, parent=None):
+    def __init__(self, tubeGroup, parent=None, registry=None):
         self.tubeGroup = tubeGroup
         self.children = list()
         self.childMap = dict()
         self.parentItem = parent
+        self.rowNumber = 0
+
+        self.registry = registry if registry is not None \
+                else TubeItemRegistry()
+        self.tubeId = self.registry.tubeIds.get(hash(tubeGroup))
+        self.registry.register(self)
 
-        # assume we are handling only 3D spatial objects
+        # assume we are handling only 3D spatial objects. Tubes may have
+        # branch tubes as children.
         if tubeGroup is not None and \
-                isinstance(tubeGroup, itk.GroupSpatialObject[3]):
+                isinstance(tubeGroup, (itk.GroupSpatialObject[3],
+                    itk.VesselTubeSpatialObject[3])):
             children = self.tubeGroup.GetChildren()
             for i in range(tubeGroup.GetNumberOfChildren()):
                 self.addChild(itkExtras.down_cast(children[i]))
@@ -95,12 +244,13 @@ class TubeItem(object):
         return self.parentItem
 
     def row(self):
-        if self.parentItem:
-            return self.parentItem.children.index(self)
-        return 0
+        return self.rowNumber
 
     def __repr__(self):
         if isinstance(self.tubeGroup, itk.VesselTubeSpatialObject[3]):
+            if self.tubeId is not None:
+                return 'Tube %d (%d points)' % (self.tubeId,
+                        self.tubeGroup.GetNumberOfPoints())
             return 'Tube (%d points)' % self.tubeGroup.GetNumberOfPoints()
         elif isinstance(self.tubeGroup, itk.GroupSpatialObject[3]):
             name = 'Tube group'
@@ -114,5 +264,12 @@ class TubeItem(object):
         return self.tubeGroup
 
     def addChild(self, tubeGroup):
-        item = TubeItem(tubeGroup, self)
+        item = TubeItem(tubeGroup, self, self.registry)
+        item.rowNumber = len(self.children)
         self.children.append(item)
+
+    def removeChild(self, row):
+        item = self.children.pop(row)
+        self.registry.unregister(item)
+        for i in range(row, len(self.children)):
+            self.children[i].rowNumber = i
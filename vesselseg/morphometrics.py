@@ -0,0 +1,190 @@
+import collections
+
+import numpy as np
+
+# metric name -> display label
+METRIC_LABELS = collections.OrderedDict([
+    ('length', 'Length'),
+    ('meanRadius', 'Mean radius'),
+    ('minRadius', 'Min radius'),
+    ('maxRadius', 'Max radius'),
+    ('volume', 'Volume'),
+    ('surfaceArea', 'Surface area'),
+    ('tortuosity', 'Tortuosity'),
+])
+
+METRIC_DTYPE = np.dtype([(name, np.float64) for name in METRIC_LABELS] +
+        [('numPoints', np.int64)])
+
+def _SegmentSums(values, offsets, counts):
+    '''Sums per-segment values of tubes laid out back to back.
+
+    Segment i joins points i and i + 1, so each tube has count - 1 segments
+    and the segments that cross from one tube to the next are skipped.
+    '''
+    sums = np.concatenate(([0], np.cumsum(values)))
+    starts = offsets
+    ends = offsets + np.maximum(counts - 1, 0)
+    return sums[ends] - sums[starts]
+
+def ComputeTubeMetrics(positions, radii, offsets, counts):
+    '''Computes morphometrics of tubes laid out back to back.
+
+    Tubes are modelled as chains of conical frustums between consecutive
+    centerline points. Surface areas exclude the end caps.
+
+    Args:
+        positions: (N, 3) array of world space centerline points.
+        radii: (N,) array of world space radii.
+        offsets: index of the first point of each tube.
+        counts: number of points of each tube. Must be positive.
+
+    Returns:
+        An array of dtype METRIC_DTYPE with one entry per tube.
+    '''
+    positions = np.asarray(positions, dtype=np.float64)
+    radii = np.asarray(radii, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+
+    metrics = np.zeros(len(offsets), dtype=METRIC_DTYPE)
+    if len(offsets) == 0:
+        return metrics
+
+    # segment-wise values; the last entry of each tube is a dummy segment
+    r0, r1 = radii[:-1], radii[1:]
+    height = np.sqrt(((positions[1:] - positions[:-1])**2).sum(axis=1))
+    volume = np.pi*height/3*(r0*r0 + r0*r1 + r1*r1)
+    area = np.pi*(r0 + r1)*np.sqrt(height**2 + (r1 - r0)**2)
+
+    metrics['length'] = _SegmentSums(height, offsets, counts)
+    metrics['volume'] = _SegmentSums(volume, offsets, counts)
+    metrics['surfaceArea'] = _SegmentSums(area, offsets, counts)
+    metrics['meanRadius'] = np.add.reduceat(radii, offsets) / counts
+    metrics['minRadius'] = np.minimum.reduceat(radii, offsets)
+    metrics['maxRadius'] = np.maximum.reduceat(radii, offsets)
+    metrics['numPoints'] = counts
+
+    # tortuosity: centerline length over endpoint distance
+    chord = np.sqrt(((positions[offsets + counts - 1] -
+        positions[offsets])**2).sum(axis=1))
+    metrics['tortuosity'] = np.where(chord > 0,
+            metrics['length'] / np.where(chord > 0, chord, 1), np.nan)
+    return metrics
+
+def AggregateMetrics(metrics):
+    '''Aggregates tube metrics into metrics of a whole group.
+
+    Length, volume and surface area add up, the mean radius is weighted by
+    point count and the tortuosity by length.
+
+    Returns:
+        An entry of dtype METRIC_DTYPE.
+    '''
+    total = np.zeros((), dtype=METRIC_DTYPE)
+    if len(metrics) == 0:
+        total['tortuosity'] = np.nan
+        return total
+    for name in ('length', 'volume', 'surfaceArea', 'numPoints'):
+        total[name] = metrics[name].sum()
+    total['minRadius'] = metrics['minRadius'].min()
+    total['maxRadius'] = metrics['maxRadius'].max()
+    if total['numPoints'] > 0:
+        total['meanRadius'] = (metrics['meanRadius'] *
+                metrics['numPoints']).sum() / total['numPoints']
+    valid = ~np.isnan(metrics['tortuosity'])
+    weight = metrics['length'][valid].sum()
+    total['tortuosity'] = (metrics['tortuosity'][valid] *
+            metrics['length'][valid]).sum() / weight if weight > 0 else np.nan
+    return total
+
+class TubeMorphometrics(object):
+    '''Per-tube and per-group morphometrics, updated as tubes change.'''
+
+    def __init__(self):
+        # tubeId -> entry of dtype METRIC_DTYPE
+        self.tubeMetrics = dict()
+        # tubeId -> tuple of group keys the tube belongs to
+        self._tubeGroups = dict()
+        # group key -> set of tubeIds
+        self._members = collections.defaultdict(set)
+        # group key -> cached aggregate entry
+        self._groupMetrics = dict()
+
+    def clear(self):
+        self.tubeMetrics.clear()
+        self._tubeGroups.clear()
+        self._members.clear()
+        self._groupMetrics.clear()
+
+    def update(self, tubeStore, changed=(), removed=(), groups=None):
+        '''Updates the metrics of changed tubes.
+
+        Args:
+            tubeStore: the TubeStore holding the tube points.
+            changed: IDs of added or modified tubes.
+            removed: IDs of removed tubes.
+            groups: optional map of tubeId -> tuple of keys of the groups
+                containing the tube.
+        '''
+        for tubeId in removed:
+            self.tubeMetrics.pop(tubeId, None)
+            self._setGroups(tubeId, ())
+
+        changed = [tubeId for tubeId in changed
+                if tubeStore.records.get(tubeId) and
+                    tubeStore.records[tubeId].count > 0]
+        if changed:
+            counts = np.array([tubeStore.records[tubeId].count
+                for tubeId in changed], dtype=np.int64)
+            offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            positions = np.concatenate(
+                    [tubeStore.positions(tubeId) for tubeId in changed])
+            radii = np.concatenate(
+                    [tubeStore.radii(tubeId) for tubeId in changed])
+            metrics = ComputeTubeMetrics(positions, radii, offsets, counts)
+            for tubeId, entry in zip(changed, metrics):
+                self.tubeMetrics[tubeId] = entry
+                for key in self._tubeGroups.get(tubeId, ()):
+                    self._groupMetrics.pop(key, None)
+
+        if groups:
+            for tubeId, keys in groups.items():
+                if tubeId in self.tubeMetrics:
+                    self._setGroups(tubeId, keys)
+
+    def _setGroups(self, tubeId, keys):
+        '''Moves a tube into a new set of groups.'''
+        for key in self._tubeGroups.pop(tubeId, ()):
+            self._members[key].discard(tubeId)
+            self._groupMetrics.pop(key, None)
+        if keys:
+            self._tubeGroups[tubeId] = tuple(keys)
+            for key in keys:
+                self._members[key].add(tubeId)
+                self._groupMetrics.pop(key, None)
+
+    def metrics(self, tubeId):
+        '''Gets the metrics of a tube, or None.'''
+        return self.tubeMetrics.get(tubeId)
+
+    def metricValues(self, name):
+        '''Gets one metric of all tubes.
+
+        Returns:
+            A tuple of an array of tube IDs and an array of their values.
+        '''
+        tubeIds = np.fromiter(self.tubeMetrics, dtype=np.int64,
+                count=len(self.tubeMetrics))
+        values = np.array([self.tubeMetrics[tubeId][name]
+            for tubeId in tubeIds.tolist()], dtype=np.float64)
+        return tubeIds, values
+
+    def groupMetrics(self, groupKey):
+        '''Gets the aggregated metrics of all tubes in a group.'''
+        if groupKey not in self._groupMetrics:
+            members = self._members.get(groupKey, ())
+            metrics = np.array([self.tubeMetrics[tubeId]
+                for tubeId in members], dtype=METRIC_DTYPE)
+            self._groupMetrics[groupKey] = AggregateMetrics(metrics)
+        return self._groupMetrics[groupKey]
@@ -0,0 +1,110 @@
+import math
+
+import numpy as np
+import itk
+
+from utils import itkMatrixToArray
+
+DEFAULT_SCALES = (0.5, 1.0, 2.0)
+
+def ComputeVesselness(itkImage, pixelType, dimension, scales):
+    '''Computes multiscale vesselness of an image.
+
+    Args:
+        itkImage: input ITK image.
+        pixelType: image pixel type.
+        dimension: image dimension.
+        scales: iterable of physical tube radii to probe.
+
+    Returns:
+        A (vesselness, scale) tuple of numpy arrays in [z, y, x] order. The
+        vesselness is the maximum over all scales, and scale holds the scale
+        at which that maximum was reached.
+    '''
+    imageType = itk.Image[pixelType, dimension]
+    floatImageType = itk.Image[itk.F, dimension]
+
+    cast = itk.CastImageFilter[imageType, floatImageType].New()
+    cast.SetInput(itkImage)
+    hessian = itk.HessianRecursiveGaussianImageFilter[floatImageType].New()
+    hessian.SetInput(cast.GetOutput())
+    hessian.SetNormalizeAcrossScale(True)
+    measure = itk.Hessian3DToVesselnessMeasureImageFilter[itk.F].New()
+    measure.SetInput(hessian.GetOutput())
+
+    vesselness = None
+    bestScale = None
+    for scale in scales:
+        # a tube of radius r responds best at sigma = r / sqrt(2)
+        hessian.SetSigma(scale / math.sqrt(2))
+        measure.Update()
+        response = itk.PyBuffer[floatImageType] \
+                .GetArrayFromImage(measure.GetOutput()).copy()
+        if vesselness is None:
+            vesselness = response
+            bestScale = np.full(response.shape, scale, dtype=np.float32)
+        else:
+            better = response > vesselness
+            vesselness[better] = response[better]
+            bestScale[better] = scale
+    return vesselness, bestScale
+
+def LocalMaxima(arr):
+    '''Finds voxels that are maximal in their 3x3x3 neighborhood.
+
+    Returns:
+        A boolean array of the same shape as arr.
+    '''
+    maxed = arr
+    for axis in range(arr.ndim):
+        padded = np.pad(maxed, [(1, 1) if i == axis else (0, 0)
+                for i in range(arr.ndim)], mode='edge')
+        lo = np.take(padded, range(0, arr.shape[axis]), axis=axis)
+        hi = np.take(padded, range(2, arr.shape[axis] + 2), axis=axis)
+        maxed = np.maximum(maxed, np.maximum(lo, hi))
+    return arr >= maxed
+
+def IndicesToPhysical(itkImage, indices):
+    '''Converts an (N, 3) array of [x, y, z] indices to physical points.'''
+    spacing = np.array(itkImage.GetSpacing(), dtype=float)
+    origin = np.array(itkImage.GetOrigin(), dtype=float)
+    direction = itkMatrixToArray(itkImage.GetDirection())
+    return origin + (indices * spacing).dot(direction.T)
+
+def FindSeeds(itkImage, pixelType, dimension, scales=DEFAULT_SCALES,
+        threshold=0.05, maxSeeds=None):
+    '''Finds candidate tube seeds across a whole image.
+
+    Candidates are local maxima of the multiscale vesselness that are at
+    least `threshold` times the strongest response.
+
+    Args:
+        itkImage: input ITK image.
+        pixelType: image pixel type.
+        dimension: image dimension.
+        scales: iterable of physical tube radii to probe.
+        threshold: minimum vesselness, relative to the maximum vesselness.
+        maxSeeds: maximum number of seeds to return, if given.
+
+    Returns:
+        An (N, 4) array of seeds ordered by decreasing strength. Each row
+        holds the physical x, y, z coordinates and the scale of a seed.
+    '''
+    vesselness, bestScale = ComputeVesselness(
+            itkImage, pixelType, dimension, scales)
+
+    peak = vesselness.max()
+    if peak <= 0:
+        return np.zeros((0, 4))
+
+    candidates = LocalMaxima(vesselness) & (vesselness >= threshold*peak)
+    zyx = np.argwhere(candidates)
+    strength = vesselness[candidates]
+    order = np.argsort(-strength, kind='mergesort')
+    if maxSeeds is not None:
+        order = order[:maxSeeds]
+    zyx = zyx[order]
+
+    points = IndicesToPhysical(itkImage, zyx[:, ::-1].astype(float))
+    seedScales = bestScale[tuple(zyx.T)]
+    return np.column_stack((points, seedScales))
@@ -1,109 +1,256 @@
-import copy
+import time
 import Queue
-from math import ceil, floor
+import collections
+from math import floor
 from StringIO import StringIO
 
-import vtk
+import numpy as np
 import itk
 import itkTypes
 import itkExtras
 
 from PyQt5.QtCore import *
 
+from utils import itkMatrixToArray, copyItkTransform
+from seedfinder import FindSeeds
+
 class SegmentArgs(object):
     '''Wrapper for segmentation arguments.'''
     scale = 2.0
     coords = (0, 0, 0)
+    # ID of the batch this job belongs to, if any
+    batchId = None
+    # half size in voxels of the initial segmentation region, or None
+    roiSize = None
+    # speculative jobs run only when no other jobs are queued
+    speculative = False
+    # (seed voxel, scale, image version) key of the job
+    cacheKey = None
+    # job timestamps, as given by time.time()
+    enqueueTime = None
+    startTime = None
+    finishTime = None
+    # SegmentJobStats, set when the job is done
+    stats = None
 
 class SegmentResult(object):
     '''Wraps segment result.'''
-    def __init__(self, tube):
+    def __init__(self, tube, args=None):
         self.tube = tube
+        self.args = args
+
+class SegmentJobStats(object):
+    '''Timing and outcome of one segmentation job.
+
+    All times are in seconds.
+    '''
+
+    OK, NO_TUBE, FAILED = 'ok', 'no tube', 'failed'
+
+    def __init__(self, args):
+        self.coords = tuple(args.coords)
+        self.scale = args.scale
+        self.roiSize = args.roiSize
+        self.batchId = args.batchId
+        self.speculative = args.speculative
+        self.enqueueTime = args.enqueueTime
+        # time spent waiting on the job queue
+        self.queueWait = args.startTime - args.enqueueTime
+        # time spent swapping images and building segmenters
+        self.setupTime = 0.0
+        # time spent in ExtractTube
+        self.extractTime = 0.0
+        # time from queueing to the result
+        self.latency = 0.0
+        # whether the worker kept its current image for the job
+        self.imageSwapSkipped = False
+        self.numPoints = 0
+        self.status = None
+        # failure reason, if any
+        self.reason = None
+
+    def toDict(self):
+        '''Returns the stats as a JSON serializable dict.'''
+        return {
+            'coords': list(self.coords),
+            'scale': self.scale,
+            'roiSize': self.roiSize,
+            'batchId': self.batchId,
+            'speculative': self.speculative,
+            'enqueueTime': self.enqueueTime,
+            'queueWait': self.queueWait,
+            'setupTime': self.setupTime,
+            'extractTime': self.extractTime,
+            'latency': self.latency,
+            'imageSwapSkipped': self.imageSwapSkipped,
+            'numPoints': self.numPoints,
+            'status': self.status,
+            'reason': self.reason,
+        }
+
+class SegmentJobQueue(Queue.Queue):
+    '''Blocking job queue shared by segment workers.
+
+    Messages are (action, args) tuples, and are handled in the order they
+    were put on the queue. Speculative segment jobs are kept in a separate
+    lane that is only served when no other message is queued.
+    '''
+
+    def _init(self, maxsize):
+        Queue.Queue._init(self, maxsize)
+        self.speculative = collections.deque()
+
+    def _qsize(self, len=len):
+        return len(self.queue) + len(self.speculative)
+
+    def _put(self, item):
+        action, args = item
+        if args is not None and getattr(args[1], 'speculative', False):
+            self.speculative.append(item)
+        else:
+            self.queue.append(item)
+
+    def _get(self):
+        if self.queue:
+            return self.queue.popleft()
+        return self.speculative.popleft()
+
+    def clear(self, action, speculativeOnly=False):
+        '''Atomically removes all pending messages of the given action.
+
+        Args:
+            action: action of the messages to remove.
+            speculativeOnly: only remove speculative messages.
+
+        Returns:
+            A list of the args of the removed messages.
+        '''
+        with self.mutex:
+            lanes = [self.speculative]
+            if not speculativeOnly:
+                lanes.append(self.queue)
+
+            removed = list()
+            for lane in lanes:
+                removed.extend(args for a, args in lane if a == action)
+                kept = [(a, args) for a, args in lane if a != action]
+                lane.clear()
+                lane.extend(kept)
+            self.not_full.notify_all()
+        return removed
 
 class SegmentWorker(QObject):
-    '''Threaded worker to perform tube segmentation.'''
+    '''Threaded worker to perform tube segmentation.
+
+    Several workers may share one SegmentJobQueue. Each worker owns its own
+    SegmentTubes instance, and blocks on the queue until a message arrives.
+    Workers also find seeds across whole images, see seedfinder.FindSeeds().
+    '''
 
-    IMAGE, SEGMENT = range(2)
+    SEGMENT, STOP, FIND_SEEDS = range(3)
 
     # signal: segmentation job finished
     jobFinished = pyqtSignal(SegmentResult)
     # signal: segmentation job threw exception
-    jobFailed = pyqtSignal(Exception)
+    jobFailed = pyqtSignal(Exception, SegmentArgs)
+    # signal: seeds found, as an (N, 4) array ordered by decreasing strength
+    seedsFound = pyqtSignal(object)
+    # signal: seed finding threw exception
+    seedsFailed = pyqtSignal(Exception)
     # signal: segment worker terminated
     terminated = pyqtSignal()
 
-    def __init__(self, parent=None):
+    def __init__(self, jobQueue, parent=None):
         super(SegmentWorker, self).__init__(parent)
 
-        self.jobQueue = Queue.Queue()
-        self.stopFlag = False
+        self.jobQueue = jobQueue
         self.busyFlag = False
-        self.clearFlag = False
         self.segmenter = SegmentTubes()
+        self.imageVersion = None
+        # number of jobs that reused the current segmenter image
+        self.skippedImageSwaps = 0
 
     def run(self):
-        while not self.stopFlag:
-            if self.clearFlag:
-                self.jobQueue = Queue.Queue()
-                self.clearFlag = False
-            try:
-                action, args = self.jobQueue.get(True, 0.5)
-            except Queue.Empty:
-                pass
-            else:
-                if action == self.IMAGE:
-                    image, pixelType, dims = args
-                    self.segmenter.setImage(image, pixelType, dims)
-
-                if action == self.SEGMENT:
-                    self.busyFlag = True
-                    self._extractTube(args)
-
-                self.busyFlag = not self.jobQueue.empty()
+        while True:
+            action, args = self.jobQueue.get()
+            if action == self.STOP:
+                break
+
+            if action == self.SEGMENT:
+                self.busyFlag = True
+                imageHandle, segmentArgs = args
+                segmentArgs.startTime = time.time()
+                swapSkipped = self._setImage(imageHandle)
+                setupTime = time.time() - segmentArgs.startTime
+                self._extractTube(segmentArgs, setupTime, swapSkipped)
+                self.busyFlag = False
+
+            if action == self.FIND_SEEDS:
+                self.busyFlag = True
+                imageHandle, _ = args
+                try:
+                    seeds = FindSeeds(imageHandle.image,
+                            imageHandle.pixelType, imageHandle.dimension)
+                except Exception as e:
+                    self.seedsFailed.emit(e)
+                else:
+                    self.seedsFound.emit(seeds)
+                self.busyFlag = False
 
         # tell main thread that this worker has terminated
         self.terminated.emit()
 
-    def _extractTube(self, args):
+    def _setImage(self, imageHandle):
+        '''Updates the segmenter image if the job image version differs.
+
+        Returns:
+            True if the segmenter kept its current image.
+        '''
+        if imageHandle is None:
+            return False
+        if imageHandle.version == self.imageVersion:
+            self.skippedImageSwaps += 1
+            return True
+        self.segmenter.setImage(imageHandle.image,
+                imageHandle.pixelType, imageHandle.dimension)
+        self.imageVersion = imageHandle.version
+        return False
+
+    def _extractTube(self, args, setupTime=0.0, swapSkipped=False):
         if self.segmenter:
             self.segmenter.scale = args.scale
+            self.segmenter.roiSize = args.roiSize
+            stats = SegmentJobStats(args)
+            stats.imageSwapSkipped = swapSkipped
+            args.stats = stats
             try:
                 tube = self.segmenter.extractTube(args.coords)
             except Exception as e:
-                self.jobFailed.emit(e)
+                args.finishTime = time.time()
+                stats.status = SegmentJobStats.FAILED
+                stats.reason = str(e)
+                self._finishStats(args, setupTime)
+                self.jobFailed.emit(e, args)
             else:
-                self.jobFinished.emit(SegmentResult(tube))
-
-    def extractTube(self, args):
-        '''Queue up a segment job.
-
-        This is meant to be called by code in a different thread.
-        '''
-        # make deepcopy to prevent modification via references
-        self.jobQueue.put((self.SEGMENT, copy.deepcopy(args)))
-
-    def stop(self):
-        '''Tell this worker to stop when possible.'''
-        self.stopFlag = True
-
-    def clearJobs(self):
-        '''Tell this worker to clear all jobs when possible.'''
-        self.clearFlag = True
+                args.finishTime = time.time()
+                if tube:
+                    stats.status = SegmentJobStats.OK
+                    stats.numPoints = tube.GetNumberOfPoints()
+                else:
+                    stats.status = SegmentJobStats.NO_TUBE
+                self._finishStats(args, setupTime)
+                self.jobFinished.emit(SegmentResult(tube, args))
+
+    def _finishStats(self, args, setupTime):
+        '''Fills in segmenter timings of a finished job.'''
+        args.stats.setupTime = setupTime + self.segmenter.setupTime
+        args.stats.extractTime = self.segmenter.extractTime
+        args.stats.latency = args.finishTime - args.enqueueTime
 
     def isBusy(self):
         '''Flag if worker is busy.'''
         return self.busyFlag
 
-    def setImage(self, itkImage, pixelType, dimension):
-        '''Sets the image to process.
-
-        Args:
-            itkImage: input ITK image.
-            pixelType: image pixel type.
-            dimension: image dimension.
-        '''
-        self.jobQueue.put((self.IMAGE, (itkImage, pixelType, dimension)))
-
     def getTubeGroup(self):
         '''Gets the extracted tube group, if any.
 
@@ -116,6 +263,9 @@ class SegmentWorker(QObject):
 class SegmentTubes(object):
     '''Holds logic to segment tubes from an image.'''
 
+    # distance in voxels at which a tube reaches the ROI boundary
+    ROI_MARGIN = 1.0
+
     def __init__(self):
         '''Creates a SegmentTubes object.
 
@@ -128,39 +278,87 @@ class SegmentTubes(object):
         self.tubeGroup = None
         self.segTubes = None
         self.scale = 2.0
+        # half size in voxels of the region around the seed to segment in,
+        # or None to segment in the whole image
+        self.roiSize = None
+        # enables ITK debug output of the segmenter
+        self.debug = False
+        # setup and ExtractTube times of the last extraction, in seconds
+        self.setupTime = 0.0
+        self.extractTime = 0.0
 
     def setImage(self, itkImage, pixelType, dimension):
         '''Sets the input image.
 
+        The TubeTK segmenter is rebuilt on the next extraction only if the
+        image differs from the current one.
+
         Args:
             itkImage: a itkImage image object.
             pixelType: pixel type for image.
             dimension: image dimensions.
         '''
+        if itkImage is not self.itkImage:
+            self.segTubes = None
         self.itkImage = itkImage
         self.pixelType = pixelType
         self.dimension = dimension
         self.imageType = itk.Image[pixelType, dimension]
 
+    def _newSegmenter(self, image):
+        '''Creates a TubeTK segmenter for an image.
+
+        The tube group transform always maps indices of the full input image
+        into world space, even if image is a cropped region.
+        '''
+        segTubes = itk.TubeTKITK.SegmentTubes[self.imageType].New()
+        segTubes.SetInputImage(image)
+        segTubes.SetDebug(self.debug)
+
+        tubeGroup = segTubes.GetTubeGroup()
+        tubeGroup.ComputeObjectToParentTransform()
+        tubeGroup.GetObjectToParentTransform() \
+                .SetScale(self.itkImage.GetSpacing())
+        tubeGroup.GetObjectToParentTransform() \
+                .SetOffset(self.itkImage.GetOrigin())
+        tubeGroup.GetObjectToParentTransform() \
+                .SetMatrix(self.itkImage.GetDirection())
+        tubeGroup.ComputeObjectToWorldTransform()
+        return segTubes
+
+    def _getSegmenter(self):
+        '''Gets the TubeTK segmenter for the current image.
+
+        The segmenter is cached across extractions and only recreated after
+        the input image changes.
+        '''
+        if self.segTubes is None:
+            self.segTubes = self._newSegmenter(self.itkImage)
+            self.tubeGroup = self.segTubes.GetTubeGroup()
+        return self.segTubes
+
     def extractTube(self, coords):
         '''Tries to extract a tube at coordinates.
 
+        If roiSize is set, the tube is extracted from a region around the
+        seed. See _extractTubeInRoi().
+
+        Extracted tubes are not kept by the segmenter, see _detachTube().
+
         Args:
             coords: 3D coordinates in the image.
 
+        Returns:
+            A detached itk.VesselTubeSpatialObject in world space, or None.
+
         Raises:
             Exception: no image supplied as input.
         '''
+        self.setupTime = 0.0
+        self.extractTime = 0.0
         if self.itkImage is None:
             raise Exception('No input image provided!')
 
-        # create a new segment tubes every extraction so we get an updated
-        # image to segment on.
-        self.segTubes = itk.TubeTKITK.SegmentTubes[self.imageType].New()
-        self.segTubes.SetInputImage(self.itkImage)
-
-        self.tubeGroup = self.segTubes.GetTubeGroup()
-
         seedPoint = itk.Point[itkTypes.D, self.dimension]()
         for idx, c in enumerate(coords):
             seedPoint[idx] = c
@@ -171,30 +369,119 @@ class SegmentTubes(object):
         scaleNorm = self.itkImage.GetSpacing()[0]
         if self.scale/scaleNorm < 0.3:
             raise Exception('scale/scaleNorm < 0.3')
-        self.segTubes.SetRadius(self.scale/scaleNorm)
 
-        self.segTubes.SetDebug(True)
+        if self.roiSize:
+            return self._extractTubeInRoi(index, self.scale/scaleNorm)
+
+        start = time.time()
+        segTubes = self._getSegmenter()
+        segTubes.SetRadius(self.scale/scaleNorm)
+        self.setupTime += time.time() - start
+
+        start = time.time()
+        tube = segTubes.ExtractTube(index, 0, self.debug)
+        self.extractTime += time.time() - start
+        if tube:
+            tube = self._detachTube(segTubes, tube)
+        return tube
+
+    def _extractTubeInRoi(self, index, radius):
+        '''Extracts a tube from a region of interest around a seed index.
+
+        The region starts roiSize voxels around the seed in each direction,
+        and is doubled until the tube no longer reaches the region boundary
+        or the region covers the whole image. The extracted tube is offset by
+        the region start, so it lives in the index space of the full image.
+        '''
+        largest = self.itkImage.GetLargestPossibleRegion()
+        imageStart = [int(i) for i in largest.GetIndex()]
+        imageEnd = [s + int(n) for s, n in zip(imageStart, largest.GetSize())]
+        seed = [int(floor(index[i])) for i in range(self.dimension)]
+
+        halfSize = self.roiSize
+        while True:
+            setupStart = time.time()
+            start = [max(imageStart[i], seed[i] - halfSize)
+                    for i in range(self.dimension)]
+            end = [min(imageEnd[i], seed[i] + halfSize + 1)
+                    for i in range(self.dimension)]
+            size = [e - s for s, e in zip(start, end)]
+
+            region = itk.ImageRegion[self.dimension]()
+            region.SetIndex(start)
+            region.SetSize(size)
+            roi = itk.RegionOfInterestImageFilter[
+                    self.imageType, self.imageType].New()
+            roi.SetInput(self.itkImage)
+            roi.SetRegionOfInterest(region)
+            roi.Update()
+
+            segTubes = self._newSegmenter(roi.GetOutput())
+            segTubes.SetRadius(radius)
+
+            roiIndex = itk.ContinuousIndex[itkTypes.D, self.dimension]()
+            for i in range(self.dimension):
+                roiIndex[i] = index[i] - start[i]
+
+            self.setupTime += time.time() - setupStart
+
+            extractStart = time.time()
+            tube = segTubes.ExtractTube(roiIndex, 0, self.debug)
+            self.extractTime += time.time() - extractStart
+
+            wholeImage = start == imageStart and end == imageEnd
+            if not tube or wholeImage or not self._reachesRoiBoundary(
+                    tube, start, end, imageStart, imageEnd):
+                break
+            halfSize *= 2
 
-        tube = self.segTubes.ExtractTube(index, 0, True)
         if tube:
-            self.segTubes.AddTube(tube)
-
-            scaleVector = self.itkImage.GetSpacing()
-            offsetVector = self.itkImage.GetOrigin()
-
-            self.segTubes.GetTubeGroup().ComputeObjectToParentTransform()
-            self.segTubes.GetTubeGroup().ComputeObjectToWorldTransform()
-            tube.ComputeObjectToWorldTransform()
-
-            self.segTubes.GetTubeGroup().GetObjectToParentTransform() \
-                    .SetScale(scaleVector)
-            self.segTubes.GetTubeGroup().GetObjectToParentTransform() \
-                    .SetOffset(offsetVector)
-            self.segTubes.GetTubeGroup().GetObjectToParentTransform() \
-                    .SetMatrix(self.itkImage.GetDirection())
-            self.segTubes.GetTubeGroup().ComputeObjectToWorldTransform()
+            offset = itk.Vector[itkTypes.D, self.dimension]()
+            for i in range(self.dimension):
+                offset[i] = start[i]
+            tube = self._detachTube(segTubes, tube, offset)
         return tube
 
+    def _detachTube(self, segTubes, tube, offset=None):
+        '''Copies an extracted tube out of the segmenter into world space.
+
+        The tube is not added to the segmenter with AddTube(), which would
+        keep it in the segmenter's tube mask. The segmenter is cached across
+        extractions, so a kept tube would block later extractions near it,
+        even after the tube is deleted. The tube is parented to the tube
+        group only to compute its world transform, and the segmenter keeps
+        no reference to the returned copy, see DetachTube().
+
+        Args:
+            segTubes: the segmenter that extracted the tube.
+            tube: the extracted itk.VesselTubeSpatialObject.
+            offset: optional index offset of the tube, for tubes extracted
+                from a region of interest.
+        '''
+        group = segTubes.GetTubeGroup()
+        group.AddSpatialObject(tube)
+        if offset is not None:
+            tube.GetObjectToParentTransform().SetOffset(offset)
+        tube.ComputeObjectToWorldTransform()
+        newTube = DetachTube(tube)
+        group.RemoveSpatialObject(tube)
+        return newTube
+
+    def _reachesRoiBoundary(self, tube, start, end, imageStart, imageEnd):
+        '''Checks if a tube in ROI index space reaches a cropped ROI side.
+
+        ROI sides that coincide with the image boundary are ignored.
+        '''
+        positions = GetTubePointArray(tube)['position']
+        if len(positions) == 0:
+            return False
+        size = np.subtract(end, start)
+        croppedLow = np.greater(start, imageStart)
+        croppedHigh = np.less(end, imageEnd)
+        low = positions.min(axis=0) < self.ROI_MARGIN
+        high = positions.max(axis=0) > size - 1 - self.ROI_MARGIN
+        return bool(np.any(low & croppedLow) or np.any(high & croppedHigh))
+
     def getTubeGroup(self):
         '''Gets the extracted tube group, if any.
 
@@ -250,29 +537,272 @@ def DowncastToVesselTubeSOPoint(soPoint):
 
     return vesselTubePoint
 
-def GetTubePoints(tube):
-    '''Gets the points and radii associated with the tube.'''
-    points = list()
-    for j in range(tube.GetNumberOfPoints()):
-        point = tube.GetPoint(j)
-        point = DowncastToVesselTubeSOPoint(point)
-
-        radius = point.GetRadius()
-        pos = point.GetPosition()
-
-        # I think I need to extract the values otherwise corruption occurs
-        # on the itkPointD3 objects.
-        points.append(((pos[0], pos[1], pos[2]), radius))
-    return points
-
-def TubeIterator(tubeGroup):
-    '''Iterates over all tubes in a tube group.'''
-    obj = itkExtras.down_cast(tubeGroup)
-    if isinstance(obj, itk.VesselTubeSpatialObject[3]):
-        yield obj
-
-    # otherwise, `obj` is a GroupSpatialObject
-    children = obj.GetChildren()
-    for i in range(obj.GetNumberOfChildren()):
-        for tube in TubeIterator(children[i]):
-            yield tube
+# attributes of a tube point, as returned by GetTubePointArray()
+TUBE_POINT_DTYPE = np.dtype([
+    ('id', np.int64),
+    ('position', np.float64, 3),
+    ('radius', np.float64),
+    ('tangent', np.float64, 3),
+    ('normal1', np.float64, 3),
+    ('normal2', np.float64, 3),
+    ('medialness', np.float64),
+    ('ridgeness', np.float64),
+    ('alpha1', np.float64),
+    ('alpha2', np.float64),
+    ('alpha3', np.float64),
+    ('mark', np.bool_),
+])
+
+def _GetVesselTubePoints(tube):
+    '''Gets the typed points of a tube.
+
+    VesselTubeSpatialObject.GetPoints() returns the points with their vessel
+    tube type intact. If the bindings don't expose that, fall back to
+    downcasting each point.
+    '''
+    try:
+        points = tube.GetPoints()
+        if len(points):
+            points[0].GetRidgeness
+        return points
+    except (AttributeError, TypeError):
+        return [DowncastToVesselTubeSOPoint(tube.GetPoint(i))
+                for i in range(tube.GetNumberOfPoints())]
+
+def GetTubePointArray(tube):
+    '''Gets all point attributes of a tube as a numpy structured array.
+
+    Returns:
+        An array of dtype TUBE_POINT_DTYPE with one entry per tube point.
+        Positions are in the tube's object space.
+    '''
+    points = _GetVesselTubePoints(tube)
+    arr = np.zeros(len(points), dtype=TUBE_POINT_DTYPE)
+    if len(arr) == 0:
+        return arr
+
+    # Extract the values right away, otherwise corruption occurs on the
+    # itkPointD3 objects.
+    def vec(v):
+        return (v[0], v[1], v[2])
+
+    arr['id'] = [p.GetID() for p in points]
+    arr['position'] = [vec(p.GetPosition()) for p in points]
+    arr['radius'] = [p.GetRadius() for p in points]
+    arr['tangent'] = [vec(p.GetTangent()) for p in points]
+    arr['normal1'] = [vec(p.GetNormal1()) for p in points]
+    arr['normal2'] = [vec(p.GetNormal2()) for p in points]
+    arr['medialness'] = [p.GetMedialness() for p in points]
+    arr['ridgeness'] = [p.GetRidgeness() for p in points]
+    arr['alpha1'] = [p.GetAlpha1() for p in points]
+    arr['alpha2'] = [p.GetAlpha2() for p in points]
+    arr['alpha3'] = [p.GetAlpha3() for p in points]
+    arr['mark'] = [p.GetMark() for p in points]
+    return arr
+
+def GetTubeTransformArrays(tube):
+    '''Gets the index to world transform of a tube.
+
+    Returns:
+        A tuple of the 3x3 transform matrix and the offset vector.
+    '''
+    tube.ComputeObjectToWorldTransform()
+    transform = tube.GetIndexToWorldTransform()
+    matrix = itkMatrixToArray(transform.GetMatrix())
+    offset = transform.GetOffset()
+    return matrix, np.array([offset[i] for i in range(3)], dtype=float)
+
+def CopyTubeWithPoints(tube, points):
+    '''Creates a copy of a tube with different points.
+
+    The copy has the ID, name, properties and transforms of the tube, but no
+    parent or children.
+
+    Args:
+        tube: an itk.VesselTubeSpatialObject.
+        points: array of dtype TUBE_POINT_DTYPE, in the tube's index space.
+
+    Returns:
+        A new itk.VesselTubeSpatialObject.
+    '''
+    dim = 3
+    newTube = itk.VesselTubeSpatialObject[dim].New()
+    newTube.SetId(tube.GetId())
+    newTube.SetObjectName(tube.GetObjectName())
+    newTube.SetRoot(tube.GetRoot())
+    newTube.SetArtery(tube.GetArtery())
+    newTube.SetParentPoint(tube.GetParentPoint())
+    newTube.SetEndType(tube.GetEndType())
+    prop = tube.GetProperty()
+    newTube.GetProperty().SetName(prop.GetName())
+    newTube.GetProperty().SetColor(prop.GetColor())
+
+    copyItkTransform(tube.GetIndexToObjectTransform(),
+            newTube.GetIndexToObjectTransform())
+    copyItkTransform(tube.GetObjectToParentTransform(),
+            newTube.GetObjectToParentTransform())
+    newTube.ComputeObjectToWorldTransform()
+
+    try:
+        pointList = type(tube.GetPoints())()
+    except (AttributeError, TypeError):
+        pointList = itk.vector[itk.VesselTubeSpatialObjectPoint[dim]]()
+    for row in points:
+        point = itk.VesselTubeSpatialObjectPoint[dim]()
+        point.SetID(int(row['id']))
+        point.SetPosition(*row['position'].tolist())
+        point.SetRadius(float(row['radius']))
+        point.SetTangent(*row['tangent'].tolist())
+        point.SetNormal1(*row['normal1'].tolist())
+        point.SetNormal2(*row['normal2'].tolist())
+        point.SetMedialness(float(row['medialness']))
+        point.SetRidgeness(float(row['ridgeness']))
+        point.SetAlpha1(float(row['alpha1']))
+        point.SetAlpha2(float(row['alpha2']))
+        point.SetAlpha3(float(row['alpha3']))
+        point.SetMark(bool(row['mark']))
+        pointList.push_back(point)
+    newTube.SetPoints(pointList)
+    return newTube
+
+def DetachTube(tube):
+    '''Copies a tube out of its spatial object tree.
+
+    The copy has no parent. Its object to parent transform is the object to
+    world transform of the tube, so it keeps its world space placement.
+
+    Returns:
+        The copied itk.VesselTubeSpatialObject.
+    '''
+    tube.ComputeObjectToWorldTransform()
+    newTube = CopyTubeWithPoints(tube, GetTubePointArray(tube))
+    copyItkTransform(tube.GetObjectToWorldTransform(),
+            newTube.GetObjectToParentTransform())
+    newTube.ComputeObjectToWorldTransform()
+    return newTube
+
+def WalkTubeTree(root, downCast=itkExtras.down_cast):
+    '''Iterates over a spatial object tree in depth-first order.
+
+    Args:
+        root: the spatial object to start from.
+        downCast: function used to down cast each spatial object.
+
+    Yields:
+        (obj, path) tuples, where obj is the down cast spatial object and
+        path is the tuple of its down cast ancestors, starting at root.
+    '''
+    stack = [(root, ())]
+    while stack:
+        node, path = stack.pop()
+        obj = downCast(node)
+        yield obj, path
+
+        children = obj.GetChildren()
+        childPath = path + (obj,)
+        # push in reverse so children are visited in order
+        for i in reversed(range(obj.GetNumberOfChildren())):
+            stack.append((children[i], childPath))
+
+class TubeRegistry(object):
+    '''Flattened view of the tubes in a tube tree.
+
+    The tree is walked once, and the down cast spatial objects, their
+    ancestor paths and the list of tubes are kept until the structure of
+    the tree changes. Callers report structural changes through
+    addSubtree() and removeSubtree(), or invalidate() to rebuild lazily.
+    '''
+
+    def __init__(self, root=None):
+        self._root = root
+        # hash(spatial object) -> (down cast object, ancestor path)
+        self._nodes = dict()
+        # hash(tube) -> tube, in traversal order
+        self._tubes = collections.OrderedDict()
+        # cached list of tubes
+        self._tubeList = None
+        self._valid = False
+
+    def __len__(self):
+        self._ensureBuilt()
+        return len(self._tubes)
+
+    def __iter__(self):
+        return iter(self.tubes())
+
+    def __contains__(self, tube):
+        self._ensureBuilt()
+        return hash(tube) in self._tubes
+
+    def setRoot(self, root):
+        '''Sets the root of the tracked tree.'''
+        self._root = root
+        self.invalidate()
+
+    def invalidate(self):
+        '''Marks the registry for a rebuild on next access.'''
+        self._valid = False
+
+    def tubes(self):
+        '''Gets the list of all tubes.'''
+        self._ensureBuilt()
+        if self._tubeList is None:
+            self._tubeList = list(self._tubes.values())
+        return self._tubeList
+
+    def downCast(self, obj):
+        '''Down casts a spatial object, using the cache if possible.'''
+        node = self._nodes.get(hash(obj))
+        if node is not None:
+            return node[0]
+        return itkExtras.down_cast(obj)
+
+    def pathOf(self, obj):
+        '''Gets the down cast ancestors of a registered object.'''
+        self._ensureBuilt()
+        return self._nodes[hash(obj)][1]
+
+    def addSubtree(self, node):
+        '''Registers a subtree that was attached to the tracked tree.
+
+        Returns:
+            A list of the tubes in the subtree.
+        '''
+        self._ensureBuilt()
+        parent = self._nodes.get(hash(node.GetParent()))
+        path = parent[1] + (parent[0],) if parent is not None else ()
+        return self._register(node, path)
+
+    def removeSubtree(self, node):
+        '''Unregisters a subtree that was detached from the tracked tree.'''
+        if not self._valid:
+            return
+        for obj, _ in WalkTubeTree(node, self.downCast):
+            key = hash(obj)
+            self._nodes.pop(key, None)
+            if self._tubes.pop(key, None) is not None:
+                self._tubeList = None
+
+    def _ensureBuilt(self):
+        if self._valid:
+            return
+        self._nodes.clear()
+        self._tubes.clear()
+        self._tubeList = None
+        if self._root is not None:
+            self._register(self._root, ())
+        self._valid = True
+
+    def _register(self, node, path):
+        '''Walks a subtree, registering objects that are not known yet.'''
+        tubes = list()
+        for obj, objPath in WalkTubeTree(node, self.downCast):
+            key = hash(obj)
+            if key not in self._nodes:
+                self._nodes[key] = (obj, path + objPath)
+            if isinstance(obj, itk.VesselTubeSpatialObject[3]):
+                if key not in self._tubes:
+                    self._tubes[key] = obj
+                    self._tubeList = None
+                tubes.append(obj)
+        return tubes
@@ -0,0 +1,129 @@
+import numpy as np
+
+class TubeSelectionChange(object):
+    '''Tubes that entered and left a TubeSelection in one update.'''
+
+    def __init__(self, selection, selected=None, deselected=None):
+        # the TubeSelection after the update
+        self.selection = selection
+        # arrays of tube IDs
+        self.selected = selected if selected is not None \
+                else np.zeros(0, dtype=np.int64)
+        self.deselected = deselected if deselected is not None \
+                else np.zeros(0, dtype=np.int64)
+
+    def isEmpty(self):
+        return len(self.selected) == 0 and len(self.deselected) == 0
+
+class TubeSelection(object):
+    '''Set of tube IDs stored as a bitset.
+
+    Tube IDs are small non-negative integers, so the set is a boolean array
+    indexed by tube ID. Updates return a TubeSelectionChange holding only
+    the tubes whose state changed, so that consumers can apply diffs. Sets
+    combine with |, & and -.
+    '''
+
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, tubeIds=()):
+        self._bits = np.zeros(self.INITIAL_CAPACITY, dtype=bool)
+        self._count = 0
+        self.select(tubeIds)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, tubeId):
+        return 0 <= tubeId < len(self._bits) and bool(self._bits[tubeId])
+
+    def __iter__(self):
+        return iter(self.tubeIds().tolist())
+
+    def tubeIds(self):
+        '''Gets the selected tube IDs as a sorted array.'''
+        return np.flatnonzero(self._bits)
+
+    def _grow(self, size):
+        '''Makes room for tube IDs below size.'''
+        if size <= len(self._bits):
+            return
+        capacity = len(self._bits)
+        while capacity < size:
+            capacity *= 2
+        bits = np.zeros(capacity, dtype=bool)
+        bits[:len(self._bits)] = self._bits
+        self._bits = bits
+
+    def _mask(self, size):
+        '''Gets the bitset padded or cut to size.'''
+        mask = np.zeros(size, dtype=bool)
+        count = min(size, len(self._bits))
+        mask[:count] = self._bits[:count]
+        return mask
+
+    def toggle(self, tubeId):
+        '''Toggles the selection of a tube.'''
+        self._grow(tubeId + 1)
+        ids = np.array([tubeId], dtype=np.int64)
+        if self._bits[tubeId]:
+            self._bits[tubeId] = False
+            self._count -= 1
+            return TubeSelectionChange(self, deselected=ids)
+        self._bits[tubeId] = True
+        self._count += 1
+        return TubeSelectionChange(self, selected=ids)
+
+    def select(self, tubeIds):
+        '''Adds tubes to the selection.'''
+        tubeIds = np.unique(np.asarray(list(tubeIds), dtype=np.int64))
+        if len(tubeIds):
+            self._grow(int(tubeIds[-1]) + 1)
+        selected = tubeIds[~self._bits[tubeIds]]
+        self._bits[selected] = True
+        self._count += len(selected)
+        return TubeSelectionChange(self, selected=selected)
+
+    def deselect(self, tubeIds):
+        '''Removes tubes from the selection.'''
+        tubeIds = np.unique(np.asarray(list(tubeIds), dtype=np.int64))
+        tubeIds = tubeIds[(tubeIds >= 0) & (tubeIds < len(self._bits))]
+        deselected = tubeIds[self._bits[tubeIds]]
+        self._bits[deselected] = False
+        self._count -= len(deselected)
+        return TubeSelectionChange(self, deselected=deselected)
+
+    def clear(self):
+        '''Deselects all tubes.'''
+        return self.assign(TubeSelection())
+
+    def assign(self, other):
+        '''Makes this selection equal to another TubeSelection.'''
+        size = max(len(self._bits), len(other._bits))
+        self._grow(size)
+        bits = other._mask(len(self._bits))
+        changed = np.flatnonzero(bits ^ self._bits)
+        selected = changed[bits[changed]]
+        deselected = changed[~bits[changed]]
+        self._bits = bits
+        self._count = len(other)
+        return TubeSelectionChange(self, selected, deselected)
+
+    def _combine(self, other, op):
+        size = max(len(self._bits), len(other._bits))
+        result = TubeSelection()
+        result._grow(size)
+        result._bits = op(self._mask(len(result._bits)),
+                other._mask(len(result._bits)))
+        result._count = int(np.count_nonzero(result._bits))
+        return result
+
+    def __or__(self, other):
+        return self._combine(other, np.logical_or)
+
+    def __and__(self, other):
+        return self._combine(other, np.logical_and)
+
+    def __sub__(self, other):
+        return self._combine(other,
+                lambda a, b: np.logical_and(a, np.logical_not(b)))
@@ -0,0 +1,128 @@
+import numpy as np
+import itk
+import itkExtras
+
+from segmenttubes import GetTubePointArray, GetTubeTransformArrays, \
+        CopyTubeWithPoints
+from utils import copyItkTransform
+
+# default maximum simplification error, in world units
+DEFAULT_MAX_ERROR = 0.1
+
+def SimplifyCenterline(positions, radii, maxError=DEFAULT_MAX_ERROR):
+    '''Douglas-Peucker simplification of a tube centerline.
+
+    Points are treated as (x, y, z, r) vectors, so both the centerline and
+    the radius profile of the simplified tube stay within maxError of the
+    original. All open intervals are split at once in each pass.
+
+    Args:
+        positions: (N, 3) array of centerline points.
+        radii: (N,) array of radii.
+        maxError: maximum distance of a dropped point from the simplified
+            centerline, in (x, y, z, r) space.
+
+    Returns:
+        A boolean array of length N marking the points to keep. The first
+        and last points are always kept.
+    '''
+    points = np.column_stack((positions, radii)).astype(float)
+    count = len(points)
+    keep = np.zeros(count, dtype=bool)
+    if count == 0:
+        return keep
+    keep[[0, -1]] = True
+
+    starts = np.array([0])
+    ends = np.array([count - 1])
+    while len(starts):
+        # only intervals with interior points need splitting
+        lengths = ends - starts - 1
+        inner = lengths > 0
+        starts, ends, lengths = starts[inner], ends[inner], lengths[inner]
+        if not len(starts):
+            break
+
+        interval = np.repeat(np.arange(len(starts)), lengths)
+        firsts = np.cumsum(lengths) - lengths
+        index = starts[interval] + 1 + np.arange(len(interval)) \
+                - firsts[interval]
+
+        a = points[starts[interval]]
+        b = points[ends[interval]]
+        dist = _SegmentDistance(points[index], a, b)
+
+        # farthest interior point of each interval
+        maxDist = np.maximum.reduceat(dist, firsts)
+        isMax = dist == maxDist[interval]
+        farthest = np.full(len(starts), -1, dtype=np.int64)
+        # the last match wins, which is fine for ties
+        farthest[interval[isMax]] = index[isMax]
+
+        split = maxDist > maxError
+        keep[farthest[split]] = True
+        starts = np.concatenate((starts[split], farthest[split]))
+        ends = np.concatenate((farthest[split], ends[split]))
+    return keep
+
+def SimplifyTubeArray(points, maxError=DEFAULT_MAX_ERROR):
+    '''Simplifies a segmenttubes.TUBE_POINT_DTYPE point array.
+
+    Returns:
+        The kept points.
+    '''
+    keep = SimplifyCenterline(points['position'], points['radius'], maxError)
+    return points[keep]
+
+def _SegmentDistance(points, a, b):
+    '''Distances from points to segments, row by row.'''
+    axis = b - a
+    length2 = (axis**2).sum(axis=1)
+    t = ((points - a)*axis).sum(axis=1)
+    t = np.where(length2 > 0, t / np.where(length2 > 0, length2, 1), 0)
+    t = np.clip(t, 0, 1)
+    return np.sqrt(((points - a - t[:, None]*axis)**2).sum(axis=1))
+
+def SimplifiedCopy(spatialObject, maxError=DEFAULT_MAX_ERROR):
+    '''Copies a tube or tube group tree with simplified tubes.
+
+    The copy is detached, so its root takes over the world transform of
+    the original.
+
+    Args:
+        spatialObject: an itk.VesselTubeSpatialObject or
+            itk.GroupSpatialObject.
+        maxError: maximum simplification error, in world units. Zero
+            keeps all points.
+
+    Returns:
+        The copied spatial object.
+    '''
+    copy = _SimplifiedCopy(spatialObject, maxError)
+    spatialObject.ComputeObjectToWorldTransform()
+    copyItkTransform(spatialObject.GetObjectToWorldTransform(),
+            copy.GetObjectToParentTransform())
+    copy.ComputeObjectToWorldTransform()
+    return copy
+
+def _SimplifiedCopy(spatialObject, maxError):
+    dim = 3
+    obj = itkExtras.down_cast(spatialObject)
+    if isinstance(obj, itk.VesselTubeSpatialObject[dim]):
+        points = GetTubePointArray(obj)
+        # tube points are in index space
+        matrix, _ = GetTubeTransformArrays(obj)
+        scale = np.mean(np.abs(np.diag(matrix)))
+        if maxError > 0 and scale > 0:
+            points = SimplifyTubeArray(points, maxError / scale)
+        copy = CopyTubeWithPoints(obj, points)
+    else:
+        copy = itk.GroupSpatialObject[dim].New()
+        copy.SetObjectName(obj.GetObjectName())
+        copyItkTransform(obj.GetObjectToParentTransform(),
+                copy.GetObjectToParentTransform())
+
+    children = obj.GetChildren()
+    for i in range(obj.GetNumberOfChildren()):
+        copy.AddSpatialObject(_SimplifiedCopy(children[i], maxError))
+    return copy
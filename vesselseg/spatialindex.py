@@ -0,0 +1,434 @@
+import itertools
+from math import ceil
+
+import numpy as np
+
+# shell -> array of cell offsets at that Chebyshev distance
+_SHELL_OFFSETS = dict()
+
+class TubeSpatialIndex(object):
+    '''Voxel hash over tube centerline segments.
+
+    Each tube is stored as a chain of capsules, one per pair of consecutive
+    centerline points, whose radius varies linearly between the point radii.
+    Every capsule is registered in all grid cells its bounding box touches.
+    '''
+
+    DEFAULT_CELL_SIZE = 4.0
+
+    def __init__(self, cellSize=DEFAULT_CELL_SIZE):
+        '''Creates an empty TubeSpatialIndex.
+
+        Args:
+            cellSize: edge length of a grid cell, in world units.
+        '''
+        self.cellSize = float(cellSize)
+        # tubeId -> (p0, p1, r0, r1, cells)
+        self._tubes = dict()
+        # cell -> {tubeId: array of segment indices}
+        self._grid = dict()
+        # (lo, hi) keys bounding the occupied cells. Only ever grows.
+        self._bounds = None
+
+    def __len__(self):
+        return len(self._tubes)
+
+    def __contains__(self, tubeId):
+        return tubeId in self._tubes
+
+    def clear(self):
+        '''Removes all tubes.'''
+        self._tubes.clear()
+        self._grid.clear()
+        self._bounds = None
+
+    def addTubePoints(self, tubeId, positions, radii):
+        '''Adds a tube given its world space centerline.
+
+        Args:
+            tubeId: tube ID. Replaces any tube with the same ID.
+            positions: (N, 3) array of centerline points. The index keeps
+                a copy.
+            radii: (N,) array of radii.
+        '''
+        self.removeTube(tubeId)
+        if len(positions) == 0:
+            return
+
+        # copy, since the arrays may be views that their owner rewrites
+        positions = np.array(positions, dtype=np.float64)
+        radii = np.array(radii, dtype=np.float64)
+
+        if len(positions) == 1:
+            # a single point is a degenerate capsule
+            positions = np.repeat(positions, 2, axis=0)
+            radii = np.repeat(radii, 2)
+        p0, p1 = positions[:-1], positions[1:]
+        r0, r1 = radii[:-1], radii[1:]
+
+        rmax = np.maximum(r0, r1)[:, None]
+        lo = np.floor((np.minimum(p0, p1) - rmax) / self.cellSize) \
+                .astype(np.int64)
+        hi = np.floor((np.maximum(p0, p1) + rmax) / self.cellSize) \
+                .astype(np.int64)
+
+        # enumerate all (cell, segment) pairs covered by segment boxes
+        cellList = list()
+        segList = list()
+        span = (hi - lo).max(axis=0)
+        for offset in itertools.product(*[range(n+1) for n in span]):
+            cells = lo + offset
+            inside = np.all(cells <= hi, axis=1)
+            cellList.append(cells[inside])
+            segList.append(np.flatnonzero(inside))
+        cells = np.concatenate(cellList)
+        segs = np.concatenate(segList)
+
+        order = np.lexsort(cells.T[::-1])
+        cells, segs = cells[order], segs[order]
+        boundaries = np.flatnonzero(np.any(np.diff(cells, axis=0), axis=1))
+        starts = np.concatenate(([0], boundaries + 1))
+        ends = np.concatenate((boundaries + 1, [len(cells)]))
+
+        keys = list()
+        for start, end in zip(starts, ends):
+            key = tuple(cells[start].tolist())
+            self._grid.setdefault(key, dict())[tubeId] = segs[start:end]
+            keys.append(key)
+
+        self._tubes[tubeId] = (p0, p1, r0, r1, keys)
+        if self._bounds is None:
+            self._bounds = (cells.min(axis=0), cells.max(axis=0))
+        else:
+            self._bounds = (np.minimum(self._bounds[0], cells.min(axis=0)),
+                    np.maximum(self._bounds[1], cells.max(axis=0)))
+
+    def removeTube(self, tubeId):
+        '''Removes a tube from the index, if present.'''
+        if tubeId not in self._tubes:
+            return
+        for key in self._tubes.pop(tubeId)[4]:
+            bucket = self._grid[key]
+            del bucket[tubeId]
+            if not bucket:
+                del self._grid[key]
+
+    def _cellKey(self, point):
+        return tuple(int(c) for c in np.floor(
+            np.asarray(point, dtype=float) / self.cellSize))
+
+    def tubesContainingPoint(self, point):
+        '''Finds the tubes that contain a world space point.
+
+        Returns:
+            A list of tube IDs.
+        '''
+        bucket = self._grid.get(self._cellKey(point))
+        if not bucket:
+            return list()
+
+        point = np.asarray(point, dtype=float)
+        found = list()
+        for tubeId, segs in bucket.items():
+            p0, p1, r0, r1, _ = self._tubes[tubeId]
+            dist, radius = _capsuleDistance(
+                    point, p0[segs], p1[segs], r0[segs], r1[segs])
+            if np.any(dist <= radius):
+                found.append(tubeId)
+        return found
+
+    def containsPoint(self, point):
+        '''Checks if a world space point is inside any tube.'''
+        return len(self.tubesContainingPoint(point)) > 0
+
+    def containsPoints(self, points):
+        '''Checks which of an (N, 3) array of points are inside any tube.
+
+        Returns:
+            A boolean array of length N.
+        '''
+        return np.array([self.containsPoint(p) for p in points], dtype=bool)
+
+    def tubesInBox(self, lo, hi):
+        '''Finds the tubes that intersect an axis-aligned box.
+
+        Args:
+            lo: minimum world space corner of the box.
+            hi: maximum world space corner of the box.
+
+        Returns:
+            A list of tube IDs.
+        '''
+        lo = np.asarray(lo, dtype=float)
+        hi = np.asarray(hi, dtype=float)
+
+        def distance(points):
+            outside = np.maximum(np.maximum(lo - points, points - hi), 0)
+            return np.sqrt((outside**2).sum(axis=1))
+
+        candidates = self._candidates(self._cellKey(lo), self._cellKey(hi))
+        tubeIds, dists = self._surfaceDistances(candidates, distance)
+        return [tubeId for tubeId, dist in zip(tubeIds, dists) if dist <= 0]
+
+    def tubesInSphere(self, center, radius):
+        '''Finds the tubes that intersect a sphere.
+
+        Returns:
+            A list of tube IDs.
+        '''
+        center = np.asarray(center, dtype=float)
+        candidates = self._candidates(self._cellKey(center - radius),
+                self._cellKey(center + radius))
+
+        tubeIds, dists = self._surfaceDistances(candidates, point=center)
+        return [tubeId for tubeId, dist in zip(tubeIds, dists)
+                if dist <= radius]
+
+    def nearestTube(self, point, maxDistance=None):
+        '''Finds the tube whose surface is closest to a point.
+
+        Cells are searched in growing shells around the point, until no
+        unvisited cell can hold a closer tube.
+
+        Args:
+            point: world space point.
+            maxDistance: if given, tubes farther away are ignored.
+
+        Returns:
+            A (tubeId, distance) tuple, or None if no tube was found. The
+            distance is negative if the point is inside the tube.
+        '''
+        if not self._grid:
+            return None
+
+        point = np.asarray(point, dtype=float)
+        center = np.array(self._cellKey(point))
+        lo, hi = self._gridBounds()
+        # shells beyond this one hold no cells
+        maxShell = int(max(np.abs(lo - center).max(),
+                np.abs(hi - center).max()))
+        if maxDistance is not None:
+            maxShell = min(maxShell,
+                    int(ceil(maxDistance / self.cellSize)) + 1)
+
+        best = None
+        for shell in range(maxShell + 1):
+            candidates = self._gather(self._shellKeys(center, shell))
+            tubeIds, dists = self._surfaceDistances(candidates, point=point)
+            if tubeIds:
+                i = np.argmin(dists)
+                if best is None or dists[i] < best[1]:
+                    best = (tubeIds[i], float(dists[i]))
+            # any cell outside the searched cube is at least this far away
+            if best is not None and best[1] <= shell*self.cellSize:
+                break
+
+        if best is None or \
+                (maxDistance is not None and best[1] > maxDistance):
+            return None
+        return best
+
+    def nearestSurface(self, point, maxDistance, exclude=None):
+        '''Finds the closest tube surface within a distance.
+
+        The surface distance is measured from the closest centerline point,
+        as the distance to that point minus the tube radius there.
+
+        Args:
+            point: world space point.
+            maxDistance: search radius around the point.
+            exclude: optional tube ID to ignore.
+
+        Returns:
+            A (tubeId, segment, t, distance) tuple, or None. The closest
+            centerline point lies at parameter t in [0, 1] on the given
+            segment, which joins centerline points segment and segment + 1.
+            The distance is negative if the point is inside the tube.
+        '''
+        point = np.asarray(point, dtype=float)
+        # capsules are registered in all cells their surface touches
+        candidates = self._candidates(self._cellKey(point - maxDistance),
+                self._cellKey(point + maxDistance))
+        candidates.pop(exclude, None)
+
+        best = None
+        for tubeId, segs in candidates.items():
+            p0, p1, r0, r1, _ = self._tubes[tubeId]
+            t, dist = _closestAxisPoint(point, p0[segs], p1[segs])
+            dist = dist - (r0[segs] + t*(r1[segs] - r0[segs]))
+            i = np.argmin(dist)
+            if dist[i] <= maxDistance and (best is None or dist[i] < best[3]):
+                best = (tubeId, int(segs[i]), float(t[i]), float(dist[i]))
+        return best
+
+    def _gridBounds(self):
+        '''Gets bounds of the occupied cell keys.
+
+        The bounds may be larger than needed after tubes are removed.
+        '''
+        return self._bounds
+
+    def _candidates(self, loKey, hiKey):
+        '''Gathers the capsules registered in a box of cells.
+
+        Args:
+            loKey: minimum cell key.
+            hiKey: maximum cell key.
+
+        Returns:
+            A map of tubeId -> array of unique segment indices.
+        '''
+        loKey = np.asarray(loKey)
+        hiKey = np.asarray(hiKey)
+        if np.prod(hiKey - loKey + 1) > len(self._grid):
+            # sparse grid: scan the occupied cells instead
+            keys = [key for key in self._grid
+                    if np.all(loKey <= key) and np.all(hiKey >= key)]
+        else:
+            keys = itertools.product(*[range(a, b+1)
+                for a, b in zip(loKey.tolist(), hiKey.tolist())])
+        return self._gather(keys)
+
+    def _shellKeys(self, center, shell):
+        '''Gets the keys of the cells at a Chebyshev distance from a cell.'''
+        if shell == 0:
+            return [tuple(center.tolist())]
+        if (2*shell + 1)**3 > len(self._grid):
+            # sparse grid: scan the occupied cells instead
+            return [key for key in self._grid
+                    if np.abs(center - key).max() == shell]
+        offsets = _SHELL_OFFSETS.get(shell)
+        if offsets is None:
+            side = np.arange(-shell, shell + 1)
+            offsets = np.stack(np.meshgrid(side, side, side, indexing='ij'),
+                    axis=-1).reshape(-1, 3)
+            offsets = offsets[np.abs(offsets).max(axis=1) == shell]
+            _SHELL_OFFSETS[shell] = offsets
+        return [tuple(key) for key in (offsets + center).tolist()]
+
+    def _gather(self, keys):
+        '''Gathers the capsules registered in some cells.
+
+        Returns:
+            A map of tubeId -> array of unique segment indices.
+        '''
+        found = dict()
+        for key in keys:
+            bucket = self._grid.get(key)
+            if bucket:
+                for tubeId, segs in bucket.items():
+                    found.setdefault(tubeId, list()).append(segs)
+        return dict((tubeId, np.unique(np.concatenate(segs)))
+                for tubeId, segs in found.items())
+
+    def _surfaceDistances(self, candidates, distance=None, point=None):
+        '''Minimum distances from a convex set to candidate tube surfaces.
+
+        Args:
+            candidates: a map of tubeId -> array of segment indices.
+            distance: function mapping an (N, 3) array of points to their
+                distances to the convex set.
+            point: if given instead of distance, the set is this point and
+                the distances are computed in closed form.
+
+        Returns:
+            A tuple (tubeIds, dists) of the candidate tube IDs and an array
+            of their signed surface distances.
+        '''
+        tubeIds = list(candidates)
+        if not tubeIds:
+            return tubeIds, np.zeros(0)
+
+        arrays = [list() for _ in range(4)]
+        counts = list()
+        for tubeId in tubeIds:
+            segs = candidates[tubeId]
+            for array, values in zip(arrays, self._tubes[tubeId][:4]):
+                array.append(values[segs])
+            counts.append(len(segs))
+        p0, p1, r0, r1 = [np.concatenate(array) for array in arrays]
+
+        if point is not None:
+            dists = _pointSurfaceDistance(point, p0, p1, r0, r1)
+        else:
+            dists = _minimizeAlongCapsules(distance, p0, p1, r0, r1)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        return tubeIds, np.minimum.reduceat(dists, starts)
+
+def _minimizeAlongCapsules(distance, p0, p1, r0, r1, iterations=32):
+    '''Minimizes distance(p(t)) - r(t) along each capsule axis.
+
+    Distance to a convex set minus a linear radius is convex in t, so a
+    ternary search over all capsules at once finds the minimum.
+    '''
+    axis = p1 - p0
+
+    def evaluate(t):
+        return distance(p0 + t[:, None]*axis) - (r0 + t*(r1 - r0))
+
+    lo = np.zeros(len(p0))
+    hi = np.ones(len(p0))
+    for _ in range(iterations):
+        t1 = lo + (hi - lo)/3
+        t2 = hi - (hi - lo)/3
+        left = evaluate(t1) < evaluate(t2)
+        hi = np.where(left, t2, hi)
+        lo = np.where(left, lo, t1)
+    return evaluate((lo + hi)/2)
+
+def _pointSurfaceDistance(point, p0, p1, r0, r1):
+    '''Signed distance from a point to capsule surfaces.
+
+    Minimizes g(t) = |p0 + t*axis - point| - r(t) in closed form: g is
+    convex, so its minimum is at an endpoint or at a root of g'(t) in
+    [0, 1], and squaring g'(t) = 0 gives a quadratic in t.
+    '''
+    a = p0 - point
+    axis = p1 - p0
+    dr = r1 - r0
+    ab = (a*axis).sum(axis=1)
+    aa = (a**2).sum(axis=1)
+    length2 = (axis**2).sum(axis=1)
+
+    # if one end sphere contains the other, the minimum is at an endpoint
+    denom = length2 - dr**2
+    valid = denom > 0
+    safeDenom = np.where(valid, denom, 1)
+    safeLength2 = np.where(valid, length2, 1)
+    disc = ab**2 - length2*(ab**2 - dr**2*aa)/safeDenom
+    root = np.sqrt(np.maximum(disc, 0))
+    candidates = [np.zeros(len(a)), np.ones(len(a))]
+    for sign in (-1, 1):
+        t = np.clip((-ab + sign*root)/safeLength2, 0, 1)
+        candidates.append(np.where(valid, t, 0))
+
+    def evaluate(t):
+        return np.sqrt(np.maximum(aa + 2*t*ab + t*t*length2, 0)) \
+                - (r0 + t*dr)
+
+    return np.min([evaluate(t) for t in candidates], axis=0)
+
+def _closestAxisPoint(point, p0, p1):
+    '''Closest points to a point on capsule axes.
+
+    Returns:
+        A tuple (t, dist) of arrays with one entry per capsule, where t is
+        the axis parameter of the closest point and dist its distance.
+    '''
+    axis = p1 - p0
+    length2 = (axis**2).sum(axis=1)
+    t = ((point - p0)*axis).sum(axis=1)
+    # degenerate capsules are spheres around p0
+    t = np.where(length2 > 0, t / np.where(length2 > 0, length2, 1), 0)
+    t = np.clip(t, 0, 1)
+    closest = p0 + t[:, None]*axis
+    return t, np.sqrt(((point - closest)**2).sum(axis=1))
+
+def _capsuleDistance(point, p0, p1, r0, r1):
+    '''Distance from a point to capsule axes, and the radii at closest points.
+
+    Returns:
+        A tuple (dist, radius) of arrays with one entry per capsule.
+    '''
+    t, dist = _closestAxisPoint(point, p0, p1)
+    return dist, r0 + t*(r1 - r0)
@@ -14,7 +14,13 @@ class TubeTreeTab(QTreeView):
     '''Tube tree tab displays tubes in tree view.'''
 
     # signal: defer tube saving to a non-view componetn
-    saveTubesClicked = pyqtSignal(list, str)
+    # (selection, filename, max simplification error or 0 to keep all points)
+    saveTubesClicked = pyqtSignal(list, str, float)
+    # signal: connect tubes into vessel trees
+    buildTreeClicked = pyqtSignal()
+
+    # initial error of simplified saving, in world units
+    DEFAULT_SAVE_ERROR = 0.1
 
     def __init__(self, parent=None):
         super(TubeTreeTab, self).__init__(parent)
@@ -22,11 +28,17 @@ class TubeTreeTab(QTreeView):
         self.setSelectionMode(QAbstractItemView.ExtendedSelection)
 
         self.saveAction = QAction('Save tube(s)...', self)
+        self.saveSimplifiedAction = QAction('Save simplified tube(s)...', self)
+        self.buildTreeAction = QAction('Build vessel tree', self)
 
         self.contextMenu = QMenu(self)
         self.contextMenu.addAction(self.saveAction)
+        self.contextMenu.addAction(self.saveSimplifiedAction)
+        self.contextMenu.addAction(self.buildTreeAction)
 
         self.saveAction.triggered.connect(self.saveTubes)
+        self.saveSimplifiedAction.triggered.connect(self.saveSimplifiedTubes)
+        self.buildTreeAction.triggered.connect(self.buildTreeClicked)
 
     def contextMenuEvent(self, event):
         '''Opens a context menu.'''
@@ -34,14 +46,29 @@ class TubeTreeTab(QTreeView):
         if index.isValid():
             self.contextMenu.exec_(QPoint(event.globalX(), event.globalY()))
 
-    def saveTubes(self):
-        '''Save selected tubes.'''
-        selection = self.selectionModel().selectedIndexes()
+    def saveTubes(self, maxError=0.0):
+        '''Save selected tubes.
+
+        Args:
+            maxError: maximum simplification error of the saved tubes, in
+                world units. Zero saves all points.
+        '''
+        # one index per row, not per column
+        selection = self.selectionModel().selectedRows()
         if len(selection):
             filename, ext = QFileDialog.getSaveFileName(
                     self, 'Save File', '', '.tre')
             if filename:
-                self.saveTubesClicked.emit(selection, str(filename + ext))
+                self.saveTubesClicked.emit(selection, str(filename + ext),
+                        maxError)
+
+    def saveSimplifiedTubes(self):
+        '''Save simplified copies of the selected tubes.'''
+        maxError, ok = QInputDialog.getDouble(self, 'Save Simplified',
+                'Maximum simplification error:', self.DEFAULT_SAVE_ERROR,
+                0.01, 100.0, 2)
+        if ok:
+            self.saveTubes(maxError)
 
 class FiltersTab(QWidget):
     '''Filters tab holds options for preprocessing the segment image.'''
@@ -117,6 +144,14 @@ class SegmentTab(QWidget):
     scaleChanged = pyqtSignal(float)
     # signal: segmentation enabled/disabled
     segmentEnabled = pyqtSignal(bool)
+    # signal: seed file selected for batch segmentation
+    seedFileSelected = pyqtSignal(str)
+    # signal: request segmenting tubes at automatically found seeds
+    findSeedsClicked = pyqtSignal()
+    # signal: speculative extraction at neighbouring scales enabled/disabled
+    speculativeEnabled = pyqtSignal(bool)
+    # signal: region of interest size changed
+    roiSizeChanged = pyqtSignal(int)
 
     SCALE_SIZES = [
         ('Custom', 1.0),
@@ -153,10 +188,34 @@ class SegmentTab(QWidget):
             self.scaleCombo.addItem(size)
         self.grid.addWidget(self.scaleCombo, 1, 2)
 
+        roiLabel = QLabel('ROI size:', self)
+        roiLabel.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.grid.addWidget(roiLabel, 2, 0, Qt.AlignRight)
+
+        self.roiSizeInput = QSpinBox(self)
+        self.roiSizeInput.setRange(0, 1024)
+        self.roiSizeInput.setSuffix(' voxels')
+        self.roiSizeInput.setSpecialValueText('Whole image')
+        self.grid.addWidget(self.roiSizeInput, 2, 1, 1, 2)
+
+        self.speculativeCheckbox = QCheckBox(
+                'Also try neighbouring scales', self)
+        self.grid.addWidget(self.speculativeCheckbox, 3, 0, 1, 3)
+
+        self.seedFileBtn = QPushButton('Segment seeds from file...', self)
+        self.grid.addWidget(self.seedFileBtn, 4, 0, 1, 3)
+
+        self.findSeedsBtn = QPushButton('Segment whole image', self)
+        self.grid.addWidget(self.findSeedsBtn, 5, 0, 1, 3)
+
         spacer = QSpacerItem(40, 20, QSizePolicy.Minimum, QSizePolicy.Expanding)
-        self.grid.addItem(spacer, 2, 0)
+        self.grid.addItem(spacer, 6, 0)
 
         self.segmentBtn.clicked.connect(self.onSegmentBtnClicked)
+        self.seedFileBtn.clicked.connect(self.openSeedFile)
+        self.findSeedsBtn.clicked.connect(self.findSeedsClicked)
+        self.speculativeCheckbox.toggled.connect(self.speculativeEnabled)
+        self.roiSizeInput.valueChanged.connect(self.roiSizeChanged)
         self.scaleInput.textChanged.connect(self.onScaleInputChanged)
         self.scaleCombo.activated.connect(self.setScalePreset)
 
@@ -164,6 +223,11 @@ class SegmentTab(QWidget):
         '''Setter for scale.'''
         self.scaleInput.setText(str(scale))
 
+    def scalePresets(self):
+        '''Gets the scales of all non-custom presets.'''
+        return [scale for preset, scale in self.SCALE_SIZES
+                if preset != 'Custom']
+
     def setScalePreset(self, index):
         '''Sets the scale according to a preset.
 
@@ -178,6 +242,13 @@ class SegmentTab(QWidget):
             self.scaleInput.setEnabled(False)
             self.setScale(scale)
 
+    def openSeedFile(self):
+        '''Opens a seed CSV file for batch segmentation.'''
+        filename, _ = QFileDialog.getOpenFileName(
+                self, 'Open Seeds', '', 'CSV files (*.csv);;All files (*)')
+        if filename:
+            self.seedFileSelected.emit(str(filename))
+
     def onSegmentBtnClicked(self):
         self.segmentEnabled.emit(self.segmentBtn.isChecked())
 
@@ -203,6 +274,8 @@ class SelectionTab(QWidget):
     clearTubeSelClicked = pyqtSignal()
     # signal: request selecting of all tubes
     selectAllTubesClicked = pyqtSignal()
+    # signal: request selecting tubes by mean radius (min, max)
+    selectByRadiusClicked = pyqtSignal(float, float)
 
     def __init__(self, parent=None):
         super(SelectionTab, self).__init__(parent)
@@ -221,9 +294,28 @@ class SelectionTab(QWidget):
         self.clearBtn = QPushButton('Clear selection')
         self.form.addWidget(self.clearBtn)
 
+        self.minRadiusInput = QDoubleSpinBox(self)
+        self.maxRadiusInput = QDoubleSpinBox(self)
+        for radiusInput in (self.minRadiusInput, self.maxRadiusInput):
+            radiusInput.setDecimals(2)
+            radiusInput.setSingleStep(0.1)
+            radiusInput.setMaximum(1000)
+        self.maxRadiusInput.setValue(1)
+        self.form.addRow('Min radius', self.minRadiusInput)
+        self.form.addRow('Max radius', self.maxRadiusInput)
+
+        self.selRadiusBtn = QPushButton('Select by mean radius')
+        self.form.addWidget(self.selRadiusBtn)
+
         self.selAllBtn.clicked.connect(self.selectAllTubesClicked)
         self.deleteBtn.clicked.connect(self.deleteTubeSelClicked)
         self.clearBtn.clicked.connect(self.clearTubeSelClicked)
+        self.selRadiusBtn.clicked.connect(self.emitSelectByRadius)
+
+    def emitSelectByRadius(self):
+        '''Emits the selected mean radius range.'''
+        self.selectByRadiusClicked.emit(self.minRadiusInput.value(),
+                self.maxRadiusInput.value())
 
     def setTubeSelection(self, tubeSelection):
         '''Sets the count of tubes.
@@ -261,6 +353,10 @@ class ThreeDTab(QWidget):
 
     # signal
     scalarOpacityUnitDistChanged = pyqtSignal(int)
+    # signal: maximum tube simplification error changed
+    tubeSimplifyErrorChanged = pyqtSignal(float)
+    # signal: rendering tubes as one merged mesh enabled/disabled
+    mergedTubesEnabled = pyqtSignal(bool)
 
     def __init__(self, parent=None):
         super(ThreeDTab, self).__init__(parent)
@@ -271,17 +367,38 @@ class ThreeDTab(QWidget):
         self.layout.addWidget(QLabel('Opacity Unit Distance'), 0, 0)
         self.layout.addWidget(self.opacitySlider, 0, 1)
 
+        self.simplifyInput = QDoubleSpinBox(self)
+        self.simplifyInput.setDecimals(2)
+        self.simplifyInput.setSingleStep(0.05)
+        self.simplifyInput.setSpecialValueText('Off')
+        self.layout.addWidget(QLabel('Tube simplification error'), 1, 0)
+        self.layout.addWidget(self.simplifyInput, 1, 1)
+
+        self.mergeCheckbox = QCheckBox('Merge tube meshes', self)
+        self.mergeCheckbox.setToolTip(
+                'Render all tubes as one mesh. Faster with many tubes.')
+        self.layout.addWidget(self.mergeCheckbox, 2, 0, 1, 2)
+
         spacer = QSpacerItem(40, 20, QSizePolicy.Minimum, QSizePolicy.Expanding)
-        self.layout.addItem(spacer, 1, 0)
+        self.layout.addItem(spacer, 3, 0)
 
         self.opacitySlider.valueChanged.connect(
                 self.scalarOpacityUnitDistChanged)
+        self.simplifyInput.valueChanged.connect(
+                self.tubeSimplifyErrorChanged)
+        self.mergeCheckbox.toggled.connect(self.mergedTubesEnabled)
 
     def setScalarOpacityRange(self, minv, maxv):
         '''Sets scalar opacity range.'''
         self.opacitySlider.setMinimum(minv)
         self.opacitySlider.setMaximum(maxv)
 
+    def setTubeSimplifyError(self, value):
+        '''Sets the tube simplification error without notifying.'''
+        self.simplifyInput.blockSignals(True)
+        self.simplifyInput.setValue(value)
+        self.simplifyInput.blockSignals(False)
+
     def setScalarOpacity(self, value):
         '''Sets scalar opacity unit distance.'''
         self.opacitySlider.setValue(value)
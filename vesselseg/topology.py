@@ -0,0 +1,189 @@
+import collections
+
+import numpy as np
+
+# endpoints join tube surfaces closer than this many endpoint radii
+DEFAULT_TOLERANCE = 1.5
+
+class TubeConnection(object):
+    '''A child tube endpoint joined to a parent tube.'''
+
+    __slots__ = ('child', 'childPoint', 'parent', 'parentPoint', 'distance')
+
+    def __init__(self, child, childPoint, parent, parentPoint, distance):
+        self.child = child
+        # index of the joined endpoint in the child tube points
+        self.childPoint = childPoint
+        self.parent = parent
+        # index of the closest parent centerline point
+        self.parentPoint = parentPoint
+        # distance from the endpoint to the parent surface
+        self.distance = distance
+
+class TubeGraph(object):
+    '''Vessel tree over tube IDs.
+
+    Every tube is a branch. Tubes without a parent are roots, and parent
+    points where children join are bifurcations.
+    '''
+
+    def __init__(self, tubeIds, connections):
+        self.tubeIds = list(tubeIds)
+        # child tubeId -> TubeConnection
+        self.connections = dict((c.child, c) for c in connections)
+        # parent tubeId -> list of child tubeIds
+        self.children = collections.defaultdict(list)
+        for connection in connections:
+            self.children[connection.parent].append(connection.child)
+
+    def parent(self, tubeId):
+        '''Gets the parent tube ID, or None for roots.'''
+        connection = self.connections.get(tubeId)
+        return connection.parent if connection else None
+
+    def roots(self):
+        '''Gets the IDs of tubes without a parent.'''
+        return [t for t in self.tubeIds if t not in self.connections]
+
+    def bifurcations(self):
+        '''Gets the branch points of the tree.
+
+        Returns:
+            A map of (parent tubeId, parent point index) -> list of the
+            child tubeIds joined at that point.
+        '''
+        points = collections.defaultdict(list)
+        for connection in self.connections.values():
+            points[(connection.parent, connection.parentPoint)].append(
+                    connection.child)
+        return dict(points)
+
+    def depthFirst(self):
+        '''Iterates over tube IDs, parents before their children.'''
+        stack = list(reversed(self.roots()))
+        while stack:
+            tubeId = stack.pop()
+            yield tubeId
+            stack.extend(reversed(self.children.get(tubeId, ())))
+
+def _NonEmptyLayout(tubeStore):
+    '''Gets the TubeStore layout of the tubes that have points.'''
+    tubeIds, offsets, counts = tubeStore.layout()
+    nonEmpty = counts > 0
+    tubeIds = [tubeId for tubeId, keep in zip(tubeIds, nonEmpty) if keep]
+    return tubeIds, offsets[nonEmpty], counts[nonEmpty]
+
+def TubeEndpoints(tubeStore):
+    '''Gets the endpoints of all tubes in a TubeStore.
+
+    Returns:
+        A tuple (tubeIds, pointIndexes, positions, radii), with two rows
+        per tube: its first and its last point. Tubes without points have
+        no rows.
+    '''
+    tubeIds, offsets, counts = _NonEmptyLayout(tubeStore)
+    if not tubeIds:
+        return [], np.zeros(0, dtype=np.int64), np.zeros((0, 3)), \
+                np.zeros(0)
+    first = offsets
+    last = offsets + counts - 1
+    rows = np.column_stack((first, last)).ravel()
+    pointIndexes = np.column_stack(
+            (np.zeros_like(counts), counts - 1)).ravel()
+    endpointIds = [tubeId for tubeId in tubeIds for _ in range(2)]
+    positions = tubeStore.positions()[rows].astype(float)
+    radii = tubeStore.radii()[rows].astype(float)
+    return endpointIds, pointIndexes, positions, radii
+
+def BuildTubeGraph(tubeStore, spatialIndex, tolerance=DEFAULT_TOLERANCE):
+    '''Connects tubes into a vessel tree by endpoint proximity.
+
+    Each tube endpoint is joined to the closest surface of another tube
+    that lies within `tolerance` times the endpoint radius, so branches
+    ending on the wall of their parent are joined. Joins are
+    accepted from the closest one on, unless they close a cycle. Each
+    connected set of tubes is then rooted at its widest tube.
+
+    Args:
+        tubeStore: a TubeStore holding the tubes.
+        spatialIndex: a TubeSpatialIndex over the same tubes.
+        tolerance: join distance, in endpoint radii.
+
+    Returns:
+        A TubeGraph.
+    '''
+    endpointIds, pointIndexes, positions, radii = TubeEndpoints(tubeStore)
+    # drop the second endpoint of single point tubes
+    keep = np.ones(len(endpointIds), dtype=bool)
+    keep[1::2] = pointIndexes[1::2] > 0
+    maxDistances = tolerance * radii
+
+    # joins are (relative distance, TubeConnection) with the endpoint tube
+    # as child, and may be flipped when the tree is rooted
+    joins = list()
+    for i in np.flatnonzero(keep & (maxDistances > 0)):
+        found = spatialIndex.nearestSurface(
+                positions[i], maxDistances[i], exclude=endpointIds[i])
+        if found is None:
+            continue
+        parent, segment, t, distance = found
+        parentCount = tubeStore.records[parent].count
+        parentPoint = min(segment + int(round(t)), parentCount - 1)
+        joins.append((distance / maxDistances[i], TubeConnection(
+                endpointIds[i], int(pointIndexes[i]),
+                parent, parentPoint, distance)))
+    joins.sort(key=lambda join: join[0])
+
+    tubeIds = tubeStore.layout()[0]
+    components = dict((tubeId, tubeId) for tubeId in tubeIds)
+
+    def find(tubeId):
+        root = tubeId
+        while components[root] != root:
+            root = components[root]
+        while components[tubeId] != root:
+            components[tubeId], tubeId = root, components[tubeId]
+        return root
+
+    # spanning forest of the joins, closest first
+    edges = collections.defaultdict(list)
+    for _, connection in joins:
+        childRoot = find(connection.child)
+        parentRoot = find(connection.parent)
+        if childRoot != parentRoot:
+            components[childRoot] = parentRoot
+            edges[connection.child].append(connection)
+            edges[connection.parent].append(connection)
+
+    # root each component at its tube with the largest mean radius. Tubes
+    # without points are never joined, so they stay roots.
+    widest = dict()
+    pointTubeIds, offsets, counts = _NonEmptyLayout(tubeStore)
+    if pointTubeIds:
+        meanRadii = np.add.reduceat(tubeStore.radii(), offsets) / counts
+        for tubeId, meanRadius in zip(pointTubeIds, meanRadii):
+            root = find(tubeId)
+            if root not in widest or meanRadius > widest[root][1]:
+                widest[root] = (tubeId, meanRadius)
+
+    connections = list()
+    for root, _ in widest.values():
+        stack = [root]
+        visited = set(stack)
+        while stack:
+            tubeId = stack.pop()
+            for connection in edges.get(tubeId, ()):
+                if connection.parent == tubeId:
+                    child = connection.child
+                else:
+                    # the tube joined its endpoint to the child centerline
+                    child = connection.parent
+                    connection = TubeConnection(child,
+                            connection.parentPoint, tubeId,
+                            connection.childPoint, connection.distance)
+                if child not in visited:
+                    visited.add(child)
+                    connections.append(connection)
+                    stack.append(child)
+
+    return TubeGraph(tubeIds, connections)
@@ -0,0 +1,345 @@
+import os
+import math
+import hashlib
+import tempfile
+import threading
+
+import numpy as np
+import vtk
+import vtk.util.numpy_support as np_s
+
+from PyQt5.QtCore import *
+
+from simplify import SimplifyCenterline
+
+# bounds of the number of sides of tube meshes
+MIN_SIDES = 3
+MAX_SIDES = 20
+# default length of a side of the tube mesh cross section, in world units
+DEFAULT_SIDE_LENGTH = 0.25
+
+DEFAULT_CACHE_DIR = os.path.join(
+        os.environ.get('XDG_CACHE_HOME',
+            os.path.join(os.path.expanduser('~'), '.cache')),
+        'vesselseg', 'meshes')
+
+def NumberOfSides(radius, sideLength=DEFAULT_SIDE_LENGTH):
+    '''Gets the number of mesh sides of a tube of the given radius.
+
+    Tubes get as many sides as fit sideLength around their cross section,
+    within [MIN_SIDES, MAX_SIDES].
+    '''
+    if sideLength <= 0:
+        return MAX_SIDES
+    sides = int(round(2*math.pi*radius / sideLength))
+    return min(max(sides, MIN_SIDES), MAX_SIDES)
+
+def CreateCenterlinePolyData(positions, radii, maxError=0):
+    '''Generates polyline polydata with radii from tube points.
+
+    Args:
+        positions: (N, 3) array of world space centerline points.
+        radii: (N,) array of world space radii.
+        maxError: maximum centerline simplification error, in world units.
+            Zero keeps all points.
+
+    Returns:
+        A vtkPolyData with a single polyline cell and a 'Radii' point
+        array.
+    '''
+    if len(positions) == 0:
+        return vtk.vtkPolyData()
+
+    if maxError > 0 and len(positions) > 2:
+        keep = SimplifyCenterline(positions, radii, maxError)
+        positions, radii = positions[keep], radii[keep]
+    count = len(positions)
+
+    # the VTK arrays share memory with these numpy arrays
+    vpoints = vtk.vtkPoints()
+    vpoints.SetData(np_s.numpy_to_vtk(
+        np.ascontiguousarray(positions, dtype=np.float64)))
+    scalars = np_s.numpy_to_vtk(
+            np.ascontiguousarray(radii, dtype=np.float32))
+    scalars.SetName('Radii')
+
+    # a single polyline cell in the legacy (count, ids...) layout
+    connectivity = np.concatenate(([count], np.arange(count)))
+    ca = vtk.vtkCellArray()
+    ca.SetCells(1, np_s.numpy_to_vtkIdTypeArray(
+        connectivity.astype(np_s.ID_TYPE_CODE), deep=True))
+
+    pd = vtk.vtkPolyData()
+    pd.SetLines(ca)
+    pd.SetPoints(vpoints)
+    pd.GetPointData().SetScalars(scalars)
+    pd.GetPointData().SetActiveScalars('Radii')
+    return pd
+
+def CreateTubeMesh(centerline, sideLength=DEFAULT_SIDE_LENGTH):
+    '''Generates a tube mesh around centerline polydata.
+
+    The number of sides follows the widest radius, see NumberOfSides.
+    vtkTubeFilter skips lines with non-positive radii, so such points get
+    the smallest positive radius of the tube instead. Tubes without any
+    positive radius have an empty mesh.
+    '''
+    if centerline.GetNumberOfPoints() == 0:
+        return vtk.vtkPolyData()
+    radii = np_s.vtk_to_numpy(centerline.GetPointData().GetArray('Radii'))
+    positive = radii[radii > 0]
+    if len(positive) == 0:
+        return vtk.vtkPolyData()
+    minRadius, maxRadius = float(positive.min()), float(positive.max())
+    if len(positive) < len(radii):
+        # the copy has its own point data, so the input keeps its radii
+        clamped = vtk.vtkPolyData()
+        clamped.ShallowCopy(centerline)
+        scalars = np_s.numpy_to_vtk(np.maximum(radii, minRadius)
+                .astype(np.float32), deep=True)
+        scalars.SetName('Radii')
+        clamped.GetPointData().SetScalars(scalars)
+        centerline = clamped
+
+    tf = vtk.vtkTubeFilter()
+    tf.SetInputData(centerline)
+    tf.SetVaryRadiusToVaryRadiusByAbsoluteScalar()
+    tf.SetRadius(minRadius)
+    tf.SetRadiusFactor(maxRadius/minRadius)
+    tf.SetNumberOfSides(NumberOfSides(maxRadius, sideLength))
+    tf.Update()
+
+    # detach the mesh so that arrays can be added to it
+    poly = vtk.vtkPolyData()
+    poly.ShallowCopy(tf.GetOutput())
+    return poly
+
+class MeshCache(object):
+    '''Bounded on-disk cache of tube meshes.
+
+    Meshes are stored as binary VTK XML polydata files named after a hash
+    of the tube points and the mesh parameters. Since tube points are in
+    world space, the hash covers the tube transform as well. When the
+    cache grows past its size limit, the least recently used files are
+    removed. Cache reads and writes are safe across threads.
+    '''
+
+    # bump when the generated meshes change for the same inputs
+    VERSION = 1
+    DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+    # eviction shrinks the cache to this fraction of its size limit
+    EVICT_RATIO = 0.9
+    SUFFIX = '.vtp'
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR,
+            maxBytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        # total size of the cache files, computed on first write
+        self._size = None
+
+    def key(self, positions, radii, maxError, sideLength):
+        '''Gets the cache key of a tube mesh.'''
+        digest = hashlib.sha1()
+        digest.update(np.array([self.VERSION, len(positions), maxError,
+            sideLength], dtype=np.float64).tobytes())
+        digest.update(np.ascontiguousarray(positions,
+            dtype=np.float64).tobytes())
+        digest.update(np.ascontiguousarray(radii, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key):
+        '''Gets a cached mesh, or None.'''
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(path)
+        reader.Update()
+        poly = reader.GetOutput()
+        try:
+            if poly.GetNumberOfPoints() == 0:
+                # unreadable file
+                self._remove(path)
+                return None
+            # mark as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        mesh = vtk.vtkPolyData()
+        mesh.ShallowCopy(poly)
+        return mesh
+
+    def put(self, key, mesh):
+        '''Writes a mesh to the cache, evicting old meshes if full.'''
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            os.close(fd)
+        except OSError:
+            return
+
+        writer = vtk.vtkXMLPolyDataWriter()
+        writer.SetFileName(tmpPath)
+        writer.SetInputData(mesh)
+        writer.SetDataModeToAppended()
+        writer.EncodeAppendedDataOff()
+        writer.SetCompressorTypeToZLib()
+        if not writer.Write():
+            self._remove(tmpPath)
+            return
+
+        path = self._path(key)
+        with self._lock:
+            try:
+                size = os.path.getsize(tmpPath)
+                # the same mesh may have been written by another worker
+                try:
+                    size -= os.path.getsize(path)
+                except OSError:
+                    pass
+                # atomic, so readers never see partial files
+                os.rename(tmpPath, path)
+            except OSError:
+                self._remove(tmpPath)
+                return
+
+            if self._size is None:
+                self._size = self._scanSize()
+            else:
+                self._size += size
+            if self._size > self.maxBytes:
+                self._evict()
+
+    def clear(self):
+        '''Removes all cached meshes.'''
+        with self._lock:
+            for path, _, _ in self._entries():
+                self._remove(path)
+            self._size = 0
+
+    def _entries(self):
+        '''Lists (path, size, access time) of all cache files.'''
+        entries = list()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _scanSize(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        '''Removes least recently used files until below the size limit.'''
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(entrySize for _, entrySize, _ in entries)
+        target = self.maxBytes * self.EVICT_RATIO
+        for path, entrySize, _ in entries:
+            if size <= target:
+                break
+            if self._remove(path):
+                size -= entrySize
+        self._size = size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        return True
+
+class MeshJob(object):
+    '''A batch of tubes to generate meshes for.'''
+
+    def __init__(self, tubes, maxError, sideLength, generation=0):
+        # list of (tubeId, token, positions, radii), with world space
+        # point arrays owned by the job
+        self.tubes = tubes
+        self.maxError = maxError
+        self.sideLength = sideLength
+        # jobs of an older generation were cancelled
+        self.generation = generation
+        # list of (tubeId, token, centerline, mesh), filled by a worker
+        self.meshes = list()
+        # list of (tubeId, token, exception) of tubes that failed to mesh
+        self.errors = list()
+
+class MeshWorker(QObject):
+    '''Threaded worker to generate tube meshes.
+
+    Several workers may share one job queue, and block on it until a
+    message arrives. Messages are (action, MeshJob) tuples. Meshes are read
+    from and written to an optional MeshCache. A tube that fails to mesh is
+    recorded in the job errors and does not fail the rest of the job.
+    '''
+
+    MESH, STOP = range(2)
+
+    # signal: mesh job finished
+    jobFinished = pyqtSignal(MeshJob)
+    # signal: mesh job threw exception
+    jobFailed = pyqtSignal(Exception, MeshJob)
+    # signal: mesh worker terminated
+    terminated = pyqtSignal()
+
+    def __init__(self, jobQueue, meshCache=None, parent=None):
+        super(MeshWorker, self).__init__(parent)
+
+        self.jobQueue = jobQueue
+        self.meshCache = meshCache
+
+    def run(self):
+        while True:
+            action, job = self.jobQueue.get()
+            if action == self.STOP:
+                break
+
+            if action == self.MESH:
+                try:
+                    self._meshTubes(job)
+                except Exception as e:
+                    self.jobFailed.emit(e, job)
+                else:
+                    self.jobFinished.emit(job)
+
+        # tell main thread that this worker has terminated
+        self.terminated.emit()
+
+    def _meshTubes(self, job):
+        for tubeId, token, positions, radii in job.tubes:
+            try:
+                centerline, mesh = self._meshTube(positions, radii, job)
+            except Exception as e:
+                job.errors.append((tubeId, token, e))
+            else:
+                job.meshes.append((tubeId, token, centerline, mesh))
+
+    def _meshTube(self, positions, radii, job):
+        '''Gets the centerline and mesh of one tube.'''
+        cache = self.meshCache
+        centerline = CreateCenterlinePolyData(positions, radii, job.maxError)
+        mesh = None
+        if cache is not None and len(positions):
+            key = cache.key(positions, radii, job.maxError, job.sideLength)
+            mesh = cache.get(key)
+            if mesh is None:
+                mesh = CreateTubeMesh(centerline, job.sideLength)
+                cache.put(key, mesh)
+        if mesh is None:
+            mesh = CreateTubeMesh(centerline, job.sideLength)
+        return centerline, mesh
@@ -0,0 +1,182 @@
+import numpy as np
+
+class TubeRecord(object):
+    '''Metadata of a tube in a TubeStore.'''
+
+    __slots__ = ('tubeId', 'offset', 'count', 'scale')
+
+    def __init__(self, tubeId, offset, count, scale):
+        self.tubeId = tubeId
+        # index of the first tube point in the store columns
+        self.offset = offset
+        self.count = count
+        # average scaling of the tube's index to world transform
+        self.scale = scale
+
+class TubeStore(object):
+    '''Columnar store of tube points.
+
+    All points of all tubes live in one contiguous array per attribute.
+    Positions, radii, tangents and normals are in world space. Tubes are
+    appended at the end of the columns, and removed tubes leave gaps until
+    the store is compacted.
+    '''
+
+    # column name -> (dtype, shape of one entry)
+    COLUMNS = [
+        ('position', np.float32, (3,)),
+        ('radius', np.float32, ()),
+        ('tangent', np.float32, (3,)),
+        ('normal1', np.float32, (3,)),
+        ('normal2', np.float32, (3,)),
+        ('medialness', np.float32, ()),
+        ('ridgeness', np.float32, ()),
+        ('alpha1', np.float32, ()),
+        ('alpha2', np.float32, ()),
+        ('alpha3', np.float32, ()),
+        ('mark', np.bool_, ()),
+    ]
+
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self):
+        # tubeId -> TubeRecord
+        self.records = dict()
+        self._columns = dict()
+        # number of used entries, including gaps
+        self._size = 0
+        # number of entries in gaps left by removed tubes
+        self._garbage = 0
+        self._allocate(self.INITIAL_CAPACITY)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, tubeId):
+        return tubeId in self.records
+
+    def numPoints(self):
+        '''Number of points of all stored tubes.'''
+        return self._size - self._garbage
+
+    def _allocate(self, capacity):
+        '''Grows all columns to capacity, keeping the used entries.'''
+        for name, dtype, shape in self.COLUMNS:
+            column = np.zeros((capacity,) + shape, dtype=dtype)
+            if name in self._columns:
+                column[:self._size] = self._columns[name][:self._size]
+            self._columns[name] = column
+
+    def clear(self):
+        '''Removes all tubes.'''
+        self.records.clear()
+        self._size = 0
+        self._garbage = 0
+
+    def addTubeArray(self, tubeId, points, matrix, offset):
+        '''Adds a tube from its point array.
+
+        Args:
+            tubeId: tube ID. Replaces any tube with the same ID.
+            points: array of dtype segmenttubes.TUBE_POINT_DTYPE, with
+                positions in object space.
+            matrix: 3x3 index to world matrix of the tube.
+            offset: index to world offset of the tube.
+        '''
+        self.removeTube(tubeId)
+
+        count = len(points)
+        if self._size + count > len(self._columns['position']):
+            capacity = len(self._columns['position'])
+            while self._size + count > capacity:
+                capacity *= 2
+            self._allocate(capacity)
+
+        scale = float(np.mean(np.diag(matrix)))
+        start, end = self._size, self._size + count
+        columns = self._columns
+        columns['position'][start:end] = points['position'].dot(matrix.T) \
+                + offset
+        columns['radius'][start:end] = points['radius'] * scale
+        for name in ('tangent', 'normal1', 'normal2'):
+            columns[name][start:end] = _normalized(points[name].dot(matrix.T))
+        for name in ('medialness', 'ridgeness', 'alpha1', 'alpha2', 'alpha3',
+                'mark'):
+            columns[name][start:end] = points[name]
+
+        self._size = end
+        self.records[tubeId] = TubeRecord(tubeId, start, count, scale)
+
+    def removeTube(self, tubeId):
+        '''Removes a tube, if present.'''
+        record = self.records.pop(tubeId, None)
+        if record is None:
+            return
+        self._garbage += record.count
+        if self._garbage > self._size // 2:
+            self.compact()
+
+    def compact(self):
+        '''Closes the gaps left by removed tubes.
+
+        Tubes keep their relative order.
+        '''
+        if self._garbage == 0:
+            return
+        records = sorted(self.records.values(), key=lambda r: r.offset)
+        if records:
+            index = np.concatenate([np.arange(r.offset, r.offset + r.count)
+                for r in records])
+        else:
+            index = np.zeros(0, dtype=int)
+        for name in self._columns:
+            column = self._columns[name]
+            column[:len(index)] = column[index]
+
+        offset = 0
+        for record in records:
+            record.offset = offset
+            offset += record.count
+        self._size = offset
+        self._garbage = 0
+
+    def column(self, name, tubeId=None):
+        '''Gets a view of a column.
+
+        Args:
+            name: column name, as in COLUMNS.
+            tubeId: if given, only the points of that tube are returned.
+                Otherwise, the store is compacted and all points returned.
+        '''
+        if tubeId is None:
+            self.compact()
+            return self._columns[name][:self._size]
+        record = self.records[tubeId]
+        return self._columns[name][record.offset:record.offset+record.count]
+
+    def positions(self, tubeId=None):
+        '''Gets world space point positions.'''
+        return self.column('position', tubeId)
+
+    def radii(self, tubeId=None):
+        '''Gets world space point radii.'''
+        return self.column('radius', tubeId)
+
+    def layout(self):
+        '''Gets the layout of all tubes in the compacted columns.
+
+        Returns:
+            A tuple (tubeIds, offsets, counts), with tubes ordered by their
+            position in the columns.
+        '''
+        self.compact()
+        records = sorted(self.records.values(), key=lambda r: r.offset)
+        tubeIds = [r.tubeId for r in records]
+        offsets = np.array([r.offset for r in records], dtype=np.int64)
+        counts = np.array([r.count for r in records], dtype=np.int64)
+        return tubeIds, offsets, counts
+
+def _normalized(vectors):
+    '''Normalizes an (N, 3) array of vectors, leaving zero vectors as is.'''
+    norms = np.sqrt((vectors**2).sum(axis=1))[:, None]
+    return vectors / np.where(norms > 0, norms, 1)
@@ -1,3 +1,6 @@
+import itertools
+
+import numpy as np
 import itk
 import vtk
 import vtk.util.numpy_support as np_s
@@ -42,3 +45,41 @@ def itkToVtkImage(itkImage):
     vtkImage.SetSpacing(list(itkImage.GetSpacing()))
 
     return vtkImage
+
+def itkMatrixToArray(matrix, dimension=3):
+    '''Converts an itk.Matrix to a numpy array.'''
+    return np.array([[matrix(i, j) for j in range(dimension)]
+        for i in range(dimension)], dtype=float)
+
+def copyItkTransform(source, dest):
+    '''Copies the matrix and offset of an ITK affine transform.'''
+    dest.SetMatrix(source.GetMatrix())
+    dest.SetOffset(source.GetOffset())
+
+class ImageHandle(object):
+    '''Versioned reference to an ITK image.
+
+    Every new image gets a new version, so consumers can tell if an image
+    changed by comparing versions.
+    '''
+
+    _versions = itertools.count(1)
+
+    def __init__(self, image, pixelType, dimension):
+        self.image = image
+        self.pixelType = pixelType
+        self.dimension = dimension
+        self.version = next(self._versions)
+
+def readSeedFile(filename):
+    '''Reads seeds from a CSV file.
+
+    Each row holds the x, y, z physical coordinates of a seed, optionally
+    followed by the seed scale. Rows with any missing or non-numeric value,
+    such as a header, are skipped.
+
+    Returns:
+        An (N, 3) or (N, 4) array of seeds.
+    '''
+    seeds = np.atleast_2d(np.genfromtxt(filename, delimiter=','))
+    return seeds[~np.isnan(seeds).any(axis=1)]
@@ -1,10 +1,16 @@
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 
+import numpy as np
 import vtk
+import vtk.util.numpy_support as np_s
 from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 
-from managers import TUBE_ID_KEY
+from managers import TUBE_ID_ARRAY
+
+# tube colors as RGBA bytes
+TUBE_COLOR = (255, 0, 0, 255)
+SELECTED_TUBE_COLOR = (255, 255, 255, 255)
 
 class SliceSlider(QWidget):
     '''Represents the slice control widget.'''
@@ -56,7 +62,7 @@ class VTKViewer(QWidget):
     # signal: image voxel selected at given coord
     imageVoxelSelected = pyqtSignal(float, float, float)
     # signal: a tube was selected
-    tubeSelected = pyqtSignal(str)
+    tubeSelected = pyqtSignal(int)
     # signal: window/level changed. Values are between [0,1]
     windowLevelChanged = pyqtSignal(float, float)
 
@@ -105,6 +111,8 @@ class VTKViewer(QWidget):
 
         self.slicePosition = 0
         self.tubeBlocks = None
+        # flat block index -> tubeId
+        self.blockTubeIds = dict()
         self.volume = None
         self.sliceActor = None
 
@@ -128,6 +136,16 @@ class VTKViewer(QWidget):
         self.tubeProducer = vtk.vtkTrivialProducer()
         self.tubeMapper = vtk.vtkCompositePolyDataMapper2()
         self.tubeActor = vtk.vtkActor()
+        # tubes merged into a few chunk meshes, colored by tube ID
+        self.mergedTubeMapper = vtk.vtkCompositePolyDataMapper2()
+        self.mergedTubeActor = vtk.vtkActor()
+        self.tubeSelectionTable = vtk.vtkLookupTable()
+        # RGBA bytes of the selection table entries, indexed by tube ID
+        self._tubeColors = np.zeros((0, 4), dtype=np.uint8)
+        self.tubeDisplayAttributes = vtk.vtkCompositeDataDisplayAttributes()
+        # tube centerlines, shown in place of tubes during interaction
+        self.centerlineMapper = vtk.vtkCompositePolyDataMapper2()
+        self.centerlineActor = vtk.vtkActor()
 
     def initRenderers(self):
         self.sliceRenderer = vtk.vtkRenderer()
@@ -160,17 +178,43 @@ class VTKViewer(QWidget):
         istyleSlice.AddObserver('LeftButtonReleaseEvent',
                 self.onWindowLevelChange)
         istyleVolume.AddObserver('LeftButtonClickEvent', self.onVolumeClicked)
+        istyleVolume.AddObserver('StartInteractionEvent',
+                self.onVolumeInteractionStart)
+        istyleVolume.AddObserver('EndInteractionEvent',
+                self.onVolumeInteractionEnd)
 
         # set up tube actor
         self.tubeMapper.SetInputConnection(self.tubeProducer.GetOutputPort())
-        cdsa = vtk.vtkCompositeDataDisplayAttributes()
-        cdsa.SetBlockColor(0, (1,0,0))
-        self.tubeMapper.SetCompositeDataDisplayAttributes(cdsa)
+        # default red
+        self.tubeDisplayAttributes.SetBlockColor(0, (1,0,0))
+        self.tubeMapper.SetCompositeDataDisplayAttributes(
+                self.tubeDisplayAttributes)
         self.tubeActor.SetMapper(self.tubeMapper)
 
+        # set up merged tube actor
+        self.mergedTubeActor.SetMapper(self.mergedTubeMapper)
+
+        # set up centerline actor, colored like the merged tubes
+        for mapper in (self.mergedTubeMapper, self.centerlineMapper):
+            mapper.SetScalarModeToUseCellFieldData()
+            mapper.SelectColorArray(TUBE_ID_ARRAY)
+            mapper.SetColorModeToMapScalars()
+            mapper.UseLookupTableScalarRangeOn()
+            mapper.SetLookupTable(self.tubeSelectionTable)
+        self.centerlineActor.SetMapper(self.centerlineMapper)
+        self.centerlineActor.GetProperty().SetLineWidth(2)
+        self.centerlineActor.VisibilityOff()
+
+        # tubes past the end of the selection table are not selected
+        self.tubeSelectionTable.SetAboveRangeColor(
+                [c / 255.0 for c in TUBE_COLOR])
+        self.tubeSelectionTable.UseAboveRangeColorOn()
+        self._resizeTubeSelectionTable(1)
+
         picker = self.volumeRenderer.GetRenderWindow().GetInteractor() \
                 .GetPicker()
         picker.AddPickList(self.tubeActor)
+        picker.AddPickList(self.mergedTubeActor)
 
     def onSliceClicked(self, istyle, event):
         '''Slice click callback'''
@@ -186,7 +230,25 @@ class VTKViewer(QWidget):
         clickX, clickY = istyle.GetInteractor().GetEventPosition()
         picker = istyle.GetInteractor().GetPicker()
         if picker.Pick(clickX, clickY, 0, self.volumeRenderer):
-            self.pickTubeBlock(picker.GetFlatBlockIndex())
+            if picker.GetActor() is self.mergedTubeActor:
+                self.pickTubeCell(picker.GetDataSet(), picker.GetCellId())
+            else:
+                self.pickTubeBlock(picker.GetFlatBlockIndex())
+
+    def onVolumeInteractionStart(self, istyle, event):
+        '''Swaps tubes for their centerlines while the camera moves.'''
+        if self.centerlineMapper.GetInputConnection(0, 0) is None:
+            return
+        for actor in (self.tubeActor, self.mergedTubeActor):
+            actor.VisibilityOff()
+        self.centerlineActor.VisibilityOn()
+
+    def onVolumeInteractionEnd(self, istyle, event):
+        '''Shows full tubes again once the camera stops.'''
+        # the interactor renders right after this event
+        self.centerlineActor.VisibilityOff()
+        for actor in (self.tubeActor, self.mergedTubeActor):
+            actor.VisibilityOn()
 
     def onWindowLevelChange(self, istyle, event):
         '''Callback when the VTK image window level changes.'''
@@ -198,16 +260,16 @@ class VTKViewer(QWidget):
 
     def pickTubeBlock(self, blockIndex):
         '''Picks out the clicked tube.'''
-        if self.tubeBlocks:
-            it = self.tubeBlocks.NewTreeIterator()
-            it.SetVisitOnlyLeaves(False)
-            it.InitTraversal()
-            while not it.IsDoneWithTraversal():
-                if blockIndex == it.GetCurrentFlatIndex():
-                    tubeId = it.GetCurrentMetaData().Get(TUBE_ID_KEY)
-                    self.tubeSelected.emit(tubeId)
-                    break
-                it.GoToNextItem()
+        tubeId = self.blockTubeIds.get(blockIndex)
+        if tubeId is not None:
+            self.tubeSelected.emit(tubeId)
+
+    def pickTubeCell(self, dataSet, cellId):
+        '''Picks out the tube of a clicked merged mesh cell.'''
+        tubeIds = dataSet.GetCellData().GetArray(TUBE_ID_ARRAY) \
+                if dataSet is not None else None
+        if tubeIds is not None and 0 <= cellId < tubeIds.GetNumberOfTuples():
+            self.tubeSelected.emit(int(tubeIds.GetValue(cellId)))
 
     def displayImage(self, vtkImageData, preserveState=False):
         '''Updates viewer with a new image.'''
@@ -324,11 +386,18 @@ class VTKViewer(QWidget):
         self.volumeRenderer.AddViewProp(self.volume)
         self.volumeRenderer.ResetCamera()
 
-    def showTubeBlocks(self, tubeBlocks):
-        '''Shows tube blocks in scene.'''
+    def showTubeBlocks(self, tubeBlocks, blockTubeIds):
+        '''Shows tube blocks in scene.
+
+        Args:
+            tubeBlocks: a vtkMultiBlockDataSet of tube polydata.
+            blockTubeIds: a map of flat block index -> tubeId.
+        '''
         self.tubeBlocks = tubeBlocks
+        self.blockTubeIds = blockTubeIds
 
         # make sure tube actor is in the scene
+        self.volumeRenderer.RemoveActor(self.mergedTubeActor)
         if not self.volumeRenderer.HasViewProp(self.tubeActor):
             self.volumeRenderer.AddActor(self.tubeActor)
 
@@ -337,20 +406,109 @@ class VTKViewer(QWidget):
         self.volumeRenderer.ResetCamera()
         self.volumeView.GetRenderWindow().Render()
 
-    def showTubeSelection(self, tubeSelection):
-        '''Shows tube selections.
+    def renderTubes(self):
+        '''Re-renders the scene after tube data changed.'''
+        self.volumeView.GetRenderWindow().Render()
+
+    def updateTubeBlockSelection(self, selectedIndexes, deselectedIndexes):
+        '''Updates the highlighted tube blocks.
+
+        The display attributes are kept, so only the given blocks change.
 
         Args:
-            tubeSelection: an iterable of tube block indexes.
+            selectedIndexes: flat indexes of blocks to highlight.
+            deselectedIndexes: flat indexes of blocks to stop highlighting.
         '''
-        cdda = vtk.vtkCompositeDataDisplayAttributes()
-        # default red
-        cdda.SetBlockColor(0, (1,0,0))
-        for index in tubeSelection:
-            cdda.SetBlockColor(index, (1,1,1))
-        self.tubeMapper.SetCompositeDataDisplayAttributes(cdda)
+        attributes = self.tubeDisplayAttributes
+        for index in deselectedIndexes:
+            attributes.RemoveBlockColor(index)
+        for index in selectedIndexes:
+            attributes.SetBlockColor(index, (1,1,1))
+        if selectedIndexes or deselectedIndexes:
+            attributes.Modified()
+            self.tubeMapper.Modified()
+
+    def clearTubeBlockSelection(self):
+        '''Removes all tube block highlights.'''
+        attributes = self.tubeDisplayAttributes
+        attributes.RemoveBlockColors()
+        attributes.SetBlockColor(0, (1,0,0))
+        attributes.Modified()
+        self.tubeMapper.Modified()
+
+    def setInteractionTubes(self, centerlinePort):
+        '''Sets the tube centerlines shown during interaction.
+
+        Args:
+            centerlinePort: output port of a vtkMultiBlockDataSet of merged
+                tube centerlines, with tube IDs in a cell array.
+        '''
+        self.centerlineMapper.SetInputConnection(centerlinePort)
+        if not self.volumeRenderer.HasViewProp(self.centerlineActor):
+            self.volumeRenderer.AddActor(self.centerlineActor)
+
+    def showMergedTubes(self, tubePort):
+        '''Shows all tubes as a few merged meshes in scene.
+
+        Args:
+            tubePort: output port of a vtkMultiBlockDataSet of merged tube
+                meshes, with tube IDs in a cell array.
+        '''
+        self.volumeRenderer.RemoveActor(self.tubeActor)
+        if not self.volumeRenderer.HasViewProp(self.mergedTubeActor):
+            self.volumeRenderer.AddActor(self.mergedTubeActor)
+
+        self.mergedTubeMapper.SetInputConnection(tubePort)
+        self.mergedTubeMapper.Update()
+        self.volumeRenderer.ResetCamera()
         self.volumeView.GetRenderWindow().Render()
 
+    def updateTubeSelectionTable(self, selected, deselected):
+        '''Updates the tube ID colors of the merged mesh and centerlines.
+
+        Only the entries of the given tubes change, unless the table has to
+        grow or most of it changes.
+
+        Args:
+            selected: array of newly selected tube IDs.
+            deselected: array of newly deselected tube IDs.
+        '''
+        if len(selected) and selected.max() >= len(self._tubeColors):
+            self._resizeTubeSelectionTable(max(2*len(self._tubeColors),
+                int(selected.max()) + 1))
+        colors = self._tubeColors
+        deselected = deselected[deselected < len(colors)]
+        colors[deselected] = TUBE_COLOR
+        colors[selected] = SELECTED_TUBE_COLOR
+
+        if 8*(len(selected) + len(deselected)) > len(colors):
+            self._setTubeSelectionTable()
+            return
+        table = self.tubeSelectionTable
+        for tubeIds, color in ((deselected, TUBE_COLOR),
+                (selected, SELECTED_TUBE_COLOR)):
+            rgba = [c / 255.0 for c in color]
+            for tubeId in tubeIds.tolist():
+                table.SetTableValue(tubeId, rgba)
+        table.Modified()
+
+    def _resizeTubeSelectionTable(self, size):
+        '''Grows the tube ID color table, keeping its colors.'''
+        colors = np.empty((size, 4), dtype=np.uint8)
+        colors[:] = TUBE_COLOR
+        colors[:len(self._tubeColors)] = self._tubeColors
+        self._tubeColors = colors
+        self._setTubeSelectionTable()
+
+    def _setTubeSelectionTable(self):
+        '''Loads the whole tube ID color table.'''
+        table = self.tubeSelectionTable
+        size = len(self._tubeColors)
+        table.SetTable(np_s.numpy_to_vtk(self._tubeColors, deep=True))
+        # center each tube ID in its table entry
+        table.SetTableRange(-0.5, size - 0.5)
+        table.Modified()
+
     def updateSlice(self, pos):
         '''Re-renders the slice with a new position.'''
         # z slice